@@ -0,0 +1,604 @@
+"""Trivia Api benchmark
+
+Seed a database with generated questions, drive every endpoint of the
+Trivia Api in-process and report throughput and p50/p95/p99 latency.
+Results are saved as JSON, so runs can be compared and regressions
+flagged.
+
+Example:
+    Seed 100k questions into SQLite, run the benchmark and compare it
+    with a baseline
+
+        $ python benchmark.py seed sqlite:////tmp/trivia.db -n 100000
+        $ python benchmark.py run sqlite:////tmp/trivia.db -o result.json
+        $ python benchmark.py compare baseline.json result.json
+
+    "seed" replaces all questions, categories and quiz events of the
+    database, so point it at a database used only for benchmarks.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import Flask
+
+from flaskr import create_app
+from flaskr.asgi import AsgiApp
+from sqlalchemy import func
+
+from models import db, init_db, setup_db, use_primary, Question, \
+    Category, QuestionCount, QuizEvent, TableVersion
+
+DEFAULT_SEED = 2020
+DEFAULT_REQUESTS = 200
+SEED_BATCH_SIZE = 5000
+QUIZ_LENGTH = 50
+DECK_SIZE = 10
+EVENTS_PER_REQUEST = 10
+BATCH_SIZE = 10
+REGRESSION_THRESHOLD = 0.1
+
+CATEGORIES = (
+    'Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports')
+WORDS = (
+    'river', 'planet', 'painter', 'empire', 'movie', 'league', 'ocean',
+    'element', 'novel', 'mountain', 'king', 'queen', 'island', 'album',
+    'bridge', 'desert', 'engine', 'festival', 'galaxy', 'harbor',
+    'insect', 'jungle', 'lantern', 'marathon', 'nebula', 'orchestra',
+    'pyramid', 'quartz', 'rocket', 'symphony', 'temple', 'volcano',
+)
+
+
+def generate_questions(count, category_ids, seed=DEFAULT_SEED):
+    """Generate questions reproducibly
+
+    Args:
+        count (int): The number of questions
+        category_ids (list): ids of the categories of the questions
+        seed (int): The random seed
+
+    Yields:
+        dict: a row of the questions table
+    """
+    rng = random.Random(seed)
+    for _ in range(count):
+        words = rng.sample(WORDS, rng.randint(3, 8))
+        yield {
+            'question': f'What is the {" ".join(words)}?',
+            'answer': ' '.join(rng.sample(WORDS, rng.randint(1, 3))),
+            'category': rng.choice(category_ids),
+            'difficulty': rng.randint(1, 5),
+        }
+
+
+def seed_database(database, count, seed=DEFAULT_SEED,
+                  batch_size=SEED_BATCH_SIZE):
+    """Replace all questions, categories and quiz events with generated
+    questions and categories
+
+    Args:
+        database (str): URI of the database
+        count (int): The number of questions
+        seed (int): The random seed
+        batch_size (int): The number of rows inserted in a transaction
+    """
+    app = Flask(__name__)
+    setup_db(app, database)
+    with app.app_context():
+        init_db()
+        use_primary()
+        for model in (QuizEvent, QuestionCount, Question, Category):
+            db.session.query(model).delete()
+        db.session.execute(Category.__table__.insert(), [
+            {'id': i, 'type': type} for i, type in enumerate(CATEGORIES, 1)
+        ])
+        db.session.commit()
+
+        batch = []
+        category_ids = list(range(1, len(CATEGORIES) + 1))
+        for row in generate_questions(count, category_ids, seed):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                db.session.execute(Question.__table__.insert(), batch)
+                db.session.commit()
+                batch.clear()
+        if batch:
+            db.session.execute(Question.__table__.insert(), batch)
+            db.session.commit()
+
+        QuestionCount.rebuild()
+        Question.bump_versions(*category_ids)
+        TableVersion.bump(Category.__tablename__)
+        db.session.commit()
+        db.session.remove()
+
+
+class Dataset:
+    """What the scenarios need to know about the seeded database"""
+
+    def __init__(self, app):
+        with app.app_context():
+            use_primary()
+            self.categories = [
+                category.format() for category in
+                Category.query.order_by(Category.id).all()
+            ]
+            self.total_questions = QuestionCount.total()
+            self.max_question_id = \
+                db.session.query(func.max(Question.id)).scalar() or 0
+            db.session.remove()
+        self.pages = max(1, -(-self.total_questions // 10))
+
+
+class ClientRandom(random.Random):
+    """The Random of a benchmark client, which keeps its scenario state"""
+
+    def __init__(self, seed):
+        super().__init__(seed)
+        self.state = {}
+
+
+def _json(response):
+    return json.loads(response.get_data(as_text=True))
+
+
+class Scenario:
+    """A benchmarked request, or a sequence of requests
+
+    Args:
+        name (str): The name in the results
+        request (function): called with the client, a ClientRandom and
+            the Dataset, and returns the response of the measured request
+        expected (tuple): Expected status codes
+        weight (float): Fraction of the requests run for the scenario
+        prepare (function): called like request before each request,
+            without being measured, e.g. to create questions to delete
+    """
+
+    def __init__(self, name, request, expected=(200,), weight=1.0,
+                 prepare=None):
+        self.name = name
+        self.request = request
+        self.expected = expected
+        self.weight = weight
+        self.prepare = prepare
+
+
+def get_categories(client, rng, dataset):
+    return client.get('/categories')
+
+
+def get_questions_page(client, rng, dataset):
+    return client.get(f'/questions?page={rng.randint(1, dataset.pages)}')
+
+
+def get_questions_cursor(client, rng, dataset):
+    state = rng.state.setdefault('cursor', {'after': None})
+    query = '' if state['after'] is None else f'?after={state["after"]}'
+    response = client.get(f'/questions{query}')
+    state['after'] = _json(response).get('next_cursor')
+    return response
+
+
+def get_questions_not_modified(client, rng, dataset):
+    state = rng.state
+    if 'etag' not in state:
+        state['etag'] = client.get('/questions?page=1').headers['ETag']
+    return client.get('/questions?page=1',
+                      headers={'If-None-Match': state['etag']})
+
+
+def get_category_questions(client, rng, dataset):
+    category = rng.choice(dataset.categories)
+    return client.get(f'/categories/{category["id"]}/questions')
+
+
+def search_questions(client, rng, dataset):
+    term = ' '.join(rng.sample(WORDS, rng.randint(1, 2)))
+    return client.post('/search_questions', json={'searchTerm': term})
+
+
+def play_quiz(client, rng, dataset):
+    """Play quizzes with a growing list of previous questions"""
+    state = rng.state.setdefault('quiz', {'previous': []})
+    if not state['previous']:
+        state['category'] = rng.choice(
+            dataset.categories + [{'id': 0, 'type': 'click'}])
+    response = client.post('/quizzes', json={
+        'previous_questions': state['previous'],
+        'quiz_category': state['category'],
+    })
+    question = _json(response).get('question')
+    if question is None or len(state['previous']) >= QUIZ_LENGTH:
+        state['previous'] = []
+    else:
+        state['previous'].append(question['id'])
+    return response
+
+
+def create_quiz_session(client, rng, dataset):
+    return client.post('/quizzes/sessions', json={
+        'quiz_category': rng.choice(dataset.categories)})
+
+
+def play_quiz_session(client, rng, dataset):
+    state = rng.state.setdefault('session', {'id': None, 'asked': 0})
+    if state['id'] is None or state['asked'] >= QUIZ_LENGTH:
+        response = create_quiz_session(client, rng, dataset)
+        state['id'] = _json(response)['session_id']
+        state['asked'] = 0
+    response = client.post('/quizzes', json={'session_id': state['id']})
+    state['asked'] += 1
+    if _json(response).get('question') is None:
+        state['id'] = None
+    return response
+
+
+def draw_quiz_deck(client, rng, dataset):
+    return client.post('/quizzes/deck', json={
+        'quiz_category': rng.choice(
+            dataset.categories + [{'id': 0, 'type': 'click'}]),
+        'count': DECK_SIZE,
+    })
+
+
+def record_quiz_events(client, rng, dataset):
+    return client.post('/quizzes/events', json={'events': [{
+        'question_id': rng.randint(1, max(1, dataset.max_question_id)),
+        'correct': rng.random() < 0.5,
+    } for _ in range(EVENTS_PER_REQUEST)]})
+
+
+def get_quiz_stats(client, rng, dataset):
+    category = rng.choice(dataset.categories)
+    return client.get(f'/quizzes/stats?category={category["id"]}')
+
+
+def export_questions(client, rng, dataset):
+    category = rng.choice(dataset.categories)
+    response = client.get(f'/questions/export?category={category["id"]}')
+    response.get_data()
+    return response
+
+
+def get_stats(client, rng, dataset):
+    return client.get('/stats')
+
+
+def get_metrics(client, rng, dataset):
+    return client.get('/metrics')
+
+
+def create_question(client, rng, dataset):
+    """Create a question, which delete_question deletes afterwards"""
+    category = rng.choice(dataset.categories)
+    row = next(generate_questions(1, [category['id']], rng.random()))
+    response = client.post('/questions', json=row)
+    rng.state.setdefault('created', []).append(_json(response)['created'])
+    return response
+
+
+def delete_question(client, rng, dataset):
+    created = rng.state.get('created')
+    if not created:
+        create_question(client, rng, dataset)
+        created = rng.state['created']
+    return client.delete(f'/questions/{created.pop()}')
+
+
+def create_batch(client, rng, dataset):
+    """Create BATCH_SIZE questions for the next batch write, unless the
+    previous batch is still there"""
+    created = rng.state.setdefault('created', [])
+    while len(created) < BATCH_SIZE:
+        create_question(client, rng, dataset)
+
+
+def update_questions(client, rng, dataset):
+    return client.patch('/questions', json={
+        'ids': rng.state['created'],
+        'difficulty': rng.randint(1, 5),
+    })
+
+
+def delete_questions(client, rng, dataset):
+    ids = rng.state.pop('created')
+    return client.delete('/questions', json={'ids': ids})
+
+
+def import_questions(client, rng, dataset):
+    category_ids = [category['id'] for category in dataset.categories]
+    body = ''.join(
+        json.dumps(row) + '\n'
+        for row in generate_questions(50, category_ids, rng.random()))
+    return client.post('/questions/bulk', data=body,
+                       content_type='application/x-ndjson')
+
+
+# Scenarios run in this order. Writes come last and leave the questions
+# as seeded, except the bulk import and BATCH_SIZE questions per client
+# of the batch update.
+SCENARIOS = (
+    Scenario('GET /categories', get_categories),
+    Scenario('GET /questions?page', get_questions_page),
+    Scenario('GET /questions?after', get_questions_cursor),
+    Scenario('GET /questions 304', get_questions_not_modified,
+             expected=(304,)),
+    Scenario('GET /categories/<id>/questions', get_category_questions),
+    Scenario('POST /search_questions', search_questions),
+    Scenario('POST /quizzes', play_quiz),
+    Scenario('POST /quizzes/sessions', create_quiz_session),
+    Scenario('POST /quizzes session', play_quiz_session),
+    Scenario('POST /quizzes/deck', draw_quiz_deck),
+    Scenario('POST /quizzes/events', record_quiz_events, expected=(202,)),
+    Scenario('GET /quizzes/stats', get_quiz_stats),
+    Scenario('GET /questions/export', export_questions, weight=0.1),
+    Scenario('GET /stats', get_stats),
+    Scenario('GET /metrics', get_metrics),
+    Scenario('POST /questions', create_question),
+    Scenario('DELETE /questions/<id>', delete_question),
+    Scenario('PATCH /questions', update_questions, prepare=create_batch),
+    Scenario('DELETE /questions', delete_questions, prepare=create_batch),
+    Scenario('POST /questions/bulk', import_questions, weight=0.1),
+)
+
+
+def percentile(latencies, p):
+    """The p-th percentile by the nearest rank of sorted latencies"""
+    if not latencies:
+        return None
+    rank = max(1, -(-len(latencies) * p // 100))
+    return latencies[int(rank) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """Summarize latencies (seconds) of a scenario in milliseconds"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput': count / elapsed if elapsed else None,
+        'mean_ms': sum(latencies) / count * 1000 if count else None,
+        **{
+            f'p{p}_ms': percentile(latencies, p) * 1000 if count else None
+            for p in (50, 95, 99)
+        },
+        'max_ms': latencies[-1] * 1000 if count else None,
+    }
+
+
+def run_scenario(scenario, client_factory, dataset, requests, concurrency,
+                 seed):
+    """Run a scenario in concurrent clients
+
+    Every client runs its share of the requests with its own Random
+    seeded from seed, and keeps its own scenario state, e.g. its quiz.
+
+    Returns:
+        dict: the summary of the scenario
+    """
+    count = max(1, int(requests * scenario.weight))
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client_loop(index, share):
+        client = client_factory()
+        rng = ClientRandom(f'{seed}:{scenario.name}:{index}')
+        own_latencies = []
+        own_errors = 0
+        for _ in range(share):
+            started = time.perf_counter()
+            try:
+                if scenario.prepare is not None:
+                    scenario.prepare(client, rng, dataset)
+                    started = time.perf_counter()
+                response = scenario.request(client, rng, dataset)
+                ok = response.status_code in scenario.expected
+            except Exception:
+                ok = False
+            own_latencies.append(time.perf_counter() - started)
+            own_errors += not ok
+        with lock:
+            latencies.extend(own_latencies)
+            errors.append(own_errors)
+
+    shares = [
+        count // concurrency + (i < count % concurrency)
+        for i in range(concurrency)
+    ]
+    threads = [
+        threading.Thread(target=client_loop, args=(i, share))
+        for i, share in enumerate(shares) if share
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, sum(errors), time.perf_counter() - started)
+
+
+def run_benchmark(database, requests=DEFAULT_REQUESTS, concurrency=1,
+                  seed=DEFAULT_SEED, asgi=False, scenarios=None,
+                  config=None):
+    """Run the benchmark against a seeded database
+
+    Args:
+        database (str): URI of the database
+        requests (int): The number of requests of each scenario
+        concurrency (int): The number of concurrent clients
+        seed (int): The random seed of the requests
+        asgi (bool): Send the requests through the ASGI app
+        scenarios (list): Names of the scenarios to run. All scenarios
+            are run if it is not given.
+        config (dict): Additional config passed to create_app
+
+    Returns:
+        dict: the results with "meta" and "scenarios"
+    """
+    app = create_app(dict(config or {}, DATABASE_PATH=database))
+    client_factory = app.test_client
+    if asgi:
+        client_factory = AsgiApp(app).test_client
+    dataset = Dataset(app)
+
+    results = {}
+    for scenario in SCENARIOS:
+        if scenarios and scenario.name not in scenarios:
+            continue
+        results[scenario.name] = run_scenario(
+            scenario, client_factory, dataset, requests, concurrency, seed)
+    # write the recorded quiz events before the database is left alone
+    app.extensions['quiz_events'].close()
+
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'database': db.get_engine(app).dialect.name,
+            'questions': dataset.total_questions,
+            'requests': requests,
+            'concurrency': concurrency,
+            'seed': seed,
+            'asgi': asgi,
+            'read_model': bool(app.config.get('READ_MODEL', False)),
+            'python': platform.python_version(),
+            'startup': app.extensions['startup_report'].as_dict(),
+        },
+        'scenarios': results,
+    }
+
+
+def compare_results(baseline, result, threshold=REGRESSION_THRESHOLD):
+    """Compare results with a baseline
+
+    A scenario regresses if its p95 latency grows or its throughput
+    drops by more than threshold, or if it has new errors.
+
+    Returns:
+        list: a dictionary per scenario in both results, with
+            "regressions", a list of regressed metrics
+    """
+    comparison = []
+    for name, new in result['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            continue
+        regressions = []
+        if old['p95_ms'] and new['p95_ms'] \
+                and new['p95_ms'] > old['p95_ms'] * (1 + threshold):
+            regressions.append('p95_ms')
+        if old['throughput'] and new['throughput'] \
+                and new['throughput'] < old['throughput'] * (1 - threshold):
+            regressions.append('throughput')
+        if new['errors'] > old['errors']:
+            regressions.append('errors')
+        comparison.append({
+            'scenario': name,
+            'old': old,
+            'new': new,
+            'regressions': regressions,
+        })
+    return comparison
+
+
+def _format_ms(value):
+    return '-' if value is None else f'{value:.2f}'
+
+
+def print_results(results, file=sys.stdout):
+    print(f'{"scenario":34} {"req/s":>9} {"p50":>8} {"p95":>8} '
+          f'{"p99":>8} {"errors":>6}', file=file)
+    for name, summary in results['scenarios'].items():
+        print(f'{name:34} {summary["throughput"] or 0:9.1f} '
+              f'{_format_ms(summary["p50_ms"]):>8} '
+              f'{_format_ms(summary["p95_ms"]):>8} '
+              f'{_format_ms(summary["p99_ms"]):>8} '
+              f'{summary["errors"]:6}', file=file)
+
+
+def print_comparison(comparison, file=sys.stdout):
+    print(f'{"scenario":34} {"p95 old":>9} {"p95 new":>9} '
+          f'{"req/s old":>10} {"req/s new":>10}', file=file)
+    for row in comparison:
+        old, new = row['old'], row['new']
+        flag = ' REGRESSION: ' + ', '.join(row['regressions']) \
+            if row['regressions'] else ''
+        print(f'{row["scenario"]:34} {_format_ms(old["p95_ms"]):>9} '
+              f'{_format_ms(new["p95_ms"]):>9} '
+              f'{old["throughput"] or 0:10.1f} '
+              f'{new["throughput"] or 0:10.1f}{flag}', file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Trivia Api benchmark')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed = commands.add_parser('seed', help='seed a benchmark database')
+    seed.add_argument('database', help='database URI')
+    seed.add_argument('-n', '--questions', type=int, default=1000)
+    seed.add_argument('--seed', type=int, default=DEFAULT_SEED)
+
+    run = commands.add_parser('run', help='run the benchmark')
+    run.add_argument('database', help='database URI')
+    run.add_argument('-r', '--requests', type=int, default=DEFAULT_REQUESTS,
+                     help='requests per scenario')
+    run.add_argument('-c', '--concurrency', type=int, default=1)
+    run.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    run.add_argument('--asgi', action='store_true',
+                     help='send requests through the ASGI app')
+    run.add_argument('--read-model', action='store_true',
+                     help='serve question reads from the read model')
+    run.add_argument('-s', '--scenario', action='append',
+                     help='run only this scenario, can be repeated')
+    run.add_argument('-o', '--output', help='save the results as JSON')
+    run.add_argument('-b', '--baseline',
+                     help='compare the results with a saved baseline')
+    run.add_argument('-t', '--threshold', type=float,
+                     default=REGRESSION_THRESHOLD)
+
+    compare = commands.add_parser('compare', help='compare saved results')
+    compare.add_argument('baseline')
+    compare.add_argument('result')
+    compare.add_argument('-t', '--threshold', type=float,
+                         default=REGRESSION_THRESHOLD)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'seed':
+        seed_database(args.database, args.questions, args.seed)
+        return 0
+
+    if args.command == 'run':
+        result = run_benchmark(
+            args.database, requests=args.requests,
+            concurrency=args.concurrency, seed=args.seed, asgi=args.asgi,
+            scenarios=args.scenario,
+            config={'READ_MODEL': args.read_model})
+        print_results(result)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(result, output, indent=2)
+        if not args.baseline:
+            return 0
+        with open(args.baseline) as baseline:
+            baseline = json.load(baseline)
+    else:
+        with open(args.baseline) as baseline:
+            baseline = json.load(baseline)
+        with open(args.result) as result:
+            result = json.load(result)
+
+    comparison = compare_results(baseline, result, args.threshold)
+    print_comparison(comparison)
+    return 1 if any(row['regressions'] for row in comparison) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
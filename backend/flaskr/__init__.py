@@ -11,35 +11,172 @@ Example:
 
         $ FLASK_APP=flaskr FLASK_ENV=development flask run
 """
-import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+import click
+from datetime import datetime
+from flask import Flask, Response, g, request, abort, jsonify, \
+    stream_with_context
 from flask_cors import CORS
 import random
-
-from models import setup_db, Question, Category
+import time
+
+from models import database_path, init_db, setup_db, use_primary, \
+    Category, Question, QuestionCount, QuizEvent, category_cache
+from .bulk_import import import_questions
+from .conditional import conditional, table_versions
+from .export import MIMETYPES, export_rows, generate_export
+from .instrumentation import StartupReport, init_instrumentation
+from .quiz_deck import QuizDeckSampler
+from .quiz_events import create_quiz_event_writer
+from .quiz_sessions import create_quiz_session_store
+from .response_cache import create_response_cache
+from .search import create_search_backend
+from .serialization import QUESTION_COLUMNS, QUESTION_FIELDS, \
+    create_json_backend, parse_fields, project, question_columns, \
+    json_response
 
 QUESTIONS_PER_PAGE = 10
+MAX_BATCH_SIZE = 1000
+QUESTIONS_PER_PLAY = 5
+MAX_DECK_SIZE = 50
+MAX_QUIZ_EVENTS = 100
+
+# POST endpoints which only read, and can be served by replicas
+READ_ONLY_ENDPOINTS = {
+    'create_quiz_deck',
+    'create_quiz_session',
+    'retrieve_questions_by_search',
+    'retrieve_questions_for_quiz',
+}
 
 
-def paginate_questions(request, all_questions):
-    """Paginate questions by QUESTIONS_PER_PAGE
+def paginate_questions(request, selection, fields=QUESTION_FIELDS):
+    """Paginate questions by QUESTIONS_PER_PAGE in the database
+
+    LIMIT/OFFSET is pushed down into SQL for the "?page=<n>" form. The
+    "?after=<id>" form is keyset pagination on Question.id, so that deep
+    pages cost the same as the first one.
 
     Args:
         request (obj): An instance of request_class
-        all_questions (list): list of dictionaries which are json
-            objects of all questions
+        selection (obj): A Question query which is not ordered or
+            limited yet
+        fields (tuple): The selected question fields
+
+    Returns:
+        list: a paginated list of question rows of fields
+    """
+    selection = selection.order_by(Question.id)
+
+    after = request.args.get('after', None, type=int)
+    if after is not None:
+        selection = selection.filter(Question.id > after)
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return []
+        selection = selection.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+    return selection.with_entities(*question_columns(fields)) \
+        .limit(QUESTIONS_PER_PAGE).all()
+
+
+def list_projection(request, categories_by_default=False):
+    """Get the projection of a question list endpoint
+
+    "?fields=<field>,..." selects question fields, the id always
+    included, and then the categories are only listed with
+    "?include=categories".
+
+    Args:
+        request (obj): An instance of request_class
+        categories_by_default (bool): The endpoint lists the
+            categories unless "?fields=" is given
+
+    Returns:
+        tuple: the selected fields and whether the categories are
+            listed
+
+    Raises:
+        400: Bad request if a field or an include is unknown.
+    """
+    includes = {
+        name.strip() for name in request.args.get('include', '').split(',')
+        if name.strip()
+    }
+    if not includes <= {'categories'}:
+        abort(400)
+    try:
+        fields = parse_fields(request.args.get('fields', None))
+    except ValueError:
+        abort(400)
+    include_categories = 'categories' in includes or (
+        categories_by_default and 'fields' not in request.args)
+    return fields, include_categories
+
+
+def next_cursor(current_questions):
+    """Get the keyset cursor for the page after current_questions
+
+    Args:
+        current_questions (list): a paginated list of question rows
+
+    Returns:
+        int: the id to pass as "?after=<id>", or None if the page is
+            not full
+    """
+    if len(current_questions) < QUESTIONS_PER_PAGE:
+        return None
+    return current_questions[-1][0]
+
+
+def quiz_question_ids(quiz_category, previous_questions=()):
+    """Get ids of the questions which can be asked in a quiz
+
+    Only the id column is selected.
+
+    Args:
+        quiz_category (dict): The quiz category. Its id 0 means 'all'
+            categories.
+        previous_questions (list): Ids of questions to exclude
+
+    Returns:
+        list: a list of question ids
+    """
+    selection = Question.query.with_entities(Question.id)
+    if int(quiz_category['id']) != 0:
+        selection = selection.filter(
+            Question.category == int(quiz_category['id']))
+    if previous_questions:
+        selection = selection.filter(Question.id.notin_(previous_questions))
+    return [question_id for question_id, in selection]
+
+
+def question_row(question_id):
+    """Get a question row of QUESTION_COLUMNS by the primary key
 
     Returns:
-        list: a paginated question list
+        tuple: the question row, or None if there is no such a question
     """
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+    return Question.query.with_entities(*QUESTION_COLUMNS) \
+        .filter(Question.id == question_id).first()
+
 
-    questions = [question.format() for question in all_questions]
-    current_questions = questions[start:end]
-    return current_questions
+def batch_question_ids(body):
+    """Get the question ids of a batch mutation
+
+    Args:
+        body (dict): a request body with "ids", a list of question ids
+
+    Returns:
+        list: the question ids, or None if they are missing, not
+            integers or more than MAX_BATCH_SIZE
+    """
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not 0 < len(ids) <= MAX_BATCH_SIZE:
+        return None
+    if not all(type(question_id) is int for question_id in ids):
+        return None
+    return ids
 
 
 def create_app(test_config=None):
@@ -52,7 +189,31 @@ def create_app(test_config=None):
         - Error Handlers
 
     Args:
-        test_config ():
+        test_config (dict): config overriding the defaults, such as
+            DATABASE_PATH: URI of the primary database
+            DATABASE_REPLICA_PATHS: URIs of the read replicas
+            DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW,
+            DATABASE_POOL_PRE_PING: connection pool options
+            DATABASE_STATEMENT_TIMEOUT: statement timeout in
+                milliseconds
+            JSON_BACKEND: 'json' (default) or 'orjson'
+            RESPONSE_CACHE: 'memory' (default) or 'sqlite'
+            RESPONSE_CACHE_MAX_BYTES: the size of the response cache
+            RESPONSE_CACHE_PATH: the file of the 'sqlite' cache
+            PROFILER_TOKEN: the X-Profile header value profiling a
+                request and authorizing "/admin/profiles"
+            PROFILER_SAMPLE_RATE: the probability of profiling a
+                request, 0 by default
+            PROFILER_DIR: the directory of the profile files
+            PROFILER_KEEP: the number of slowest profiles kept
+            READ_MODEL: serve question reads from memory, False by
+                default
+            READ_MODEL_POLL_SECONDS: the interval of checking the
+                questions table for changes of other workers
+            READ_MODEL_MAX_QUESTIONS: the number of questions beyond
+                which reads go to the database
+            QUIZ_EVENTS_BATCH_SIZE, QUIZ_EVENTS_FLUSH_SECONDS,
+            QUIZ_EVENTS_MAX_QUEUE: batching of the quiz event writer
 
     Returns:
         obj: a "Trivia API" Flask app object
@@ -62,21 +223,204 @@ def create_app(test_config=None):
     # Initial setups
     ######################################################################
 
+    started_at = time.perf_counter()
+
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+
+    setup_db(
+        app,
+        app.config.get('DATABASE_PATH', database_path),
+        replica_paths=app.config.get('DATABASE_REPLICA_PATHS', ()),
+        pool_size=app.config.get('DATABASE_POOL_SIZE'),
+        max_overflow=app.config.get('DATABASE_MAX_OVERFLOW'),
+        pool_pre_ping=app.config.get('DATABASE_POOL_PRE_PING', True),
+        statement_timeout=app.config.get('DATABASE_STATEMENT_TIMEOUT'),
+    )
+
+    # optional subsystems are only imported when their config enables
+    # them, which is timed as the import of the app
+    imports_started_at = time.perf_counter()
+    admission_enabled = \
+        app.config.get('ADMISSION_MAX_CONCURRENCY') is not None
+    if admission_enabled:
+        from .admission import init_admission
+    profiler_enabled = app.config.get('PROFILER_TOKEN') is not None \
+        or bool(app.config.get('PROFILER_SAMPLE_RATE'))
+    if profiler_enabled:
+        from .profiler import PROFILE_HEADER, init_profiler
+    compression_enabled = app.config.get('COMPRESSION', True)
+    if compression_enabled:
+        from .compression import create_compressor
+    read_model_enabled = app.config.get('READ_MODEL', False)
+    if read_model_enabled:
+        from .read_model import create_read_model
+    startup = StartupReport(time.perf_counter() - imports_started_at)
+
+    app.extensions['startup_report'] = startup
+    metrics = init_instrumentation(app, startup)
+    admission = init_admission(app) if admission_enabled else None
+    app.extensions['admission'] = admission
+    if admission is not None:
+        metrics.register(admission.collect)
+    profiler = init_profiler(app) if profiler_enabled else None
+    if profiler is not None:
+        metrics.register(profiler.collect)
 
     CORS(app, resources={r"/*": {"origins": "*"}})
 
+    quiz_sessions = create_quiz_session_store(app)
+    quiz_decks = QuizDeckSampler()
+    quiz_events = create_quiz_event_writer(app)
+    app.extensions['quiz_events'] = quiz_events
+    metrics.register(quiz_events.collect)
+    compressor = create_compressor(app) if compression_enabled else None
+    if compressor is not None:
+        metrics.register(compressor.collect)
+    json_backend = create_json_backend(app.config.get('JSON_BACKEND', 'json'))
+    response_cache = create_response_cache(app)
+    metrics.register(response_cache.collect)
+    read_model = create_read_model(app, QUESTIONS_PER_PAGE) \
+        if read_model_enabled else None
+    if read_model is not None:
+        metrics.register(read_model.collect)
+
+    def serving_read_model():
+        """Get the read model if it can serve the current request
+
+        Returns:
+            obj: the QuestionReadModel, or None if reads go to the
+                database
+        """
+        if read_model is None:
+            return None
+        if 'read_model_ready' not in g:
+            # check the version of the questions once per request, and
+            # reuse the version read for the ETag if there is one
+            g.read_model_ready = read_model.refresh(
+                g.get('table_versions', {}).get(Question.__tablename__))
+        return read_model if g.read_model_ready else None
+
+    def total_questions():
+        """Get the number of all questions"""
+        model = serving_read_model()
+        if model is not None:
+            return model.total()
+        return QuestionCount.total()
+
+    def quiz_ids(quiz_category, previous_questions=()):
+        """Get ids of the questions which can be asked in a quiz, from
+        the read model if possible"""
+        model = serving_read_model()
+        if model is None:
+            return quiz_question_ids(quiz_category, previous_questions)
+        category_id = int(quiz_category['id'])
+        return model.question_ids(
+            category_id if category_id != 0 else None, previous_questions)
+
+    def find_question_row(question_id):
+        """Get a question row by id, from the read model if possible"""
+        model = serving_read_model()
+        if model is None:
+            return question_row(question_id)
+        return model.row(question_id)
+
+    def questions_version():
+        """Get the version of the questions table, read once per request"""
+        return table_versions(Question.__tablename__)[Question.__tablename__]
+
+    def current_categories():
+        """Get the category cache at the version of the categories table
+        read by the request, so that categories added by other workers
+        are known
+
+        Returns:
+            obj: the CategoryCache
+        """
+        category_cache.refresh(
+            table_versions(Category.__tablename__)[Category.__tablename__])
+        return category_cache
+
+    def question_page(key, tags, selection, category_id=None,
+                      fields=QUESTION_FIELDS):
+        """Get a cached page of questions
+
+        Args:
+            key (str): The cache key of the selection
+            tags (tuple): Tags invalidating the page
+            selection (obj): A Question query which is not ordered or
+                limited yet
+            category_id (int): The category of the selection, keyed by
+                the version of its questions, None for all questions
+            fields (tuple): The selected question fields
+
+        Returns:
+            dict: "questions" and "next_cursor" encoded, or None if
+                there is no question in the page
+        """
+        after = request.args.get('after', None, type=int)
+        page = request.args.get('page', 1, type=int)
+        key = f'{key}?after={after}' if after is not None \
+            else f'{key}?page={page}'
+        if fields != QUESTION_FIELDS:
+            key = f'{key}&fields={",".join(fields)}'
+
+        def build():
+            model = serving_read_model()
+            if model is not None:
+                current_questions = project(
+                    model.page(category_id, after, page), fields)
+            else:
+                current_questions = paginate_questions(
+                    request, selection, fields)
+            if len(current_questions) == 0:
+                return None
+            return {
+                'questions': json_backend.rows(
+                    current_questions, fields).json,
+                'next_cursor': json_backend.encode(
+                    next_cursor(current_questions)),
+            }
+        if category_id is None:
+            version = questions_version()
+        else:
+            name = Question.category_version_name(category_id)
+            version = table_versions(name)[name]
+        return response_cache.cached(key, tags, build, version)
+
+    search_backend = create_search_backend(app, serving_read_model)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create or upgrade the database schema and indexes."""
+        applied = init_db()
+        search_backend.ensure_indexes()
+        if applied:
+            click.echo(f'Applied migrations {applied}.')
+        click.echo('The database is up to date.')
+
+    @app.before_request
+    def route_writes_to_primary():
+        """Run requests which write on the primary database
+
+        GET requests and READ_ONLY_ENDPOINTS are read from replicas.
+        """
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') \
+                and request.endpoint not in READ_ONLY_ENDPOINTS:
+            use_primary()
+
     @app.after_request
     def after_request(response):
-        """Setting Access-Control-Allow
+        """Setting Access-Control-Allow, and compressing the response
 
         Args:
             response (obj): an instance of response_class
 
         Return:
-            response object with Access-Control-Allow
+            response object with Access-Control-Allow, compressed if
+                the client accepts it
         """
         response.headers.add(
             'Access-Control-Allow-Headers',
@@ -84,8 +428,10 @@ def create_app(test_config=None):
         )
         response.headers.add(
             'Access-Control-Allow-Methods',
-            'GET, PUT, POST, DELETE, OPTIONS'
+            'GET, PUT, POST, PATCH, DELETE, OPTIONS'
         )
+        if compressor is not None:
+            response = compressor.compress(request, response)
         return response
 
     ######################################################################
@@ -93,6 +439,7 @@ def create_app(test_config=None):
     ######################################################################
 
     @app.route('/categories', methods=['GET'])
+    @conditional('categories')
     def retrieve_categories():
         """An endpoint to handle GET requests '/categories'
 
@@ -107,8 +454,7 @@ def create_app(test_config=None):
             422: Unprocessable request.
         """
         try:
-            categories = Category.query.order_by(Category.id).all()
-            categories = [category.type for category in categories]
+            categories = current_categories().types()
 
             if len(categories) == 0:
                 abort(404)
@@ -122,11 +468,15 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route('/questions', methods=['GET'])
+    @conditional('questions', 'categories')
     def retrieve_questions():
         """An endpoint to handle GET requests '/questions'
 
         Handling GET requests for questions, including pagination
-        (every 10 questions).
+        (every 10 questions). Pages are selected either by "?page=<n>"
+        or by the keyset cursor "?after=<id>". "?fields=" selects the
+        question fields and drops "categories" unless
+        "?include=categories" is given.
 
         Return
             a json object with
@@ -134,30 +484,58 @@ def create_app(test_config=None):
                 "total_questions": the number of total questions
                 "current_category": None
                 "categories": a list of all categories' type
+                "next_cursor": the cursor for the next page, or None
 
         Raises:
+            400: Bad request if a field is unknown.
             404: Resource is not found if there is no such a question.
         """
-        all_questions = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, all_questions)
-        if len(current_questions) == 0:
+        fields, include_categories = list_projection(
+            request, categories_by_default=True)
+        page = question_page('questions', ('questions',), Question.query,
+                             fields=fields)
+        if page is None:
             abort(404)
 
-        categories = set()
-        for question in current_questions:
-            # categories.add(Category.query.get(question['category']).type)
-            categories.add(question['category'])
-
-        categories = Category.query.order_by(Category.id).all()
-        categories = [category.type for category in categories]
-
-        return jsonify({
+        payload = {
             'success': True,
-            'questions': current_questions,
-            'categories': categories,
             'current_category': None,
-            'total_questions': len(all_questions)
-        })
+            'total_questions': total_questions(),
+            **page,
+        }
+        if include_categories:
+            payload['categories'] = current_categories().types()
+        return json_response(json_backend, payload)
+
+    @app.route('/questions/export', methods=['GET'])
+    def export_questions():
+        """An endpoint to handle GET requests '/questions/export'
+
+        Stream all questions ordered by id as NDJSON ("?format=ndjson",
+        the default) or CSV ("?format=csv"). Questions can be filtered
+        by "?category=<id>" and "?difficulty=<n>".
+
+        Return:
+            NDJSON or CSV of all selected questions
+
+        Raises:
+            400: Bad request if the format is unknown.
+        """
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in MIMETYPES:
+            abort(400)
+
+        rows = export_rows(
+            category=request.args.get('category', None, type=int),
+            difficulty=request.args.get('difficulty', None, type=int))
+
+        return Response(
+            stream_with_context(generate_export(rows, export_format)),
+            mimetype=MIMETYPES[export_format],
+            headers={
+                'Content-Disposition':
+                    f'attachment; filename=questions.{export_format}',
+            })
 
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
@@ -186,20 +564,115 @@ def create_app(test_config=None):
                 abort(404)
 
             question.delete()
-            all_questions = Question.query.order_by(Question.id).all()
+            total_questions = QuestionCount.total()
 
-            if len(all_questions) == 0:
+            if total_questions == 0:
                 abort(404)
 
             return jsonify({
                 'success': True,
                 'deleted': question_id,
-                'total_questions': len(all_questions),
+                'total_questions': total_questions,
             })
 
         except Exception:
             abort(422)
 
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions():
+        """An endpoint to handle DELETE requests '/questions'
+
+        Delete the questions of "ids" in the body with a single
+        statement in one transaction, e.g. {"ids": [1, 2, 3]}.
+
+        return:
+            A json object with
+                "deleted": ids of deleted questions
+                "total_questions": number of questions after deletion
+                "categories": A dictionary of category id: the number
+                    of questions after deletion
+                "difficulties": A dictionary of difficulty: the number
+                    of questions after deletion
+
+        Raises:
+            404: Resource is not found if none of the questions exist.
+            422: Unprocessable request.
+        """
+        ids = batch_question_ids(request.get_json(silent=True))
+        if ids is None:
+            abort(422)
+
+        try:
+            deleted = Question.delete_many(ids)
+        except Exception:
+            abort(422)
+
+        if not deleted:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'deleted': [question['id'] for question in deleted],
+            'total_questions': QuestionCount.total(),
+            'categories': QuestionCount.by_category(),
+            'difficulties': QuestionCount.by_difficulty(),
+        })
+
+    @app.route('/questions', methods=['PATCH'])
+    def update_questions():
+        """An endpoint to handle PATCH requests '/questions'
+
+        Set "difficulty" and/or "category" of the questions of "ids" in
+        the body with a single statement in one transaction, e.g.
+        {"ids": [1, 2, 3], "difficulty": 2}.
+
+        return:
+            A json object with
+                "updated": ids of updated questions
+                "total_questions": number of total questions
+                "categories": A dictionary of category id: the number
+                    of questions after the update
+                "difficulties": A dictionary of difficulty: the number
+                    of questions after the update
+
+        Raises:
+            404: Resource is not found if none of the questions exist.
+            422: Unprocessable request.
+        """
+        body = request.get_json(silent=True)
+        ids = batch_question_ids(body)
+        if ids is None:
+            abort(422)
+
+        values = {}
+        if 'category' in body:
+            if current_categories().get(body['category']) is None:
+                abort(422)
+            values['category'] = int(body['category'])
+        if 'difficulty' in body:
+            try:
+                values['difficulty'] = int(body['difficulty'])
+            except (TypeError, ValueError):
+                abort(422)
+        if not values:
+            abort(422)
+
+        try:
+            updated = Question.update_many(ids, values)
+        except Exception:
+            abort(422)
+
+        if not updated:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'updated': [question['id'] for question in updated],
+            'total_questions': QuestionCount.total(),
+            'categories': QuestionCount.by_category(),
+            'difficulties': QuestionCount.by_difficulty(),
+        })
+
     @app.route('/questions', methods=['POST'])
     def add_a_new_question():
         """An endpoint to handle POST requests '/questions'
@@ -220,71 +693,128 @@ def create_app(test_config=None):
         try:
             body = request.get_json()
             category_id = body.get('category', None)
+            category_type = current_categories().get(category_id)
+            if category_type is None:
+                abort(422)
+
             new_question = Question(
                 question=body.get('question', None),
                 answer=body.get('answer', None),
-                category=category_id,
+                category=int(category_id),
                 difficulty=body.get('difficulty', None)
             )
             new_question.insert()
 
-            all_questions = Question.query.order_by(Question.id).all()
-            category_type = Category.query.get(category_id).type
-
             return jsonify({
                 'success': True,
                 'created': new_question.id,
                 'current_category': category_type,
-                'total_questions': len(all_questions),
+                'total_questions': QuestionCount.total(),
             })
 
         except Exception:
             abort(422)
 
+    @app.route('/questions/bulk', methods=['POST'])
+    def import_questions_in_bulk():
+        """An endpoint to handle POST requests '/questions/bulk'
+
+        Import questions from a streamed body, either NDJSON
+        (application/x-ndjson) with an object per line, or CSV
+        (text/csv) with a header row. Each row requires question,
+        answer, category and difficulty. Rows are inserted in batches,
+        and invalid rows are reported without aborting their batch.
+
+        Return:
+            A json object with
+                "inserted": The number of inserted questions
+                "failed": The number of rows which are not inserted
+                "errors": Line numbers and messages of failed rows
+                "total_questions": The number of total questions
+
+        Raises:
+            400: Bad request if the body is neither NDJSON nor CSV.
+        """
+        content_type = request.mimetype
+        if content_type not in ('application/x-ndjson', 'text/csv'):
+            abort(400)
+
+        # rows are validated against the categories of the request
+        current_categories()
+        report = import_questions(request.stream, content_type)
+
+        return jsonify({
+            'success': True,
+            'inserted': report.inserted,
+            'failed': report.failed,
+            'errors': report.errors,
+            'total_questions': QuestionCount.total(),
+        })
+
     @app.route('/search_questions', methods=['POST'])
     def retrieve_questions_by_search():
         """An endpoint to handle POST requests '/search_questions'
 
         Get questions based on a search term. It should return any
-        questions for whom the search term is a substring of the
-        question.
+        questions whose question or answer text matches the search term,
+        ranked by relevance and paginated by "?page=<n>".
 
         Return:
             A json object with
                 "questions": A list of paginated questions
                 "current_category": None
                 "total_questions": The number of total questions
+                "total_results": The number of matched questions
 
         Raises:
+            400: Bad request if a field is unknown.
             404: Resource is not found if there is no such a question.
             422: Unprocessable request.
         """
+        fields, include_categories = list_projection(request)
         try:
             body = request.get_json()
             search_term = body['searchTerm']
-            questions_by_category = Question.query.filter(Question.question.ilike(
-                f'%{search_term}%')).order_by(Question.id).all()
-            current_questions = paginate_questions(
-                request, questions_by_category)
-
-            if len(current_questions) == 0:
+            page = request.args.get('page', 1, type=int)
+            if page < 1:
                 abort(404)
 
-            categories = set()
-            for question in current_questions:
-                categories.add(Category.query.get(question['category']).type)
+            def build():
+                current_questions, total_results = search_backend.search(
+                    search_term,
+                    (page - 1) * QUESTIONS_PER_PAGE,
+                    QUESTIONS_PER_PAGE,
+                    fields)
+                if len(current_questions) == 0:
+                    return None
+                return {
+                    'questions': json_backend.rows(
+                        current_questions, fields).json,
+                    'total_results': json_backend.encode(total_results),
+                }
+
+            results = response_cache.cached(
+                f'search?page={page}&fields={",".join(fields)}'
+                f'&term={search_term}', ('search',), build,
+                questions_version())
+            if results is None:
+                abort(404)
 
-            return jsonify({
+            payload = {
                 'success': True,
-                'questions': current_questions,
                 'current_category': None,
-                'total_questions': len(Question.query.all())
-            })
+                'total_questions': total_questions(),
+                **results,
+            }
+            if include_categories:
+                payload['categories'] = current_categories().types()
+            return json_response(json_backend, payload)
 
         except Exception:
             abort(422)
 
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    @conditional('questions', 'categories', Question.category_version_name)
     def retrieve_questions_by_category(category_id):
         """An endpoint to handle GET requests
             '/categories/<int:category_id>/questions'
@@ -303,25 +833,139 @@ def create_app(test_config=None):
                 "total_questions": The number of total questions
 
         Raises:
-            404: Resource is not found if there is no such a question.
+            400: Bad request if a field is unknown.
+            404: Resource is not found if there is no such a category
+                or question.
             422: Unprocessable request.
         """
+        fields, include_categories = list_projection(request)
+        current_category = current_categories().get(category_id)
+        if current_category is None:
+            abort(404)
+
         try:
             questions_by_category = Question.query.filter(
-                Question.category == str(category_id)).order_by(Question.id).all()
-            current_questions = paginate_questions(
-                request, questions_by_category)
+                Question.category == category_id)
+            tag = f'category:{category_id}'
+            page = question_page(tag, (tag,), questions_by_category,
+                                 category_id, fields)
 
-            if len(current_questions) == 0:
+            if page is None:
                 abort(404)
 
-            current_category = Category.query.get(category_id).type
-
-            return jsonify({
+            payload = {
                 'success': True,
-                'questions': current_questions,
                 'current_category': current_category,
-                'total_questions': len(Question.query.all())
+                'total_questions': total_questions(),
+                **page,
+            }
+            if include_categories:
+                payload['categories'] = current_categories().types()
+            return json_response(json_backend, payload)
+
+        except Exception:
+            abort(422)
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def create_quiz_session():
+        """An endpoint to handle POST requests '/quizzes/sessions'
+
+        Start a quiz session. The server keeps a shuffled sequence of
+        up to QUIZ_SESSION_MAX_QUESTIONS questions in the given
+        category, and "/quizzes" takes the next one of them with the
+        returned session id.
+
+        Return:
+            A json object with
+                "session_id": The id of the quiz session
+                "total_questions": The number of questions in the quiz
+                "current_category": Currently selected category
+
+        Raises:
+            422: Unprocessable request.
+        """
+        try:
+            body = request.get_json()
+            quiz_category = body.get('quiz_category', None)
+            question_ids = quiz_ids(quiz_category)
+            session_id, total = quiz_sessions.create(
+                quiz_category, question_ids)
+
+            return jsonify({
+                "success": True,
+                "session_id": session_id,
+                "total_questions": total,
+                "current_category": quiz_category['type'],
+            })
+
+        except Exception:
+            abort(422)
+
+    @app.route('/quizzes/deck', methods=['POST'])
+    def create_quiz_deck():
+        """An endpoint to handle POST requests '/quizzes/deck'
+
+        Draw a deck of "count" (QUESTIONS_PER_PLAY by default) distinct
+        random questions within the given category, if provided, and
+        not in "previous_questions", in a single request. With
+        "stratify": true, the deck is spread evenly over difficulties.
+
+        Return:
+            A json object with
+                "questions": The questions of the deck in random order.
+                    There are fewer than "count" if the category runs
+                    out of questions.
+                "total_questions": The number of questions in the
+                    category
+                "current_category": Currently selected category
+
+        Raises:
+            404: Resource is not found if there is no such a category.
+            422: Unprocessable request.
+        """
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            abort(422)
+        quiz_category = body.get('quiz_category', None)
+        try:
+            category_id = int(quiz_category['id'])
+            count = int(body.get('count', QUESTIONS_PER_PLAY))
+        except (KeyError, TypeError, ValueError):
+            abort(422)
+        if not 0 < count <= MAX_DECK_SIZE:
+            abort(422)
+        # both versions in one query
+        version = table_versions(
+            Category.__tablename__, Question.__tablename__
+        )[Question.__tablename__]
+        if category_id != 0 and current_categories().get(category_id) is None:
+            abort(404)
+
+        try:
+            deck, total_questions = quiz_decks.sample(
+                category_id, count,
+                body.get('previous_questions', None) or (),
+                stratify=bool(body.get('stratify', False)), version=version)
+
+            model = serving_read_model()
+            if model is not None:
+                rows = model.rows(deck)
+            else:
+                questions = {}
+                if deck:
+                    questions = {
+                        row[0]: row for row in
+                        Question.query.with_entities(*QUESTION_COLUMNS)
+                        .filter(Question.id.in_(deck))
+                    }
+                rows = [questions[question_id] for question_id in deck
+                        if question_id in questions]
+
+            return json_response(json_backend, {
+                "success": True,
+                "questions": json_backend.rows(rows),
+                "total_questions": total_questions,
+                "current_category": quiz_category['type'],
             })
 
         except Exception:
@@ -336,49 +980,219 @@ def create_app(test_config=None):
         questions within the given category, if provided, and that is
         not one of the previous questions.
 
+        If "session_id" of a quiz session is given instead, the next
+        question of the session is returned, and "question" is None
+        once all questions of the session are asked, until the session
+        expires.
+
         Return:
             A json object with
                 "question": A random questions within in the given category
                 "current_category": Currently selected category
 
         Raises:
-            404: Resource is not found if there is no such a question.
+            404: Resource is not found if there is no such a question
+                or quiz session.
             422: Unprocessable request.
         """
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            abort(422)
+        session_id = body.get('session_id', None)
+        if session_id is not None:
+            if not isinstance(session_id, str):
+                abort(422)
+            session = quiz_sessions.get(session_id)
+            if session is None:
+                abort(404)
+
+            question = None
+            while question is None:
+                try:
+                    question_id = quiz_sessions.pop(session_id)
+                except KeyError:
+                    # evicted or expired since it was found
+                    abort(404)
+                if question_id is None:
+                    break
+                question = find_question_row(question_id)
+
+            return json_response(json_backend, {
+                "success": True,
+                "question": question and json_backend.row(question),
+                "current_category": session.category['type'],
+            })
+
         try:
-            body = request.get_json()
             previous_questions = body.get('previous_questions', None)
             quiz_category = body.get('quiz_category', None)
 
             # quiz_category 0 means 'all' categories
             # If so, questions can be selected from all categories.
             # Otherwise, select questions only from the selected category
-            if quiz_category['id'] == 0:
-                questions_for_quiz = Question.query.filter(
-                    Question.id.notin_(previous_questions)
-                ).all()
-            else:
-                questions_for_quiz = Question.query.filter(
-                    Question.category == quiz_category['id'],
-                    Question.id.notin_(previous_questions)
-                ).all()
-
-            questions_for_quiz = [
-                question.format() for question in questions_for_quiz]
-            if len(questions_for_quiz) == 0:
+            question_ids = quiz_ids(quiz_category, previous_questions)
+            if len(question_ids) == 0:
                 abort(404)
 
-            question = random.choice(questions_for_quiz)
+            question = find_question_row(random.choice(question_ids))
 
-            return jsonify({
+            return json_response(json_backend, {
                 "success": True,
-                "question": question,
+                "question": json_backend.row(question),
                 "current_category": quiz_category['type']
             })
 
         except Exception:
             abort(422)
 
+    @app.route('/quizzes/events', methods=['POST'])
+    def create_quiz_events():
+        """An endpoint to handle POST requests '/quizzes/events'
+
+        Record answered quiz questions. The events are queued and
+        written in batches in the background, so they are counted by
+        "/quizzes/stats" shortly after.
+
+        Return:
+            A json object with
+                "accepted": The number of queued events
+
+        Raises:
+            422: Unprocessable request if "events" is not a list of
+                up to MAX_QUIZ_EVENTS objects with an integer
+                "question_id" and a boolean "correct".
+            503: Service unavailable if the queue is full.
+        """
+        body = request.get_json(silent=True) or {}
+        events = body.get('events', None) if isinstance(body, dict) \
+            else None
+        if not isinstance(events, list) \
+                or not 0 < len(events) <= MAX_QUIZ_EVENTS:
+            abort(422)
+        created_at = datetime.utcnow()
+        try:
+            events = [{
+                'question_id': event['question_id'],
+                'correct': event['correct'],
+                'created_at': created_at,
+            } for event in events]
+        except (KeyError, TypeError):
+            abort(422)
+        if not all(type(event['question_id']) is int
+                   and type(event['correct']) is bool for event in events):
+            abort(422)
+
+        if not quiz_events.enqueue(events):
+            abort(503)
+
+        return jsonify({
+            'success': True,
+            'accepted': len(events),
+        }), 202
+
+    @app.route('/quizzes/stats', methods=['GET'])
+    def retrieve_quiz_stats():
+        """An endpoint to handle GET requests '/quizzes/stats'
+
+        Report the correct rate of each answered question, within
+        "?category=<id>" if it is given.
+
+        Return:
+            A json object with
+                "questions": A list of "id", "answers", "correct" and
+                    "correct_rate" of the answered questions, ordered
+                    by id
+        """
+        category = request.args.get('category', None, type=int)
+        rates = QuizEvent.correct_rates(category)
+        return jsonify({
+            'success': True,
+            'questions': [{
+                'id': question_id,
+                'answers': answers,
+                'correct': correct,
+                'correct_rate': correct / answers,
+            } for question_id, (answers, correct) in rates.items()],
+        })
+
+    @app.route('/stats', methods=['GET'])
+    def retrieve_stats():
+        """An endpoint to handle GET requests '/stats'
+
+        Report the number of questions in total, per category and per
+        difficulty. The numbers are read from the aggregated counts.
+
+        Return:
+            A json object with
+                "total_questions": The number of total questions
+                "categories": A dictionary of category id: the number
+                    of questions
+                "difficulties": A dictionary of difficulty: the number
+                    of questions
+        """
+        return jsonify({
+            'success': True,
+            'total_questions': QuestionCount.total(),
+            'categories': QuestionCount.by_category(),
+            'difficulties': QuestionCount.by_difficulty(),
+        })
+
+    @app.route('/metrics', methods=['GET'])
+    def retrieve_metrics():
+        """An endpoint to handle GET requests '/metrics'
+
+        Report request and database metrics, such as the number of
+        queries and the time spent in the database per endpoint, in the
+        Prometheus text format.
+
+        Return:
+            text: metrics in the Prometheus text format
+        """
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    if profiler is not None:
+        def authorize_profiler():
+            """Abort unless the request carries the profiling token"""
+            if not profiler.is_privileged(
+                    request.headers.get(PROFILE_HEADER)):
+                abort(403)
+
+        @app.route('/admin/profiles', methods=['GET'])
+        def retrieve_profiles():
+            """An endpoint to handle GET requests '/admin/profiles'
+
+            List the slowest profiled requests kept in memory. Only
+            registered when the profiler is enabled, and only served
+            with the profiling token in the X-Profile header.
+
+            Return:
+                A json object with
+                    "profiles": A list of profiled requests, the
+                        slowest first
+            """
+            authorize_profiler()
+            return jsonify({
+                'success': True,
+                'profiles': [profile.format()
+                             for profile in profiler.slowest()],
+            })
+
+        @app.route('/admin/profiles/<int:profile_id>', methods=['GET'])
+        def retrieve_profile(profile_id):
+            """An endpoint to handle GET requests
+            '/admin/profiles/<int:profile_id>'
+
+            Return:
+                text: the functions of the profile with the most
+                    cumulative time, as printed by pstats
+            """
+            authorize_profiler()
+            profile = profiler.get(profile_id)
+            if profile is None:
+                abort(404)
+            return Response(profile.stats, mimetype='text/plain')
+
     ######################################################################
     # Error Handlers
     ######################################################################
@@ -393,6 +1207,16 @@ def create_app(test_config=None):
             "message": "Bad request.",
         }), 400
 
+    @app.errorhandler(403)
+    def forbidden(error):
+        """Error handler 403, Forbidden"""
+
+        return jsonify({
+            "success": False,
+            "error": 403,
+            "message": "Forbidden.",
+        }), 403
+
     @app.errorhandler(404)
     def page_not_found(error):
         """Error handler 404, Resource is not found"""
@@ -423,4 +1247,23 @@ def create_app(test_config=None):
             "message": "Unprocessable.",
         }), 422
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        """Error handler 503, Service unavailable
+
+        The Retry-After set on g by the admission control, if any, is
+        sent along.
+        """
+
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service unavailable.",
+        })
+        retry_after = g.get('retry_after')
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response, 503
+
+    startup.create_app_seconds = time.perf_counter() - started_at
     return app
@@ -0,0 +1,220 @@
+"""Admission control
+
+Bounds the number of requests served at once, so that a slow database
+makes requests wait, and then fail fast, instead of piling up until
+everything times out.
+
+- ADMISSION_MAX_CONCURRENCY requests are served at once, in total.
+- ADMISSION_ROUTE_LIMITS bounds endpoints on their own, e.g.
+  {'import_questions_in_bulk': 1}.
+- Requests beyond the limits wait in a queue of ADMISSION_MAX_QUEUE
+  requests for ADMISSION_QUEUE_TIMEOUT seconds. Requests which find the
+  queue full, or run out of time in it, get 503 with a Retry-After of
+  ADMISSION_RETRY_AFTER seconds.
+- Waiting requests are admitted by priority: quiz gameplay first, then
+  reads, then admin writes such as "POST /questions".
+  ADMISSION_PRIORITIES overrides the priority of endpoints.
+
+The controller is only installed when ADMISSION_MAX_CONCURRENCY is set.
+"""
+import bisect
+import itertools
+import threading
+from collections import defaultdict
+
+from flask import abort, g, request
+
+GAMEPLAY = 0
+READ = 1
+WRITE = 2
+
+PRIORITIES = {
+    'create_quiz_deck': GAMEPLAY,
+    'create_quiz_events': GAMEPLAY,
+    'create_quiz_session': GAMEPLAY,
+    'retrieve_questions_for_quiz': GAMEPLAY,
+    'add_a_new_question': WRITE,
+    'delete_question': WRITE,
+    'delete_questions': WRITE,
+    'import_questions_in_bulk': WRITE,
+    'update_questions': WRITE,
+}
+
+# endpoints which are always served, to watch an overloaded app
+EXEMPT_ENDPOINTS = {
+    'retrieve_metrics',
+    'retrieve_profile',
+    'retrieve_profiles',
+}
+
+ADMISSION_MAX_QUEUE = 100
+ADMISSION_QUEUE_TIMEOUT = 1.0
+ADMISSION_RETRY_AFTER = 1
+
+
+class _Waiter:
+    """A request waiting for admission"""
+
+    __slots__ = ('priority', 'sequence', 'route', 'admitted')
+
+    def __init__(self, priority, sequence, route):
+        self.priority = priority
+        self.sequence = sequence
+        self.route = route
+        self.admitted = threading.Event()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < \
+            (other.priority, other.sequence)
+
+
+class AdmissionController:
+    """Concurrency limits with a bounded priority queue
+
+    Args:
+        max_concurrency (int): The number of requests served at once
+        route_limits (dict): route: the number of its requests served
+            at once
+        max_queue (int): The number of waiting requests
+        queue_timeout (float): Seconds a request waits at most
+    """
+
+    def __init__(self, max_concurrency, route_limits=None,
+                 max_queue=ADMISSION_MAX_QUEUE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.route_limits = dict(route_limits or {})
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.route_active = defaultdict(int)
+        self.admitted = defaultdict(int)
+        self.rejected = defaultdict(int)
+        # waiters ordered by (priority, arrival)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def _has_room(self, route):
+        limit = self.route_limits.get(route)
+        return self.active < self.max_concurrency \
+            and (limit is None or self.route_active[route] < limit)
+
+    def _admit(self, route):
+        self.active += 1
+        self.route_active[route] += 1
+        self.admitted[route] += 1
+
+    def _dispatch(self):
+        # admit waiters by priority, skipping those whose route is full
+        for waiter in list(self._waiters):
+            if self.active >= self.max_concurrency:
+                break
+            if self._has_room(waiter.route):
+                self._waiters.remove(waiter)
+                self._admit(waiter.route)
+                waiter.admitted.set()
+
+    def acquire(self, route, priority=READ):
+        """Admit a request of route, waiting for room if necessary
+
+        Returns:
+            bool: False if the request is rejected
+        """
+        with self._lock:
+            if self._has_room(route) and not any(
+                    waiter.priority <= priority for waiter in self._waiters):
+                self._admit(route)
+                return True
+            if len(self._waiters) >= self.max_queue:
+                self.rejected[(route, 'queue_full')] += 1
+                return False
+            waiter = _Waiter(priority, next(self._sequence), route)
+            bisect.insort(self._waiters, waiter)
+            self._dispatch()
+
+        if waiter.admitted.wait(self.queue_timeout):
+            return True
+        with self._lock:
+            if waiter.admitted.is_set():
+                return True
+            self._waiters.remove(waiter)
+            self.rejected[(route, 'timeout')] += 1
+            return False
+
+    def release(self, route):
+        """Free the room of an admitted request of route"""
+        with self._lock:
+            self.active -= 1
+            self.route_active[route] -= 1
+            self._dispatch()
+
+    def collect(self):
+        """Lines of the admission metrics in the Prometheus text format"""
+        with self._lock:
+            waiting = defaultdict(int)
+            for waiter in self._waiters:
+                waiting[waiter.route] += 1
+            lines = [
+                '# TYPE trivia_admission_active gauge',
+                f'trivia_admission_active {self.active}',
+                '# TYPE trivia_admission_waiting gauge',
+                f'trivia_admission_waiting {len(self._waiters)}',
+            ]
+            for name, values in (
+                    ('trivia_admission_route_active', self.route_active),
+                    ('trivia_admission_route_waiting', waiting),
+                    ('trivia_admission_admitted_total', self.admitted)):
+                kind = 'counter' if name.endswith('_total') else 'gauge'
+                lines.append(f'# TYPE {name} {kind}')
+                for route, value in sorted(values.items()):
+                    lines.append(f'{name}{{endpoint="{route}"}} {value}')
+            lines.append('# TYPE trivia_admission_rejected_total counter')
+            for (route, reason), value in sorted(self.rejected.items()):
+                lines.append(
+                    f'trivia_admission_rejected_total{{endpoint="{route}",'
+                    f'reason="{reason}"}} {value}')
+        return lines
+
+
+def init_admission(app):
+    """Admit the requests of app through an AdmissionController
+    configured by ADMISSION_MAX_CONCURRENCY
+
+    Returns:
+        AdmissionController: the controller, or None if it isn't enabled
+    """
+    max_concurrency = app.config.get('ADMISSION_MAX_CONCURRENCY')
+    if max_concurrency is None:
+        return None
+    controller = AdmissionController(
+        max_concurrency,
+        route_limits=app.config.get('ADMISSION_ROUTE_LIMITS'),
+        max_queue=app.config.get('ADMISSION_MAX_QUEUE', ADMISSION_MAX_QUEUE),
+        queue_timeout=app.config.get(
+            'ADMISSION_QUEUE_TIMEOUT', ADMISSION_QUEUE_TIMEOUT),
+    )
+    priorities = dict(PRIORITIES, **app.config.get('ADMISSION_PRIORITIES', {}))
+    retry_after = app.config.get(
+        'ADMISSION_RETRY_AFTER', ADMISSION_RETRY_AFTER)
+
+    @app.before_request
+    def admit_request():
+        route = request.endpoint
+        if route is None or route in EXEMPT_ENDPOINTS \
+                or request.method == 'OPTIONS':
+            return
+        if not controller.acquire(route, priorities.get(route, READ)):
+            # abort() takes no Retry-After before Werkzeug 1.0, so the
+            # 503 handler reads it from g
+            g.retry_after = retry_after
+            abort(503)
+        g.admitted_route = route
+
+    @app.teardown_request
+    def release_request(error=None):
+        route = g.pop('admitted_route', None)
+        if route is not None:
+            controller.release(route)
+
+    return controller
@@ -0,0 +1,332 @@
+"""ASGI serving mode
+
+create_asgi_app builds the same app as create_app, with the same routes
+and error handlers, and serves it over ASGI, e.g.
+
+    $ uvicorn --factory flaskr.asgi:create_asgi_app
+
+The event loop owns the connections, so thousands of slow clients only
+cost a coroutine each. Request bodies are spooled while they arrive,
+and the views run in a bounded pool of worker threads, a thread per
+connection of the database pool (DATABASE_POOL_SIZE plus
+DATABASE_MAX_OVERFLOW) unless ASGI_WORKER_THREADS is set, because the
+database sessions of the models are synchronous. A request whose
+client disconnects before the end of its body isn't run at all.
+"""
+import asyncio
+import sys
+import tempfile
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+
+from flask.testing import EnvironBuilder
+
+from . import create_app
+
+ASGI_WORKER_THREADS = 32
+# the pool defaults of SQLAlchemy
+DATABASE_POOL_SIZE = 5
+DATABASE_MAX_OVERFLOW = 10
+MAX_BUFFERED_CHUNKS = 16
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class AsgiApp:
+    """An ASGI app running a WSGI app in worker threads
+
+    Args:
+        app (obj): a Flask app
+        executor (obj): The executor running the WSGI app. A thread pool
+            of max_workers threads is created if it is not given.
+        max_workers (int): The number of worker threads
+        max_buffered_chunks (int): The number of response chunks a
+            worker produces ahead of the client. None is unbounded.
+    """
+
+    def __init__(self, app, executor=None, max_workers=ASGI_WORKER_THREADS,
+                 max_buffered_chunks=MAX_BUFFERED_CHUNKS):
+        self.app = app
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers, thread_name_prefix='trivia-asgi')
+        self.max_buffered_chunks = max_buffered_chunks
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope: {scope["type"]}')
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    # the body is truncated: the request, a bulk import
+                    # for example, mustn't run
+                    return
+                body.write(message.get('body', b''))
+                more_body = message.get('more_body', False)
+            body.seek(0)
+            await self._respond(scope, body, send)
+        finally:
+            body.close()
+
+    async def _respond(self, scope, body, send):
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        credits = None
+        if self.max_buffered_chunks is not None:
+            credits = threading.Semaphore(self.max_buffered_chunks)
+        cancelled = threading.Event()
+
+        def put(message):
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+
+        def start_response(status, headers, exc_info=None):
+            put({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [
+                    (name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in headers
+                ],
+            })
+
+        # The whole response is produced in one worker thread, because
+        # the request context of streamed responses is bound to it.
+        def run():
+            try:
+                result = self.app(build_environ(scope, body), start_response)
+                try:
+                    for chunk in result:
+                        if cancelled.is_set():
+                            break
+                        if chunk:
+                            if credits is not None:
+                                credits.acquire()
+                            put({'type': 'http.response.body',
+                                 'body': chunk, 'more_body': True})
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            finally:
+                put(None)
+
+        worker = loop.run_in_executor(self.executor, run)
+        try:
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                await send(message)
+                if credits is not None \
+                        and message['type'] == 'http.response.body':
+                    credits.release()
+        except BaseException:
+            # the client is gone: stop the worker, which may be waiting
+            # for a credit
+            cancelled.set()
+            if credits is not None:
+                credits.release()
+            raise
+        await worker
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def test_client(self):
+        """A client with the interface of the Flask test client"""
+        return AsgiTestClient(self)
+
+
+def build_environ(scope, body):
+    """Build a WSGI environ of an ASGI http scope
+
+    The body is spooled completely before, so its length is the
+    Content-Length of the environ, also for chunked requests which
+    don't send one.
+
+    Args:
+        scope (dict): The ASGI http scope
+        body (obj): A seekable file-like request body
+
+    Returns:
+        dict: the WSGI environ
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.input_terminated': True,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        if name in environ:
+            value = f'{environ[name]},{value}'
+        environ[name] = value
+
+    position = body.tell()
+    body.seek(0, 2)
+    environ['CONTENT_LENGTH'] = str(body.tell() - position)
+    body.seek(position)
+    return environ
+
+
+class InlineExecutor(Executor):
+    """An executor running calls in the calling thread"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+        return future
+
+
+class AsgiTestClient:
+    """A test client sending requests through the ASGI interface
+
+    It accepts the arguments of the Flask test client and returns
+    response objects of the Flask app, so the same tests can run against
+    the WSGI and the ASGI app. Views run in the calling thread, so that
+    query assertions of the tests see them.
+    """
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app.app
+        self.asgi_app = AsgiApp(self.app, executor=InlineExecutor(),
+                                max_buffered_chunks=None)
+
+    def open(self, path='/', method='GET', **kwargs):
+        builder = EnvironBuilder(self.app, path=path, method=method,
+                                 **kwargs)
+        try:
+            environ = builder.get_environ()
+            body = environ['wsgi.input'].read()
+        finally:
+            builder.close()
+
+        headers = []
+        for name, value in environ.items():
+            if name in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                continue
+            if name.startswith('HTTP_'):
+                name = name[5:]
+            elif name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                continue
+            headers.append((name.replace('_', '-').lower().encode('latin1'),
+                            value.encode('latin1')))
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': environ['wsgi.url_scheme'],
+            'path': environ['PATH_INFO'].encode('latin1').decode(),
+            'query_string': environ['QUERY_STRING'].encode('latin1'),
+            'root_path': '',
+            'headers': headers,
+            'server': (environ['SERVER_NAME'], int(environ['SERVER_PORT'])),
+        }
+        return asyncio.run(self._request(scope, body))
+
+    async def _request(self, scope, body):
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await self.asgi_app(scope, receive, send)
+        start = sent[0]
+        return self.app.response_class(
+            b''.join(message.get('body', b'') for message in sent[1:]),
+            status=start['status'],
+            headers=[(name.decode('latin1'), value.decode('latin1'))
+                     for name, value in start['headers']],
+        )
+
+    def get(self, *args, **kwargs):
+        return self.open(*args, method='GET', **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.open(*args, method='POST', **kwargs)
+
+    def patch(self, *args, **kwargs):
+        return self.open(*args, method='PATCH', **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self.open(*args, method='PUT', **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.open(*args, method='DELETE', **kwargs)
+
+
+def worker_threads(config):
+    """The number of worker threads of an app config
+
+    ASGI_WORKER_THREADS if it is set, and otherwise the number of
+    connections of the database pool, so that views don't time out
+    waiting for a connection. ASGI_WORKER_THREADS is the default of
+    pools without a limit.
+    """
+    threads = config.get('ASGI_WORKER_THREADS')
+    if threads is not None:
+        return threads
+    pool_size = config.get('DATABASE_POOL_SIZE')
+    max_overflow = config.get('DATABASE_MAX_OVERFLOW')
+    if pool_size is None:
+        pool_size = DATABASE_POOL_SIZE
+    if max_overflow is None:
+        max_overflow = DATABASE_MAX_OVERFLOW
+    if max_overflow < 0:
+        return ASGI_WORKER_THREADS
+    return pool_size + max_overflow
+
+
+def create_asgi_app(test_config=None):
+    """create an ASGI Application of 'trivia_app'
+
+    Args:
+        test_config (dict): config passed to create_app. Its
+            ASGI_WORKER_THREADS sets the number of worker threads,
+            which is the size of the database pool by default.
+
+    Returns:
+        AsgiApp: an ASGI app serving the "Trivia API"
+    """
+    app = create_app(test_config)
+    return AsgiApp(app, max_workers=worker_threads(app.config))
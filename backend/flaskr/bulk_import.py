@@ -0,0 +1,188 @@
+"""Bulk import of questions
+
+Questions are read from a streamed NDJSON or CSV body one row at a time,
+validated and inserted in batches. Each batch is inserted with a single
+executemany, or COPY on Postgres, and committed in its own transaction
+together with the aggregated question counts and the table version.
+Rows failing validation are reported and skipped without aborting their
+batch, so memory use is bounded by the batch size regardless of the
+upload size.
+"""
+import csv
+import io
+import json
+from collections import Counter
+
+from models import db, Question, QuestionCount, \
+    category_cache, notify_question_change
+
+BULK_BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 100
+COLUMNS = ('question', 'answer', 'category', 'difficulty')
+
+
+class ImportReport:
+    """The result of a bulk import
+
+    Attributes:
+        inserted (int): The number of inserted questions
+        failed (int): The number of rows which are not inserted
+        errors (list): Errors of the first MAX_REPORTED_ERRORS rows
+    """
+
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'message': message})
+
+
+def _decode(stream, invalid):
+    # decode line by line, so that a line of invalid UTF-8 is reported
+    # instead of failing the import
+    for line_number, line in enumerate(stream, 1):
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError as error:
+            invalid[line_number] = ValueError(f'Invalid UTF-8: {error}')
+            yield line.decode('utf-8', 'replace')
+
+
+def read_rows(stream, content_type):
+    """Read rows from a streamed body
+
+    Args:
+        stream (obj): a binary file-like body
+        content_type (str): 'text/csv' for CSV with a header row.
+            Otherwise, the body is read as NDJSON.
+
+    Yields:
+        tuple: the line number and the row, or a ValueError if the line
+            can't be decoded or parsed
+    """
+    invalid = {}
+    text = _decode(stream, invalid)
+    if content_type == 'text/csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            if invalid:
+                # a row may span several lines
+                yield reader.line_num, invalid.popitem()[1]
+                invalid.clear()
+            else:
+                yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(text, 1):
+        if line_number in invalid:
+            yield line_number, invalid.pop(line_number)
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as error:
+            yield line_number, ValueError(f'Invalid JSON: {error}')
+
+
+def validate(row):
+    """Validate a row and convert it to the column types
+
+    Raises:
+        ValueError: The row isn't a valid question.
+    """
+    if isinstance(row, ValueError):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError('A row must be an object.')
+
+    for column in ('question', 'answer'):
+        if not isinstance(row.get(column), str) or not row[column].strip():
+            raise ValueError(f'"{column}" is required.')
+    if category_cache.get(row.get('category')) is None:
+        raise ValueError(f'Unknown category: {row.get("category")}')
+    try:
+        difficulty = int(row.get('difficulty'))
+    except (TypeError, ValueError):
+        raise ValueError('"difficulty" must be an integer.')
+
+    category, difficulty = QuestionCount.key(row['category'], difficulty)
+    return {
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': category,
+        'difficulty': difficulty,
+    }
+
+
+def _copy(connection, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in COLUMNS])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f'COPY {Question.__tablename__} ({", ".join(COLUMNS)}) '
+        'FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def insert_batch(rows):
+    """Insert validated rows and their counts in one transaction"""
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        _copy(connection, rows)
+    else:
+        db.session.execute(Question.__table__.insert(), rows)
+
+    counts = Counter((row['category'], row['difficulty']) for row in rows)
+    for (category, difficulty), count in counts.items():
+        QuestionCount.adjust(category, difficulty, count)
+    Question.bump_versions(*[category for category, _ in counts])
+    db.session.commit()
+
+
+def import_questions(stream, content_type, batch_size=BULK_BATCH_SIZE):
+    """Import questions from a streamed body
+
+    Args:
+        stream (obj): a binary file-like body
+        content_type (str): 'text/csv' or 'application/x-ndjson'
+        batch_size (int): The number of rows inserted in a transaction
+
+    Returns:
+        ImportReport: the result of the import
+    """
+    report = ImportReport()
+    batch = []
+    lines = []
+
+    def flush():
+        try:
+            insert_batch(batch)
+            report.inserted += len(batch)
+        except Exception as error:
+            db.session.rollback()
+            for line in lines:
+                report.error(line, f'Batch is not inserted: {error}')
+        batch.clear()
+        lines.clear()
+
+    for line, row in read_rows(stream, content_type):
+        try:
+            batch.append(validate(row))
+            lines.append(line)
+        except ValueError as error:
+            report.error(line, str(error))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    if report.inserted:
+        notify_question_change('reload')
+    return report
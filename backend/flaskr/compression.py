@@ -0,0 +1,167 @@
+"""Response compression
+
+JSON and text responses of at least COMPRESSION_MIN_SIZE bytes are
+compressed with the best encoding accepted by the client: brotli, if
+the brotli package is installed, or gzip.
+
+Responses with a strong ETag, such as "/categories" or a page of
+questions, are compressed once per version of their data: the
+compressed bodies are kept in an LRU of COMPRESSION_CACHE_SIZE entries
+keyed by the ETag and a digest of the body, so that a body which changed
+under the same ETag is never answered with the compression of another
+one. Compressed responses get the ETag of their encoding, e.g.
+'<etag>-gzip', which conditional requests accept as well.
+
+Streamed responses, such as exports, are sent as they are.
+"""
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+
+from .conditional import CONTENT_ENCODINGS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = 500
+COMPRESSION_CACHE_SIZE = 256
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+    'text/csv',
+    'text/html',
+    'text/plain',
+}
+
+
+def _gzip(data):
+    # no timestamp, so that the same data compresses to the same bytes
+    return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+def _brotli(data):
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+_COMPRESSORS = {'br': _brotli, 'gzip': _gzip}
+if brotli is None:
+    del _COMPRESSORS['br']
+
+ENCODINGS = OrderedDict(
+    (encoding, _COMPRESSORS[encoding])
+    for encoding in CONTENT_ENCODINGS if encoding in _COMPRESSORS
+)
+
+
+class ResponseCompressor:
+    """Negotiated compression of responses
+
+    Args:
+        min_size (int): The smallest body, in bytes, worth compressing
+        cache_size (int): The number of compressed bodies of ETagged
+            responses kept
+    """
+
+    def __init__(self, min_size=COMPRESSION_MIN_SIZE,
+                 cache_size=COMPRESSION_CACHE_SIZE):
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self.responses = defaultdict(int)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cache_hits = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _compress(self, encoding, data, etag):
+        if etag is None or not self.cache_size:
+            return ENCODINGS[encoding](data)
+        key = (etag, encoding, hashlib.sha1(data).digest())
+        with self._lock:
+            body = self._cache.get(key)
+            if body is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return body
+        body = ENCODINGS[encoding](data)
+        with self._lock:
+            self._cache[key] = body
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return body
+
+    def compress(self, request, response):
+        """Compress response if the request accepts it and it is worth it
+
+        Returns:
+            obj: the response
+        """
+        if response.status_code != 200 or response.is_streamed \
+                or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers \
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(list(ENCODINGS))
+        if encoding is None or response.content_length is None \
+                or response.content_length < self.min_size:
+            return response
+
+        data = response.get_data()
+        etag, weak = response.get_etag()
+        body = self._compress(encoding, data, None if weak else etag)
+        if len(body) >= len(data):
+            return response
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        with self._lock:
+            self.responses[encoding] += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(body)
+        return response
+
+    def collect(self):
+        """Lines of the compression metrics in the Prometheus text format"""
+        lines = ['# TYPE trivia_compressed_responses_total counter']
+        for encoding in ENCODINGS:
+            lines.append(
+                f'trivia_compressed_responses_total{{encoding="{encoding}"}} '
+                f'{self.responses[encoding]}')
+        for name, kind, value in (
+                ('trivia_compression_bytes_in_total', 'counter',
+                 self.bytes_in),
+                ('trivia_compression_bytes_out_total', 'counter',
+                 self.bytes_out),
+                ('trivia_compression_cache_hits_total', 'counter',
+                 self.cache_hits),
+                ('trivia_compression_cache_entries', 'gauge',
+                 len(self._cache))):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return lines
+
+
+def create_compressor(app):
+    """Create the response compressor of app configured by COMPRESSION,
+    COMPRESSION_MIN_SIZE and COMPRESSION_CACHE_SIZE
+
+    Returns:
+        ResponseCompressor: the compressor, or None if COMPRESSION is
+            False
+    """
+    if not app.config.get('COMPRESSION', True):
+        return None
+    return ResponseCompressor(
+        min_size=app.config.get('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE),
+        cache_size=app.config.get(
+            'COMPRESSION_CACHE_SIZE', COMPRESSION_CACHE_SIZE),
+    )
@@ -0,0 +1,95 @@
+"""Conditional GET
+
+Read endpoints emit strong ETags derived from the change versions of the
+tables they read, the path and the query string. Versions of parts of a
+table, such as the questions of a category, are named by functions of
+the view arguments. A request whose
+If-None-Match matches the current ETag gets 304 Not Modified after a
+single query on the table_versions table, without running the view.
+The ETags of compressed responses match too: the compressor sets
+'<etag>-<encoding>' for the CONTENT_ENCODINGS it supports.
+
+The versions are kept for the rest of the request, so that the response
+cache and the read model build the page of the same versions as its
+ETag.
+"""
+import hashlib
+from functools import wraps
+
+from flask import current_app, g, make_response, request
+
+from models import TableVersion
+
+# encodings of compressed representations, in order of preference
+CONTENT_ENCODINGS = ('br', 'gzip')
+
+
+def make_etag(versions):
+    """Make a strong ETag of the current request and table versions
+
+    Args:
+        versions (dict): a dictionary of table name: version
+
+    Returns:
+        str: the ETag
+    """
+    key = '|'.join([request.path, request.query_string.decode()] + [
+        f'{name}={version}' for name, version in sorted(versions.items())
+    ])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def etag_variants(etag):
+    """List the ETags of the representations of a response
+
+    Args:
+        etag (str): The ETag of the uncompressed response
+
+    Returns:
+        list: the ETag and the ETags of its compressed representations
+    """
+    return [etag] + [f'{etag}-{encoding}' for encoding in CONTENT_ENCODINGS]
+
+
+def table_versions(*tables):
+    """Get the versions of tables, read once per request
+
+    Args:
+        tables (str): Names of the tables
+
+    Returns:
+        dict: a dictionary of table name: version
+    """
+    versions = g.setdefault('table_versions', {})
+    missing = [table for table in tables if table not in versions]
+    if missing:
+        versions.update(TableVersion.get(*missing))
+    return {table: versions[table] for table in tables}
+
+
+def conditional(*tables):
+    """Decorate a view to answer conditional GET requests
+
+    Args:
+        tables (str): Names of the tables read by the view, or functions
+            of the view keyword arguments returning a name
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = make_etag(table_versions(*[
+                table(**kwargs) if callable(table) else table
+                for table in tables
+            ]))
+            for variant in etag_variants(etag):
+                if request.if_none_match.contains(variant):
+                    response = current_app.response_class(status=304)
+                    response.set_etag(variant)
+                    return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
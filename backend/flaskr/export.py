@@ -0,0 +1,78 @@
+"""Export of questions
+
+Questions are read through a server-side cursor in batches of
+EXPORT_BATCH_SIZE rows and encoded as NDJSON or CSV while they are
+streamed, so memory use stays flat and the first bytes are sent right
+away however large the questions table is.
+"""
+import csv
+import io
+import json
+
+from models import db, Question
+
+EXPORT_BATCH_SIZE = 1000
+FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_rows(category=None, difficulty=None):
+    """Select questions to export as column tuples ordered by id
+
+    Args:
+        category (str): Export only questions in the category
+        difficulty (int): Export only questions of the difficulty
+
+    Returns:
+        obj: a query yielding rows of FIELDS through a server-side cursor
+    """
+    selection = db.session.query(
+        *(getattr(Question, field) for field in FIELDS))
+    if category is not None:
+        selection = selection.filter(Question.category == category)
+    if difficulty is not None:
+        selection = selection.filter(Question.difficulty == difficulty)
+    return selection.order_by(Question.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(EXPORT_BATCH_SIZE)
+
+
+def _ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, row))) + '\n'
+
+
+def _csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+
+def generate_export(rows, export_format):
+    """Encode rows in chunks of EXPORT_BATCH_SIZE rows
+
+    Args:
+        rows (iterable): rows of FIELDS
+        export_format (str): 'ndjson' or 'csv'
+
+    Yields:
+        str: a chunk of the encoded rows
+    """
+    encode = _csv if export_format == 'csv' else _ndjson
+    chunk = []
+    for line in encode(rows):
+        chunk.append(line)
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk.clear()
+    if chunk:
+        yield ''.join(chunk)
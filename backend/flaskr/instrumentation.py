@@ -0,0 +1,260 @@
+"""SQL instrumentation
+
+Listeners on the SQLAlchemy engine record every statement executed
+while a request, or a record_queries() block, is active. For each
+request, the query count, the total DB time and the slowest statement
+are published as a Server-Timing response header and accumulated into
+metrics rendered in the Prometheus text format.
+
+The cold start of an app, its import, create_app and first request, is
+reported in the log and the metrics too.
+"""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryStats:
+    """Statements executed in a request or a record_queries() block
+
+    Attributes:
+        count (int): The number of executed statements
+        duration (float): Seconds spent in the database
+        slowest (str): The slowest statement
+        slowest_duration (float): Seconds spent in the slowest statement
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = None
+        self.slowest_duration = 0.0
+        self.statements = []
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements.append(statement)
+        if duration >= self.slowest_duration:
+            self.slowest = statement
+            self.slowest_duration = duration
+
+
+def _active_stats():
+    if not hasattr(_local, 'stats'):
+        _local.stats = []
+    return _local.stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['query_started_at'].pop()
+    for stats in _active_stats():
+        stats.record(statement, duration)
+
+
+def instrument_engine(engine):
+    """Attach the statement timing listeners to an engine once
+
+    Passing the Engine class instruments every engine, including the
+    ones which are not created yet.
+    """
+    if not event.contains(engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+@contextmanager
+def record_queries():
+    """Record statements executed in the current thread
+
+    Example:
+        with record_queries() as stats:
+            client.get('/categories')
+        print(stats.count, stats.duration, stats.slowest)
+    """
+    stats = QueryStats()
+    _active_stats().append(stats)
+    try:
+        yield stats
+    finally:
+        _active_stats().remove(stats)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail if more than limit statements are executed in the block
+
+    Raises:
+        AssertionError: More statements than limit are executed.
+    """
+    with record_queries() as stats:
+        yield stats
+    if stats.count > limit:
+        raise AssertionError(
+            f'{stats.count} queries executed, expected at most {limit}:\n'
+            + '\n'.join(stats.statements))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Metrics:
+    """Request and database metrics in the Prometheus text format
+
+    Other subsystems add their own lines by register(collector), where
+    collector() yields lines of the text format.
+    """
+
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.request_seconds = defaultdict(float)
+        self.db_queries = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+        self.db_slowest_seconds = defaultdict(float)
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def observe(self, endpoint, method, status, duration, stats):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.request_seconds[endpoint] += duration
+            self.db_queries[endpoint] += stats.count
+            self.db_seconds[endpoint] += stats.duration
+            self.db_slowest_seconds[endpoint] = max(
+                self.db_slowest_seconds[endpoint], stats.slowest_duration)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines.append('# TYPE trivia_requests_total counter')
+            for (endpoint, method, status), value in \
+                    sorted(self.requests.items()):
+                lines.append(
+                    f'trivia_requests_total{{endpoint="{_escape(endpoint)}",'
+                    f'method="{method}",status="{status}"}} {value}')
+            for name, kind, values in (
+                    ('trivia_request_seconds_total', 'counter',
+                     self.request_seconds),
+                    ('trivia_db_queries_total', 'counter', self.db_queries),
+                    ('trivia_db_seconds_total', 'counter', self.db_seconds),
+                    ('trivia_db_slowest_query_seconds', 'gauge',
+                     self.db_slowest_seconds)):
+                lines.append(f'# TYPE {name} {kind}')
+                for endpoint, value in sorted(values.items()):
+                    lines.append(
+                        f'{name}{{endpoint="{_escape(endpoint)}"}} {value}')
+        for collector in self.collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+class StartupReport:
+    """Cold start timings of an app in seconds
+
+    Attributes:
+        import_seconds (float): Importing the optional subsystems
+            enabled by the config of the app
+        create_app_seconds (float): create_app()
+        first_request_seconds (float): The first request, including
+            what is initialized lazily, such as database connections
+    """
+
+    def __init__(self, import_seconds=None):
+        self.import_seconds = import_seconds
+        self.create_app_seconds = None
+        self.first_request_seconds = None
+
+    def as_dict(self):
+        return {
+            'import_seconds': self.import_seconds,
+            'create_app_seconds': self.create_app_seconds,
+            'first_request_seconds': self.first_request_seconds,
+        }
+
+    def collect(self):
+        """Lines of the timings in the Prometheus text format"""
+        lines = []
+        for name, value in self.as_dict().items():
+            if value is not None:
+                lines.append(f'# TYPE trivia_startup_{name} gauge')
+                lines.append(f'trivia_startup_{name} {value}')
+        return lines
+
+
+def init_instrumentation(app, startup):
+    """Record the statements of each request of app
+
+    Args:
+        app (obj): a Flask app
+        startup (obj): The StartupReport of app, completed by the
+            first request
+
+    Returns:
+        Metrics: the metrics of app
+    """
+    instrument_engine(Engine)
+    metrics = Metrics()
+    metrics.register(startup.collect)
+
+    @app.before_first_request
+    def start_first_request():
+        g.first_request_started_at = time.perf_counter()
+
+    @app.before_request
+    def start_recording():
+        g.query_stats = QueryStats()
+        g.request_started_at = time.perf_counter()
+        _active_stats().append(g.query_stats)
+
+    @app.after_request
+    def publish_query_stats(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+        duration = time.perf_counter() - g.request_started_at
+        response.headers.add('Server-Timing', ', '.join([
+            f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries"',
+            f'db-slowest;dur={stats.slowest_duration * 1000:.2f}',
+            f'app;dur={duration * 1000:.2f}',
+        ]))
+        metrics.observe(request.endpoint or 'unknown', request.method,
+                        response.status_code, duration, stats)
+        if 'first_request_started_at' in g:
+            startup.first_request_seconds = \
+                time.perf_counter() - g.first_request_started_at
+            app.logger.info('cold start: %s', ', '.join(
+                f'{name} {value * 1000:.1f} ms'
+                for name, value in startup.as_dict().items()
+                if value is not None))
+        if stats.slowest is not None:
+            app.logger.debug('slowest statement (%.2f ms): %s',
+                             stats.slowest_duration * 1000, stats.slowest)
+        return response
+
+    @app.teardown_request
+    def stop_recording(error=None):
+        stats = g.pop('query_stats', None)
+        if stats in _active_stats():
+            _active_stats().remove(stats)
+
+    return metrics
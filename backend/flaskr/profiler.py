@@ -0,0 +1,259 @@
+"""Request profiler
+
+Runs cProfile around requests selected by a privileged header or by
+sampling, so that the time spent inside a view can be broken down in
+production. A request is profiled if
+
+- its X-Profile header matches PROFILER_TOKEN, or
+- it is drawn with probability PROFILER_SAMPLE_RATE.
+
+Profiles are written to PROFILER_DIR, if it is set, as pstats files
+named after the time, the route and the status, and the
+PROFILER_KEEP slowest ones are kept in memory for the admin endpoints.
+
+The hooks are only registered when PROFILER_TOKEN or
+PROFILER_SAMPLE_RATE is set, so a disabled profiler costs nothing.
+One request is profiled at a time; requests arriving meanwhile are
+served without a profile.
+"""
+import cProfile
+import heapq
+import hmac
+import io
+import itertools
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from flask import g, request
+
+PROFILE_HEADER = 'X-Profile'
+PROFILER_KEEP = 20
+PROFILE_STATS_LINES = 50
+
+
+class RequestProfile:
+    """The profile of a request
+
+    Attributes:
+        id (int): The id of the profile
+        method (str): The request method
+        route (str): The URL rule of the request, or its path if no
+            rule matched
+        status (int): The response status
+        duration (float): Seconds spent in the profiled request
+        started_at (float): The start of the request in seconds since
+            the epoch
+        path (str): The pstats file of the profile, or None
+        stats (str): The functions with the most cumulative time
+    """
+
+    def __init__(self, profile_id, method, route, status, duration,
+                 started_at, path, stats):
+        self.id = profile_id
+        self.method = method
+        self.route = route
+        self.status = status
+        self.duration = duration
+        self.started_at = started_at
+        self.path = path
+        self.stats = stats
+
+    def format(self):
+        return {
+            'id': self.id,
+            'method': self.method,
+            'route': self.route,
+            'status': self.status,
+            'duration': self.duration,
+            'started_at': self.started_at,
+            'path': self.path,
+        }
+
+
+class RequestProfiler:
+    """Profiler of selected requests keeping the slowest profiles
+
+    Args:
+        token (str): The value of the X-Profile header profiling a
+            request, None to profile by sampling only
+        sample_rate (float): The probability of profiling a request
+        directory (str): The directory of the pstats files, None to
+            keep the profiles in memory only
+        keep (int): The number of slowest profiles kept in memory
+        rng (obj): a random.Random drawing the sampled requests
+    """
+
+    def __init__(self, token=None, sample_rate=0.0, directory=None,
+                 keep=PROFILER_KEEP, rng=None):
+        self.token = token
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.keep = keep
+        self.rng = rng or random.Random()
+        self.profiled = 0
+        self._ids = itertools.count(1)
+        # min-heap of (duration, id, RequestProfile) of the slowest
+        self._slowest = []
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def is_privileged(self, value):
+        """Whether value is the profiling token"""
+        return self.token is not None and value is not None \
+            and hmac.compare_digest(value.encode(), self.token.encode())
+
+    def should_profile(self, header):
+        """Whether a request with the X-Profile header value is profiled"""
+        return self.is_privileged(header) \
+            or (self.sample_rate > 0 and self.rng.random() < self.sample_rate)
+
+    def start(self):
+        """Start profiling the current thread
+
+        Returns:
+            obj: the running cProfile.Profile, or None if another
+                request is being profiled
+        """
+        if not self._active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler, such as a debugger, is active
+            self._active.release()
+            return None
+        return profile
+
+    def stop(self, profile, method, route, status, duration, started_at):
+        """Stop profile and record it
+
+        Returns:
+            RequestProfile: the recorded profile
+        """
+        profile.disable()
+        self._active.release()
+        profile_id = next(self._ids)
+
+        path = None
+        if self.directory is not None:
+            name = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+            path = os.path.join(self.directory, (
+                f'{time.strftime("%Y%m%dT%H%M%S", time.gmtime(started_at))}'
+                f'-{profile_id}-{method}-{name}-{status}'
+                f'-{duration * 1000:.0f}ms.prof'))
+            profile.dump_stats(path)
+
+        with self._lock:
+            self.profiled += 1
+            kept = len(self._slowest) < self.keep \
+                or duration > self._slowest[0][0]
+        recorded = RequestProfile(
+            profile_id, method, route, status, duration, started_at, path,
+            self._format_stats(profile) if kept else None)
+        if kept:
+            with self._lock:
+                entry = (duration, profile_id, recorded)
+                if len(self._slowest) < self.keep:
+                    heapq.heappush(self._slowest, entry)
+                elif duration > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, entry)
+        return recorded
+
+    def discard(self, profile):
+        """Stop profile without recording it"""
+        profile.disable()
+        self._active.release()
+
+    @staticmethod
+    def _format_stats(profile):
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats(
+            'cumulative').print_stats(PROFILE_STATS_LINES)
+        return output.getvalue()
+
+    def slowest(self):
+        """The kept profiles, the slowest first"""
+        with self._lock:
+            return [entry[2] for entry in
+                    sorted(self._slowest, key=lambda e: e[:2], reverse=True)]
+
+    def get(self, profile_id):
+        """A kept profile by id, or None"""
+        with self._lock:
+            for _, kept_id, profile in self._slowest:
+                if kept_id == profile_id:
+                    return profile
+        return None
+
+    def collect(self):
+        """Lines of the profiler metrics in the Prometheus text format"""
+        with self._lock:
+            kept = len(self._slowest)
+        return [
+            '# TYPE trivia_profiled_requests_total counter',
+            f'trivia_profiled_requests_total {self.profiled}',
+            '# TYPE trivia_profiles_kept gauge',
+            f'trivia_profiles_kept {kept}',
+        ]
+
+
+def init_profiler(app):
+    """Profile the requests of app configured by PROFILER_TOKEN and
+    PROFILER_SAMPLE_RATE
+
+    Call it right after init_instrumentation, so that the profile
+    covers the view and the hooks registered later. The bodies of streamed
+    responses are produced after the profile ends.
+
+    Returns:
+        RequestProfiler: the profiler, or None if it isn't enabled
+    """
+    token = app.config.get('PROFILER_TOKEN')
+    sample_rate = app.config.get('PROFILER_SAMPLE_RATE', 0.0)
+    if token is None and not sample_rate:
+        return None
+    profiler = RequestProfiler(
+        token=token,
+        sample_rate=sample_rate,
+        directory=app.config.get('PROFILER_DIR'),
+        keep=app.config.get('PROFILER_KEEP', PROFILER_KEEP),
+    )
+
+    @app.before_request
+    def start_profile():
+        if request.path.startswith('/admin/'):
+            return
+        if profiler.should_profile(request.headers.get(PROFILE_HEADER)):
+            g.profile = profiler.start()
+            g.profile_started_at = time.time()
+            g.profile_started = time.perf_counter()
+
+    @app.after_request
+    def stop_profile(response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        duration = time.perf_counter() - g.profile_started
+        rule = request.url_rule
+        recorded = profiler.stop(
+            profile, request.method,
+            rule.rule if rule is not None else request.path,
+            response.status_code, duration, g.profile_started_at)
+        response.headers['X-Profile-Id'] = str(recorded.id)
+        return response
+
+    @app.teardown_request
+    def abandon_profile(error=None):
+        # after_request is skipped by unhandled exceptions
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profiler.discard(profile)
+
+    return profiler
@@ -0,0 +1,157 @@
+"""Quiz decks
+
+A deck is a set of distinct random questions of a quiz, drawn in one
+request instead of one "/quizzes" request per question. Decks are
+sampled over a compact list of question ids per category, sorted by
+(difficulty, id) and cached until the questions table changes, so a
+deck costs the version check and one query for the drawn questions.
+"""
+import random
+import threading
+from array import array
+from bisect import bisect_left
+
+from models import Question, TableVersion
+
+
+class CandidateList:
+    """Question ids of a category sorted by (difficulty, id)
+
+    Attributes:
+        ids (array): The question ids
+        strata (dict): difficulty: (start, end) of its ids
+    """
+
+    def __init__(self, rows):
+        self.ids = array('q')
+        self.strata = {}
+        for difficulty, question_id in rows:
+            if difficulty not in self.strata:
+                self.strata[difficulty] = (len(self.ids), len(self.ids))
+            self.ids.append(question_id)
+            start, _ = self.strata[difficulty]
+            self.strata[difficulty] = (start, len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _contains(self, start, end, question_id):
+        index = bisect_left(self.ids, question_id, start, end)
+        return index < end and self.ids[index] == question_id
+
+    def available(self, start, end, excluded):
+        """The number of ids in [start, end) which aren't excluded"""
+        return end - start - sum(
+            1 for question_id in excluded
+            if self._contains(start, end, question_id))
+
+    def sample(self, start, end, count, excluded, rng):
+        """Draw count distinct ids in [start, end) which aren't excluded
+
+        count + len(excluded) distinct positions hold at least count ids
+        which aren't excluded, so the ids aren't copied unless the
+        range is nearly exhausted.
+        """
+        size = end - start
+        if count + len(excluded) >= size:
+            pool = [question_id for question_id in self.ids[start:end]
+                    if question_id not in excluded]
+            return rng.sample(pool, min(count, len(pool)))
+
+        drawn = []
+        for index in rng.sample(range(start, end), count + len(excluded)):
+            if self.ids[index] not in excluded:
+                drawn.append(self.ids[index])
+                if len(drawn) == count:
+                    break
+        return drawn
+
+
+class QuizDeckSampler:
+    """Sampler of quiz decks over cached candidate lists
+
+    Args:
+        rng (obj): a random.Random, the module's one by default
+    """
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+        self._candidates = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, category_id, version=None):
+        """The CandidateList of a category, 0 for all categories, at
+        version of the questions table, read here unless it is given"""
+        if version is None:
+            version = TableVersion.get(Question.__tablename__)[
+                Question.__tablename__]
+        with self._lock:
+            cached = self._candidates.get(category_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        selection = Question.query.with_entities(
+            Question.difficulty, Question.id)
+        if category_id != 0:
+            selection = selection.filter(Question.category == category_id)
+        candidates = CandidateList(
+            selection.order_by(Question.difficulty, Question.id))
+        with self._lock:
+            self._candidates[category_id] = (version, candidates)
+        return candidates
+
+    def sample(self, category_id, count, previous_questions=(),
+               stratify=False, version=None):
+        """Draw a deck of distinct random question ids
+
+        Args:
+            category_id (int): The category, 0 for all categories
+            count (int): The number of questions in the deck
+            previous_questions (list): Ids of questions to exclude
+            stratify (bool): Spread the deck evenly over difficulties,
+                as far as each difficulty has questions
+            version (int): The version of the questions table read
+                before, if any
+
+        Returns:
+            tuple: the shuffled question ids of the deck and the number
+                of candidate questions
+        """
+        candidates = self.candidates(category_id, version)
+        excluded = set(previous_questions)
+        rng = self.rng
+
+        if not stratify:
+            deck = candidates.sample(
+                0, len(candidates), count, excluded, rng)
+            return deck, len(candidates)
+
+        available = {
+            difficulty: candidates.available(start, end, excluded)
+            for difficulty, (start, end) in candidates.strata.items()
+        }
+        quotas = dict.fromkeys(available, 0)
+        active = [difficulty for difficulty in available
+                  if available[difficulty]]
+        remaining = count
+        while remaining and active:
+            share = max(1, remaining // len(active))
+            rng.shuffle(active)
+            for difficulty in list(active):
+                taken = min(share, remaining,
+                            available[difficulty] - quotas[difficulty])
+                quotas[difficulty] += taken
+                remaining -= taken
+                if quotas[difficulty] == available[difficulty]:
+                    active.remove(difficulty)
+                if not remaining:
+                    break
+
+        deck = []
+        for difficulty, quota in quotas.items():
+            if quota:
+                start, end = candidates.strata[difficulty]
+                deck.extend(
+                    candidates.sample(start, end, quota, excluded, rng))
+        rng.shuffle(deck)
+        return deck, len(candidates)
@@ -0,0 +1,188 @@
+"""Quiz events
+
+Answers of quiz questions are recorded for calibrating difficulties,
+without a commit per answer in the request. "/quizzes/events" enqueues
+the events in memory, and a background writer thread inserts them in
+batches with a single multi-row INSERT:
+
+- a batch is written once QUIZ_EVENTS_BATCH_SIZE events are queued, or
+  QUIZ_EVENTS_FLUSH_SECONDS after the first of them
+- at most QUIZ_EVENTS_MAX_QUEUE events wait to be written, and events
+  beyond it are rejected, so that a slow database can't grow the
+  queue without bounds
+- the queue is flushed when the process exits
+
+The thread is started by the first event. Events which fail to be
+written are logged and dropped.
+"""
+import atexit
+import threading
+import time
+from collections import deque
+
+from models import QuizEvent
+
+QUIZ_EVENTS_BATCH_SIZE = 500
+QUIZ_EVENTS_FLUSH_SECONDS = 1.0
+QUIZ_EVENTS_MAX_QUEUE = 10000
+QUIZ_EVENTS_CLOSE_TIMEOUT = 5.0
+
+
+class QuizEventWriter:
+    """Bounded queue of events written in batches by a thread
+
+    Args:
+        write (function): writes a list of events in one batch
+        batch_size (int): The maximum number of events in a batch
+        flush_seconds (float): The longest time an event waits for a
+            batch to fill up
+        max_queue (int): The maximum number of events waiting to be
+            written
+        logger (obj): The logger of write errors
+    """
+
+    def __init__(self, write, batch_size=QUIZ_EVENTS_BATCH_SIZE,
+                 flush_seconds=QUIZ_EVENTS_FLUSH_SECONDS,
+                 max_queue=QUIZ_EVENTS_MAX_QUEUE, logger=None):
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_queue = max_queue
+        self.logger = logger
+        self.written = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+        self._events = deque()
+        self._writing = 0
+        self._closed = False
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._events)
+
+    def enqueue(self, events):
+        """Queue events to be written
+
+        Events are queued all together or not at all.
+
+        Returns:
+            bool: False if the queue is full or closed
+        """
+        with self._condition:
+            if self._closed \
+                    or len(self._events) + len(events) > self.max_queue:
+                self.rejected += len(events)
+                return False
+            self._events.extend(events)
+            self._condition.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='trivia-quiz-events',
+                    daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        return True
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._events and not self._closed:
+                self._condition.wait()
+            if len(self._events) < self.batch_size and not self._closed:
+                # wait for the batch to fill up, at most flush_seconds
+                deadline = time.monotonic() + self.flush_seconds
+                while len(self._events) < self.batch_size \
+                        and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            batch = [self._events.popleft() for _ in
+                     range(min(self.batch_size, len(self._events)))]
+            self._writing = len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self.write(batch)
+                self.written += len(batch)
+                self.batches += 1
+            except Exception:
+                self.failed += len(batch)
+                if self.logger is not None:
+                    self.logger.exception(
+                        'failed to write %d quiz events', len(batch))
+            with self._condition:
+                self._writing = 0
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until the queued events are written
+
+        Returns:
+            bool: False if the timeout expired first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._events or self._writing:
+                if self._thread is None:
+                    return False
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=QUIZ_EVENTS_CLOSE_TIMEOUT):
+        """Write the queued events and stop the thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def collect(self):
+        """Lines of the writer metrics in the Prometheus text format"""
+        lines = []
+        for name, kind, value in (
+                ('trivia_quiz_events_queued', 'gauge', len(self._events)),
+                ('trivia_quiz_events_written_total', 'counter',
+                 self.written),
+                ('trivia_quiz_events_rejected_total', 'counter',
+                 self.rejected),
+                ('trivia_quiz_events_failed_total', 'counter', self.failed),
+                ('trivia_quiz_event_batches_total', 'counter',
+                 self.batches)):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return lines
+
+
+def create_quiz_event_writer(app):
+    """Create the quiz event writer of app configured by
+    QUIZ_EVENTS_BATCH_SIZE, QUIZ_EVENTS_FLUSH_SECONDS and
+    QUIZ_EVENTS_MAX_QUEUE
+
+    Returns:
+        QuizEventWriter: the writer
+    """
+    def write(events):
+        with app.app_context():
+            QuizEvent.insert_many(events)
+
+    return QuizEventWriter(
+        write,
+        batch_size=app.config.get(
+            'QUIZ_EVENTS_BATCH_SIZE', QUIZ_EVENTS_BATCH_SIZE),
+        flush_seconds=app.config.get(
+            'QUIZ_EVENTS_FLUSH_SECONDS', QUIZ_EVENTS_FLUSH_SECONDS),
+        max_queue=app.config.get(
+            'QUIZ_EVENTS_MAX_QUEUE', QUIZ_EVENTS_MAX_QUEUE),
+        logger=app.logger,
+    )
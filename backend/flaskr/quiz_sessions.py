@@ -0,0 +1,147 @@
+"""Quiz sessions
+
+A quiz session keeps a shuffled sequence of question ids on the server,
+so that each round of "/quizzes" is a pop from the sequence and a single
+primary key fetch, instead of a query excluding every previous question.
+A session keeps a random sample of at most max_questions ids, so that
+the store holds at most max_sessions * max_questions ids however large
+the categories are.
+
+Sessions are kept in the memory of a worker, so a round has to reach the
+worker which started its session. The least recently used session is
+evicted when there are more than max_sessions, and sessions expire after
+ttl seconds without a round. An exhausted session is kept until then, so
+that every further round finds no question rather than no session.
+"""
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+MAX_QUIZ_SESSIONS = 10000
+QUIZ_SESSION_TTL = 3600
+QUIZ_SESSION_MAX_QUESTIONS = 100
+
+
+class QuizSession:
+    """A shuffled sequence of question ids for a quiz
+
+    Attributes:
+        category (dict): The quiz category, e.g. {"type": .., "id": ..}
+        question_ids (list): Question ids which are not asked yet
+        touched_at (float): The last time the session was used
+    """
+
+    def __init__(self, category, question_ids,
+                 max_questions=QUIZ_SESSION_MAX_QUESTIONS):
+        question_ids = list(question_ids)
+        self.category = category
+        # a sample of all of them is a shuffle
+        self.question_ids = random.sample(
+            question_ids, min(len(question_ids), max_questions))
+        self.touched_at = time.monotonic()
+
+
+class QuizSessionStore:
+    """In-memory quiz sessions with LRU eviction and expiry
+
+    Args:
+        max_sessions (int): The maximum number of sessions to keep
+        ttl (int): Seconds a session is kept without being used
+        max_questions (int): The maximum number of question ids kept
+            per session
+    """
+
+    def __init__(self, max_sessions=MAX_QUIZ_SESSIONS, ttl=QUIZ_SESSION_TTL,
+                 max_questions=QUIZ_SESSION_MAX_QUESTIONS):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_questions = max_questions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, category, question_ids):
+        """Start a new quiz session
+
+        Args:
+            category (dict): The quiz category
+            question_ids (iterable): Ids of the questions to ask, of
+                which up to max_questions are sampled
+
+        Returns:
+            tuple: The id of the new session and the number of its
+                questions
+        """
+        session_id = uuid.uuid4().hex
+        session = QuizSession(category, question_ids, self.max_questions)
+        with self._lock:
+            self._evict(time.monotonic())
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session_id, len(session.question_ids)
+
+    def get(self, session_id):
+        """Get a session which is not expired
+
+        Returns:
+            QuizSession: The session, or None if there is no such a
+                session.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._evict(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.touched_at = now
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def pop(self, session_id):
+        """Take the next question id of a session
+
+        Returns:
+            int: The next question id, or None if all questions of the
+                session are asked. The session is kept until it expires.
+
+        Raises:
+            KeyError: There is no such a session.
+        """
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        with self._lock:
+            if session.question_ids:
+                return session.question_ids.pop()
+        return None
+
+    def discard(self, session_id):
+        """Remove a session if it exists"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _evict(self, now):
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.touched_at <= self.ttl:
+                break
+            del self._sessions[session_id]
+
+
+def create_quiz_session_store(app):
+    """Create the quiz session store of app configured by
+    MAX_QUIZ_SESSIONS, QUIZ_SESSION_TTL and QUIZ_SESSION_MAX_QUESTIONS
+
+    Returns:
+        QuizSessionStore: the store
+    """
+    return QuizSessionStore(
+        max_sessions=app.config.get('MAX_QUIZ_SESSIONS', MAX_QUIZ_SESSIONS),
+        ttl=app.config.get('QUIZ_SESSION_TTL', QUIZ_SESSION_TTL),
+        max_questions=app.config.get(
+            'QUIZ_SESSION_MAX_QUESTIONS', QUIZ_SESSION_MAX_QUESTIONS),
+    )
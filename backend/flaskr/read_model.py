@@ -0,0 +1,321 @@
+"""In-memory read model of the questions
+
+With READ_MODEL enabled, question reads of "/questions",
+"/categories/<id>/questions", "/search_questions" and the quiz
+endpoints are served from a column store in the worker instead of the
+database:
+
+- ids: the question ids in ascending order, an array of int64
+- difficulties, categories: arrays of small codes into the distinct
+  difficulties and categories
+- questions, answers: lists of interned strings
+- an id array per category, for category pages and quizzes
+
+The columns are loaded by the first read. Changes committed by this
+worker are applied right away by the question change listeners, which
+move the version of the columns along, and changes of other workers
+are picked up by polling the version of the questions table at most
+every READ_MODEL_POLL_SECONDS, which reloads the columns when it has
+moved past them.
+
+The database stays the fallback: reads go to it while the read model is
+disabled, and when the questions outgrow READ_MODEL_MAX_QUESTIONS.
+"""
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from flask import current_app
+
+from models import Question, QuestionCount, TableVersion, \
+    on_question_change, use_primary
+from .serialization import QUESTION_COLUMNS
+
+READ_MODEL_POLL_SECONDS = 1.0
+READ_MODEL_MAX_QUESTIONS = 100000
+
+
+def _intern(text):
+    return sys.intern(text) if type(text) is str else text
+
+
+class _Codes:
+    """Small integer codes of distinct values, such as categories"""
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def get(self, value):
+        return self._codes.get(value)
+
+
+class QuestionReadModel:
+    """Column store of all questions
+
+    Args:
+        page_size (int): The number of questions in a page
+        poll_seconds (float): The minimum interval between two checks
+            of the version of the questions table
+        max_questions (int): The number of questions beyond which the
+            read model gives way to the database
+    """
+
+    def __init__(self, page_size, poll_seconds=READ_MODEL_POLL_SECONDS,
+                 max_questions=READ_MODEL_MAX_QUESTIONS):
+        self.page_size = page_size
+        self.poll_seconds = poll_seconds
+        self.max_questions = max_questions
+        self.loaded = False
+        self.version = None
+        self.loads = 0
+        self.fallbacks = 0
+        self._polled_at = 0.0
+        self._clear()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def _clear(self):
+        self.ids = array('q')
+        self.questions = []
+        self.answers = []
+        self.difficulties = array('H')
+        self.categories = array('H')
+        self.difficulty_codes = _Codes()
+        self.category_codes = _Codes()
+        self.by_category = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def refresh(self, version=None):
+        """Load the columns, or reload them if the questions table has
+        changed since they were loaded
+
+        Args:
+            version (int): The version of the questions table read by
+                the request already, if any. Otherwise the version is
+                polled at most every poll_seconds.
+
+        Returns:
+            bool: whether the read model can serve reads
+        """
+        now = time.monotonic()
+        if version is None and (
+                self.version is None
+                or now - self._polled_at >= self.poll_seconds):
+            version = TableVersion.get(Question.__tablename__)[
+                Question.__tablename__]
+            self._polled_at = now
+        if version is not None and self._behind(version):
+            with self._load_lock:
+                if self._behind(version):
+                    self.load()
+        if not self.loaded:
+            self.fallbacks += 1
+        return self.loaded
+
+    def _behind(self, version):
+        return self.version is None or version > self.version
+
+    def load(self):
+        """Load all questions from the primary database
+
+        The version is read before the questions, so that the columns
+        are at least as recent as it.
+        """
+        use_primary()
+        version = TableVersion.get(Question.__tablename__)[
+            Question.__tablename__]
+        if QuestionCount.total() > self.max_questions:
+            current_app.logger.warning(
+                'read model disabled: more than %d questions',
+                self.max_questions)
+            with self._lock:
+                self._clear()
+                self.loaded = False
+                self.version = version
+            return
+
+        rows = Question.query.with_entities(*QUESTION_COLUMNS) \
+            .order_by(Question.id)
+        with self._lock:
+            self._clear()
+            for row in rows:
+                self._append(row)
+            self.loaded = True
+            self.version = version
+            self.loads += 1
+
+    def _append(self, row):
+        question_id, question, answer, category, difficulty = row
+        self.ids.append(question_id)
+        self.questions.append(_intern(question))
+        self.answers.append(_intern(answer))
+        self.difficulties.append(self.difficulty_codes.code(difficulty))
+        code = self.category_codes.code(category)
+        self.categories.append(code)
+        self.by_category.setdefault(code, array('q')).append(question_id)
+
+    def _index(self, question_id):
+        index = bisect_left(self.ids, question_id)
+        if index < len(self.ids) and self.ids[index] == question_id:
+            return index
+        return None
+
+    def _row(self, index):
+        return (
+            self.ids[index],
+            self.questions[index],
+            self.answers[index],
+            self.category_codes.values[self.categories[index]],
+            self.difficulty_codes.values[self.difficulties[index]],
+        )
+
+    def _category_ids(self, category_id):
+        if category_id is None:
+            return self.ids
+        code = self.category_codes.get(category_id)
+        if code is None:
+            return array('q')
+        return self.by_category.get(code, array('q'))
+
+    def total(self):
+        """The number of all questions"""
+        return len(self.ids)
+
+    def page(self, category_id=None, after=None, page=1):
+        """A page of questions ordered by id, like paginate_questions
+
+        Args:
+            category_id (int): The category, None for all questions
+            after (int): The keyset cursor, or None for "page"
+            page (int): The page number from 1
+
+        Returns:
+            list: a page of question rows of QUESTION_COLUMNS
+        """
+        with self._lock:
+            ids = self._category_ids(category_id)
+            if after is not None:
+                start = bisect_right(ids, after)
+            elif page < 1:
+                return []
+            else:
+                start = (page - 1) * self.page_size
+            return self._rows(ids[start:start + self.page_size])
+
+    def rows(self, question_ids):
+        """The question rows of question_ids in the same order, without
+        the ids which don't exist"""
+        with self._lock:
+            return self._rows(question_ids)
+
+    def _rows(self, question_ids):
+        rows = []
+        for question_id in question_ids:
+            index = self._index(question_id)
+            if index is not None:
+                rows.append(self._row(index))
+        return rows
+
+    def row(self, question_id):
+        """The question row of an id, or None"""
+        rows = self.rows((question_id,))
+        return rows[0] if rows else None
+
+    def question_ids(self, category_id=None, previous_questions=()):
+        """The ids of a category, all categories for None, which are
+        not in previous_questions, like quiz_question_ids"""
+        excluded = set(previous_questions or ())
+        with self._lock:
+            return [question_id
+                    for question_id in self._category_ids(category_id)
+                    if question_id not in excluded]
+
+    def on_question_change(self, action, old, new):
+        if action == 'reload':
+            with self._lock:
+                self.loaded = False
+                self.version = None
+            return
+        version = TableVersion.bumped(Question.__tablename__)
+        with self._lock:
+            if not self.loaded:
+                return
+            if old is not None:
+                self._remove(old['id'])
+            if new is not None:
+                self._insert(new)
+            # the columns are up to date with the version of this change
+            # only if no other worker has changed the questions before it
+            if version is not None and self.version is not None \
+                    and version == self.version + 1:
+                self.version = version
+
+    def _insert(self, question):
+        self._remove(question['id'])
+        index = bisect_left(self.ids, question['id'])
+        self.ids.insert(index, question['id'])
+        self.questions.insert(index, _intern(question['question']))
+        self.answers.insert(index, _intern(question['answer']))
+        self.difficulties.insert(
+            index, self.difficulty_codes.code(question['difficulty']))
+        code = self.category_codes.code(question['category'])
+        self.categories.insert(index, code)
+        ids = self.by_category.setdefault(code, array('q'))
+        ids.insert(bisect_left(ids, question['id']), question['id'])
+
+    def _remove(self, question_id):
+        index = self._index(question_id)
+        if index is None:
+            return
+        ids = self.by_category[self.categories[index]]
+        del ids[bisect_left(ids, question_id)]
+        for column in (self.ids, self.questions, self.answers,
+                       self.difficulties, self.categories):
+            del column[index]
+
+    def collect(self):
+        """Lines of the read model metrics in the Prometheus text
+        format"""
+        lines = []
+        for name, kind, value in (
+                ('trivia_read_model_questions', 'gauge', len(self.ids)),
+                ('trivia_read_model_loads_total', 'counter', self.loads),
+                ('trivia_read_model_fallbacks_total', 'counter',
+                 self.fallbacks)):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return lines
+
+
+def create_read_model(app, page_size):
+    """Create the read model of app if READ_MODEL is enabled
+
+    Question changes of app are applied to the read model. Nothing is
+    read from the database here.
+
+    Returns:
+        QuestionReadModel: the read model, or None if it is disabled
+    """
+    if not app.config.get('READ_MODEL', False):
+        return None
+    read_model = QuestionReadModel(
+        page_size,
+        poll_seconds=app.config.get(
+            'READ_MODEL_POLL_SECONDS', READ_MODEL_POLL_SECONDS),
+        max_questions=app.config.get(
+            'READ_MODEL_MAX_QUESTIONS', READ_MODEL_MAX_QUESTIONS),
+    )
+    on_question_change(app, read_model.on_question_change)
+    return read_model
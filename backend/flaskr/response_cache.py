@@ -0,0 +1,374 @@
+"""Response cache of question pages
+
+Pages of "/questions", "/categories/<id>/questions" and
+"/search_questions" are cached as encoded JSON, so a hit runs neither
+the page query nor the encoder.
+
+Pages are keyed by the version of the questions they list, read by the
+request with the versions of its ETag, so that a question change
+committed by any worker makes the pages of every worker miss, even
+though only the worker of the change is told about it. Pages of all
+questions and search results are keyed by the version of the questions
+table, and pages of a category by the version of the questions of that
+category, so a change leaves the pages of the other categories cached.
+Entries are tagged by what they list as well, and the worker of a
+change drops the entries it touches right away instead of waiting for
+their eviction:
+
+- 'questions': pages of all questions
+- 'category:<id>': pages of a category, the old and the new one
+- 'search': search results
+
+Totals and category types are read on every request instead of being
+cached.
+
+Backends, selected by RESPONSE_CACHE:
+- 'memory' (default): an LRU dictionary in the worker
+- 'sqlite': a SQLite file at RESPONSE_CACHE_PATH shared by the workers
+  on a host, so that they build each page once
+
+RESPONSE_CACHE_MAX_BYTES bounds the size of the entries, and 0 disables
+the cache.
+
+Concurrent misses of a key of the same version are coalesced: one of
+them builds the page, and the others share it. This holds when the
+cache is disabled as well.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from models import on_question_change
+from .serialization import Fragment
+from .single_flight import SingleFlight
+
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+def _entry_size(key, value):
+    return len(key) + sum(
+        len(name) + len(text) for name, text in value.items())
+
+
+class MemoryCacheBackend:
+    """An LRU dictionary bounded by the size of its entries
+
+    Args:
+        max_bytes (int): The total size of the entries. The least
+            recently used entries are evicted beyond it.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._tags = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, tags, generation):
+        """Store an entry built at generation, and return the number of
+        evicted entries
+
+        The entry isn't stored if the cache has been invalidated since
+        generation, because it may have been built from older data.
+        """
+        size = _entry_size(key, value)
+        if size > self.max_bytes:
+            return 0
+        evicted = 0
+        with self._lock:
+            if generation != self.generation:
+                return 0
+            self._remove(key)
+            self._entries[key] = (value, tags, size)
+            for tag in tags:
+                self._tags[tag].add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+        return evicted
+
+    def invalidate(self, tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, tags, size = entry
+        self.size -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SqliteCacheBackend:
+    """An LRU table in a SQLite file shared by processes
+
+    Args:
+        path (str): The path of the SQLite file
+        max_bytes (int): The total size of the entries
+    """
+
+    def __init__(self, path, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_entries_used
+                    ON entries (used);
+                CREATE TABLE IF NOT EXISTS entry_tags (
+                    tag TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    PRIMARY KEY (tag, key)
+                );
+                CREATE INDEX IF NOT EXISTS ix_entry_tags_key
+                    ON entry_tags (key);
+                CREATE TABLE IF NOT EXISTS generation (
+                    generation INTEGER NOT NULL
+                );
+                INSERT INTO generation (generation)
+                    SELECT 0 WHERE NOT EXISTS (SELECT * FROM generation);
+            ''')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection = connection
+        return connection
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    @property
+    def size(self):
+        return self._connect().execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    @property
+    def generation(self):
+        return self._connect().execute(
+            'SELECT generation FROM generation').fetchone()[0]
+
+    def get(self, key):
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                'UPDATE entries SET used = ? WHERE key = ?',
+                (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, value, tags, generation):
+        """Store an entry built at generation, and return the number of
+        evicted entries"""
+        size = _entry_size(key, value)
+        if size > self.max_bytes:
+            return 0
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if connection.execute('SELECT generation FROM generation') \
+                    .fetchone()[0] != generation:
+                return 0
+            self._delete(connection, [key])
+            connection.execute(
+                'INSERT INTO entries (key, value, size, used) '
+                'VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), size, time.time()))
+            connection.executemany(
+                'INSERT INTO entry_tags (tag, key) VALUES (?, ?)',
+                [(tag, key) for tag in tags])
+
+            total = connection.execute(
+                'SELECT SUM(size) FROM entries').fetchone()[0]
+            evicted = []
+            if total > self.max_bytes:
+                for old_key, old_size in connection.execute(
+                        'SELECT key, size FROM entries ORDER BY used'):
+                    evicted.append(old_key)
+                    total -= old_size
+                    if total <= self.max_bytes:
+                        break
+                self._delete(connection, evicted)
+        return len(evicted)
+
+    def invalidate(self, tags):
+        tags = list(tags)
+        with self._connect() as connection:
+            self._bump(connection)
+            keys = [key for key, in connection.execute(
+                'SELECT DISTINCT key FROM entry_tags WHERE tag IN '
+                f'({",".join("?" * len(tags))})', tags)]
+            self._delete(connection, keys)
+
+    def clear(self):
+        with self._connect() as connection:
+            self._bump(connection)
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM entry_tags')
+
+    @staticmethod
+    def _bump(connection):
+        connection.execute(
+            'UPDATE generation SET generation = generation + 1')
+
+    @staticmethod
+    def _delete(connection, keys):
+        connection.executemany(
+            'DELETE FROM entries WHERE key = ?', [(key,) for key in keys])
+        connection.executemany(
+            'DELETE FROM entry_tags WHERE key = ?', [(key,) for key in keys])
+
+
+class ResponseCache:
+    """Cache of encoded pages with hit and miss counters
+
+    Args:
+        backend (obj): a MemoryCacheBackend or a SqliteCacheBackend
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def cached(self, key, tags, build, version):
+        """Get a page from the cache, or build and cache it
+
+        Concurrent misses of key share a single build.
+
+        Args:
+            key (str): The key of the page
+            tags (tuple): Tags invalidating the page
+            build (function): builds the page as a dictionary of
+                field: encoded JSON, or returns None if it mustn't be
+                cached
+            version (int): The version of the questions listed by the
+                page, read by the request before the page is built
+
+        Returns:
+            dict: a dictionary of field: Fragment, or None
+        """
+        key = f'{key}@{version}'
+        generation = self.backend.generation
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            def build_and_store():
+                value = build()
+                if value is not None:
+                    evicted = self.backend.set(key, value, tags, generation)
+                    with self._lock:
+                        self.evictions += evicted
+                return value
+            value = self.flights.do((key, generation), build_and_store)
+            if value is None:
+                return None
+        return {name: Fragment(text) for name, text in value.items()}
+
+    def on_question_change(self, action, old, new):
+        if action == 'reload':
+            self.backend.clear()
+            return
+        tags = {'questions', 'search'}
+        for question in (old, new):
+            if question is not None:
+                tags.add(f'category:{question["category"]}')
+        self.backend.invalidate(tags)
+
+    def collect(self):
+        """Lines of the cache metrics in the Prometheus text format"""
+        lines = []
+        for name, kind, value in (
+                ('trivia_response_cache_hits_total', 'counter', self.hits),
+                ('trivia_response_cache_misses_total', 'counter',
+                 self.misses),
+                ('trivia_response_cache_evictions_total', 'counter',
+                 self.evictions),
+                ('trivia_response_cache_entries', 'gauge', len(self.backend)),
+                ('trivia_response_cache_bytes', 'gauge', self.backend.size)):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return lines + self.flights.collect()
+
+
+def create_response_cache(app):
+    """Create the response cache configured by RESPONSE_CACHE
+
+    Question changes of app invalidate the cache.
+
+    Returns:
+        ResponseCache: the cache
+
+    Raises:
+        ValueError: RESPONSE_CACHE is unknown.
+    """
+    name = app.config.get('RESPONSE_CACHE', 'memory')
+    max_bytes = app.config.get('RESPONSE_CACHE_MAX_BYTES',
+                               RESPONSE_CACHE_MAX_BYTES)
+    if name == 'memory':
+        backend = MemoryCacheBackend(max_bytes)
+    elif name == 'sqlite':
+        backend = SqliteCacheBackend(
+            app.config.get('RESPONSE_CACHE_PATH', os.path.join(
+                tempfile.gettempdir(), 'trivia-response-cache.db')),
+            max_bytes)
+        # entries of the previous run may be stale
+        backend.clear()
+    else:
+        raise ValueError(f'Unknown response cache: {name}')
+
+    cache = ResponseCache(backend)
+    on_question_change(app, cache.on_question_change)
+    return cache
@@ -0,0 +1,341 @@
+"""Question search
+
+Search backends for "/search_questions". A backend finds questions
+whose question or answer text matches a search term, ranks them and
+returns one page of them with the number of all matches.
+
+Both backends match the same questions: a term is split into words of
+letters and digits, every word has to match a whole word of the question
+or the answer, and the last word also matches as a prefix, so that
+search-as-you-type finds words being typed. Words are not stemmed.
+
+- PostgresSearchBackend: a tsvector GIN index of the words, without
+  stemming ('simple'), queried by prefix tsqueries.
+- InvertedIndexSearchBackend: an in-process inverted index built by
+  the first search and kept current by question changes, for SQLite or
+  development deployments. It is rebuilt when the version of the
+  questions table shows changes of other workers.
+"""
+import bisect
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy import func, literal_column, text
+from sqlalchemy.engine.url import make_url
+
+from models import db, Question, TableVersion, on_question_change, \
+    use_primary
+from .conditional import table_versions
+from .serialization import QUESTION_FIELDS, project, question_columns
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+QUESTION_WEIGHT = 2
+ANSWER_WEIGHT = 1
+
+
+def tokenize(text):
+    """Split a text into lower case words of letters and digits"""
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+def prefix_tsquery(tokens):
+    """The tsquery text of tokens, matching the last one as a prefix"""
+    return ' & '.join(tokens[:-1] + [tokens[-1] + ':*'])
+
+
+class SearchBackend:
+    """Base class of search backends"""
+
+    name = None
+
+    def search(self, term, offset, limit, fields=QUESTION_FIELDS):
+        """Search questions
+
+        Args:
+            term (str): The search term
+            offset (int): The number of ranked matches to skip
+            limit (int): The maximum number of questions to return
+            fields (tuple): The selected question fields, starting with
+                the id
+
+        Returns:
+            tuple: a list of question rows of fields and the number of
+                all matched questions
+        """
+        raise NotImplementedError
+
+    def ensure_indexes(self):
+        """Create the indexes of the backend if they don't exist"""
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Prefix search on a Postgres full-text index
+
+    Punctuation is replaced by spaces before the text is parsed, so that
+    Postgres splits numbers, e-mails and paths into the words tokenize()
+    finds. Matches are ranked by ts_rank, words of the question text
+    weighing more than of the answer.
+    """
+
+    name = 'postgres'
+    config = 'simple'
+    WORD_SEPARATORS = '[^[:alnum:]]+'
+    # ts_rank weights of the labels D, C, B (answer) and A (question)
+    WEIGHTS = literal_column("'{0.1, 0.2, 0.5, 1.0}'::float4[]")
+
+    INDEXES = (
+        "DROP INDEX IF EXISTS ix_questions_document",
+        "DROP INDEX IF EXISTS ix_questions_question_trgm",
+        "CREATE INDEX IF NOT EXISTS ix_questions_words ON questions "
+        "USING GIN (to_tsvector('simple', regexp_replace("
+        "coalesce(question, '') || ' ' || coalesce(answer, ''), "
+        "'[^[:alnum:]]+', ' ', 'g')))",
+    )
+
+    def ensure_indexes(self):
+        """Create the search indexes if they don't exist"""
+        with db.engine.begin() as connection:
+            for statement in self.INDEXES:
+                connection.execute(text(statement))
+
+    def words(self, text):
+        return func.to_tsvector(self.config, func.regexp_replace(
+            text, self.WORD_SEPARATORS, ' ', 'g'))
+
+    def document(self):
+        # the expression of the ix_questions_words index
+        return self.words(
+            func.coalesce(Question.question, '') + ' '
+            + func.coalesce(Question.answer, ''))
+
+    def ranked_document(self):
+        return func.setweight(
+            self.words(func.coalesce(Question.question, '')), 'A'
+        ).op('||')(func.setweight(
+            self.words(func.coalesce(Question.answer, '')), 'B'))
+
+    def search(self, term, offset, limit, fields=QUESTION_FIELDS):
+        tokens = tokenize(term)
+        if not tokens:
+            return [], 0
+
+        query = func.to_tsquery(self.config, prefix_tsquery(tokens))
+        selection = Question.query.filter(self.document().op('@@')(query))
+
+        total = selection.with_entities(func.count(Question.id)).scalar()
+        questions = selection.with_entities(
+            *question_columns(fields)).order_by(
+            func.ts_rank(self.WEIGHTS, self.ranked_document(), query).desc(),
+            Question.id
+        ).offset(offset).limit(limit).all()
+        return questions, total
+
+
+class InvertedIndexSearchBackend(SearchBackend):
+    """In-process inverted index over question and answer text
+
+    Matches are ranked by the weight of matched tokens, tokens
+    in the question text weighing more than in the answer.
+
+    The index is built by the first search, so that starting an app
+    doesn't read all questions. Changes of this worker are applied to
+    the index, and it is rebuilt when a search reads a version of the
+    questions table past the version of the index.
+
+    Args:
+        read_model (function): returns the QuestionReadModel of the
+            rows of matched questions, or None to read them from the
+            database
+    """
+
+    name = 'memory'
+
+    def __init__(self, read_model=None):
+        self.read_model = read_model
+        self.built = False
+        self.version = None
+        self._postings = defaultdict(dict)
+        self._tokens = {}
+        self._vocabulary = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def build(self, version=None):
+        """Index all questions in the primary database
+
+        Args:
+            version (int): The version of the questions table read
+                before, if any. It is read before the questions
+                otherwise, so that the index is at least as recent as
+                its version.
+        """
+        use_primary()
+        if version is None:
+            version = TableVersion.get(Question.__tablename__)[
+                Question.__tablename__]
+        rows = Question.query.with_entities(
+            Question.id, Question.question, Question.answer)
+        with self._lock:
+            self._postings.clear()
+            self._tokens.clear()
+            for question_id, question, answer in rows:
+                self._add(question_id, question, answer)
+            self.built = True
+            self.version = version
+
+    def _behind(self, version):
+        return not self.built \
+            or (version is not None and version > self.version)
+
+    def ensure_built(self, version=None):
+        """Build the index unless it is built already, at version or
+        later if version is given"""
+        if self._behind(version):
+            with self._build_lock:
+                if self._behind(version):
+                    self.build(version)
+
+    def add(self, question):
+        """Index a formatted question"""
+        with self._lock:
+            self._remove(question['id'])
+            self._add(question['id'], question['question'],
+                      question['answer'])
+
+    def remove(self, question_id):
+        """Drop a question from the index"""
+        with self._lock:
+            self._remove(question_id)
+
+    def on_question_change(self, action, old, new):
+        if not self.built:
+            return
+        if action == 'reload':
+            self.build()
+            return
+        version = TableVersion.bumped(Question.__tablename__)
+        with self._lock:
+            if old is not None:
+                self._remove(old['id'])
+            if new is not None:
+                self._remove(new['id'])
+                self._add(new['id'], new['question'], new['answer'])
+            # move along unless another worker changed the questions
+            # before, as the read model does
+            if version is not None and version == self.version + 1:
+                self.version = version
+
+    def _add(self, question_id, question, answer):
+        weights = defaultdict(int)
+        for token in tokenize(question):
+            weights[token] += QUESTION_WEIGHT
+        for token in tokenize(answer):
+            weights[token] += ANSWER_WEIGHT
+        for token, weight in weights.items():
+            if token not in self._postings:
+                self._vocabulary = None
+            self._postings[token][question_id] = weight
+        self._tokens[question_id] = list(weights)
+
+    def _remove(self, question_id):
+        for token in self._tokens.pop(question_id, ()):
+            postings = self._postings[token]
+            postings.pop(question_id, None)
+            if not postings:
+                del self._postings[token]
+                self._vocabulary = None
+
+    def _prefixed(self, prefix):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        for token in self._vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            yield token
+
+    def _match(self, tokens):
+        scores = None
+        for i, token in enumerate(tokens):
+            if i == len(tokens) - 1:
+                candidates = defaultdict(int)
+                for prefixed in self._prefixed(token):
+                    for question_id, weight in \
+                            self._postings[prefixed].items():
+                        candidates[question_id] += weight
+            else:
+                candidates = self._postings.get(token, {})
+
+            if scores is None:
+                scores = dict(candidates)
+            else:
+                scores = {
+                    question_id: score + candidates[question_id]
+                    for question_id, score in scores.items()
+                    if question_id in candidates
+                }
+            if not scores:
+                break
+        return scores or {}
+
+    def search(self, term, offset, limit, fields=QUESTION_FIELDS):
+        tokens = tokenize(term)
+        if not tokens:
+            return [], 0
+
+        self.ensure_built(
+            table_versions(Question.__tablename__)[Question.__tablename__])
+        with self._lock:
+            scores = self._match(tokens)
+        ranked = sorted(scores, key=lambda question_id: (
+            -scores[question_id], question_id))
+        page = ranked[offset:offset + limit]
+        if not page:
+            return [], len(ranked)
+
+        model = self.read_model and self.read_model()
+        if model is not None:
+            return project(model.rows(page), fields), len(ranked)
+
+        questions = Question.query.with_entities(*question_columns(fields)) \
+            .filter(Question.id.in_(page)).all()
+        questions = {question[0]: question for question in questions}
+        return [
+            questions[question_id]
+            for question_id in page if question_id in questions
+        ], len(ranked)
+
+
+def create_search_backend(app, read_model=None):
+    """Create the search backend of an app
+
+    The backend is selected by app.config['SEARCH_BACKEND'], either
+    'postgres' or 'memory'. By default, 'postgres' is used on Postgres,
+    and 'memory' on other databases, with or without the read model.
+    Nothing is read from the database here; the indexes of the backend
+    are created by `flask init-db`.
+
+    Args:
+        app (obj): a Flask app bound to the database by setup_db
+        read_model (function): returns the QuestionReadModel serving
+            the current request, or None. Only for the 'memory' backend.
+
+    Returns:
+        SearchBackend: the search backend
+    """
+    name = app.config.get('SEARCH_BACKEND')
+    if name is None:
+        backend_name = make_url(
+            app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+        name = 'postgres' if backend_name in ('postgres', 'postgresql') \
+            else 'memory'
+
+    if name == PostgresSearchBackend.name:
+        backend = PostgresSearchBackend()
+    elif name == InvertedIndexSearchBackend.name:
+        backend = InvertedIndexSearchBackend(read_model)
+        on_question_change(app, backend.on_question_change)
+    else:
+        raise ValueError(f'Unknown search backend: {name}')
+    return backend
@@ -0,0 +1,204 @@
+"""Lean serialization of questions
+
+List endpoints select questions as column tuples instead of hydrating
+Question objects, and encode them without building a dictionary per
+question through Question.format(). A "?fields=" projection selects
+and encodes only the requested columns.
+
+JSON backends:
+- 'json' (default): the standard library encoder with a precompiled
+  template per projection. Responses are byte-identical to jsonify.
+- 'orjson': orjson, if it is installed. Responses have the same shape
+  and sorted keys, but non-ASCII characters are not escaped.
+"""
+import json
+from json.encoder import encode_basestring_ascii
+
+from flask import current_app, jsonify
+
+from models import Question
+
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = tuple(
+    getattr(Question, field) for field in QUESTION_FIELDS)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Fragment:
+    """Already encoded JSON embedded in a payload"""
+
+    __slots__ = ('json',)
+
+    def __init__(self, json):
+        self.json = json
+
+
+def _encode_value(value):
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    if type(value) is int:
+        return int.__repr__(value)
+    if value is None:
+        return 'null'
+    return json.dumps(value)
+
+
+def compile_row_encoder(fields):
+    """Compile an encoder of rows of fields into JSON objects
+
+    Keys are sorted and separators are compact, as jsonify does.
+
+    Args:
+        fields (tuple): field names in the order of the row columns
+
+    Returns:
+        function: an encoder of a row into a JSON object string
+    """
+    order = sorted(range(len(fields)), key=lambda i: fields[i])
+    template = '{' + ','.join(
+        f'{encode_basestring_ascii(fields[i])}:%s' for i in order) + '}'
+
+    def encode(row):
+        return template % tuple(_encode_value(row[i]) for i in order)
+    return encode
+
+
+def parse_fields(value):
+    """Parse a "?fields=" projection of question fields
+
+    The id is always included, because it is the key of a question and
+    the pagination cursor.
+
+    Args:
+        value (str): comma separated field names, or None
+
+    Returns:
+        tuple: the fields in the order of QUESTION_FIELDS,
+            QUESTION_FIELDS if value is None
+
+    Raises:
+        ValueError: A field is unknown.
+    """
+    if value is None:
+        return QUESTION_FIELDS
+    fields = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = fields.difference(QUESTION_FIELDS)
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    fields.add('id')
+    return tuple(field for field in QUESTION_FIELDS if field in fields)
+
+
+def question_columns(fields):
+    """The Question columns of fields"""
+    if fields == QUESTION_FIELDS:
+        return QUESTION_COLUMNS
+    return tuple(getattr(Question, field) for field in fields)
+
+
+def project(rows, fields):
+    """Project rows of QUESTION_COLUMNS onto fields"""
+    if fields == QUESTION_FIELDS:
+        return rows
+    indexes = [QUESTION_FIELDS.index(field) for field in fields]
+    return [tuple(row[i] for i in indexes) for row in rows]
+
+
+class JsonBackend:
+    """Encoding of payloads whose values may be already encoded"""
+
+    def dumps(self, payload):
+        return '{' + ','.join(
+            encode_basestring_ascii(key) + ':' + (
+                value.json if isinstance(value, Fragment)
+                else self.encode(value)
+            )
+            for key, value in sorted(payload.items())
+        ) + '}\n'
+
+
+class StdlibJsonBackend(JsonBackend):
+    """JSON with the standard library and precompiled row templates"""
+
+    name = 'json'
+
+    def __init__(self):
+        # row encoder per tuple of fields
+        self._encoders = {}
+
+    def encoder(self, fields):
+        encode_row = self._encoders.get(fields)
+        if encode_row is None:
+            encode_row = self._encoders[fields] = compile_row_encoder(fields)
+        return encode_row
+
+    def encode(self, value):
+        return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+    def row(self, row, fields=QUESTION_FIELDS):
+        return Fragment(self.encoder(fields)(row))
+
+    def rows(self, rows, fields=QUESTION_FIELDS):
+        return Fragment(
+            '[' + ','.join(map(self.encoder(fields), rows)) + ']')
+
+
+class OrjsonBackend(JsonBackend):
+    """JSON with orjson"""
+
+    name = 'orjson'
+
+    def encode(self, value):
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS).decode()
+
+    def row(self, row, fields=QUESTION_FIELDS):
+        return Fragment(self.encode(dict(zip(fields, row))))
+
+    def rows(self, rows, fields=QUESTION_FIELDS):
+        return Fragment(self.encode([dict(zip(fields, row)) for row in rows]))
+
+
+def create_json_backend(name='json'):
+    """Create the JSON backend selected by name
+
+    Raises:
+        ValueError: The backend is unknown or not installed.
+    """
+    if name == StdlibJsonBackend.name:
+        return StdlibJsonBackend()
+    if name == OrjsonBackend.name:
+        if orjson is None:
+            raise ValueError('The orjson JSON backend is not installed.')
+        return OrjsonBackend()
+    raise ValueError(f'Unknown JSON backend: {name}')
+
+
+def _decode(value):
+    if isinstance(value, Fragment):
+        return json.loads(value.json)
+    return value
+
+
+def json_response(backend, payload):
+    """Make a JSON response of a payload with the JSON backend
+
+    Pretty printed responses, in debug mode for example, are left to
+    jsonify.
+
+    Args:
+        backend (obj): a JSON backend
+        payload (dict): the response body, whose values may be
+            encoded by backend.row() or backend.rows()
+
+    Returns:
+        obj: a response object
+    """
+    app = current_app
+    if app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug:
+        return jsonify({key: _decode(value) for key, value in payload.items()})
+    return app.response_class(
+        backend.dumps(payload), mimetype=app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,89 @@
+"""Single-flight request coalescing
+
+When many clients ask for the same page at the same moment, after a
+content update for example, only the first of them builds it. The
+others wait for that build and share its result instead of running the
+same queries again.
+"""
+import threading
+
+
+class _Flight:
+    """A call in progress and its outcome"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalescing of concurrent calls with the same key
+
+    Attributes:
+        executed (int): The number of calls which ran their function
+        coalesced (int): The number of calls which shared the result of
+            a call in progress
+    """
+
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, function):
+        """Call function, unless a call with key is in progress, and
+        return its result
+
+        A call in progress is joined, and its result, or its exception,
+        is shared with the joining calls.
+
+        Args:
+            key (obj): A hashable key of the call, such as the cache key
+                and the version of the data
+            function (function): builds the result
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = _Flight()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leading:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def collect(self):
+        """Lines of the coalescing metrics in the Prometheus text format"""
+        lines = []
+        for name, kind, value in (
+                ('trivia_single_flight_executed_total', 'counter',
+                 self.executed),
+                ('trivia_single_flight_coalesced_total', 'counter',
+                 self.coalesced),
+                ('trivia_single_flight_in_flight', 'gauge', len(self))):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return lines
@@ -0,0 +1,246 @@
+'''Versioned schema migrations
+
+init_db, run by `flask init-db`, upgrades the primary database to the
+latest version. The version is kept in the schema_version table, and
+every migration runs in its own transaction together with the version
+bump.
+Migrations are idempotent, so databases created before versioning, by
+db.create_all() or from trivia.psql, are upgraded from version 0.
+
+Upgrade a database by hand with
+
+    $ python migrations.py postgres://trivia@localhost:5432/trivia
+'''
+
+import sys
+from sqlalchemy import Boolean, Column, DateTime, Integer, MetaData, \
+    String, Table, create_engine, inspect
+
+# key of the advisory lock serializing concurrent upgrades on Postgres
+MIGRATION_LOCK_KEY = 20200414
+
+metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', metadata,
+    Column('version', Integer, nullable=False),
+)
+
+
+def _tables_v1(metadata):
+    '''the tables as created by db.create_all() before versioning'''
+    Table(
+        'categories', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('type', String),
+    )
+    Table(
+        'questions', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('question', String),
+        Column('answer', String),
+        Column('category', String),
+        Column('difficulty', Integer),
+    )
+    Table(
+        'table_versions', metadata,
+        Column('name', String, primary_key=True),
+        Column('version', Integer, nullable=False, default=0),
+    )
+    _question_counts(metadata, String)
+    return metadata
+
+
+def _question_counts(metadata, category_type):
+    return Table(
+        'question_counts', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('category', category_type),
+        Column('difficulty', Integer),
+        Column('count', Integer, nullable=False, default=0),
+    )
+
+
+def create_tables(connection):
+    '''create the tables which don't exist yet'''
+    _tables_v1(MetaData()).create_all(connection, checkfirst=True)
+
+
+def _has_category_foreign_key(inspector):
+    return any(
+        foreign_key['constrained_columns'] == ['category']
+        and foreign_key['referred_table'] == 'categories'
+        for foreign_key in inspector.get_foreign_keys('questions')
+    )
+
+
+def integer_category(connection):
+    '''change questions.category into an integer foreign key to
+    categories.id
+
+    Categories which don't exist are set to NULL. question_counts is
+    recreated with an integer category and rebuilt by init_db.
+    '''
+    inspector = inspect(connection)
+    category_type = next(
+        column['type'] for column in inspector.get_columns('questions')
+        if column['name'] == 'category')
+    is_integer = isinstance(category_type, Integer)
+    has_foreign_key = _has_category_foreign_key(inspector)
+
+    if connection.dialect.name == 'postgresql':
+        if not is_integer:
+            connection.execute(
+                "UPDATE questions SET category = NULL "
+                "WHERE category !~ '^[0-9]{1,9}$'")
+            connection.execute(
+                'ALTER TABLE questions ALTER COLUMN category '
+                'TYPE integer USING category::integer')
+        if not has_foreign_key:
+            connection.execute(
+                'UPDATE questions SET category = NULL '
+                'WHERE category NOT IN (SELECT id FROM categories)')
+            connection.execute(
+                'ALTER TABLE questions ADD CONSTRAINT '
+                'questions_category_fkey FOREIGN KEY (category) '
+                'REFERENCES categories (id) '
+                'ON UPDATE CASCADE ON DELETE SET NULL')
+    elif not (is_integer and has_foreign_key):
+        # SQLite can't alter columns, so the table is rebuilt
+        connection.execute(
+            'CREATE TABLE questions_migrating ('
+            'id INTEGER NOT NULL PRIMARY KEY, '
+            'question VARCHAR, '
+            'answer VARCHAR, '
+            'category INTEGER REFERENCES categories (id) '
+            'ON UPDATE CASCADE ON DELETE SET NULL, '
+            'difficulty INTEGER)')
+        connection.execute(
+            'INSERT INTO questions_migrating '
+            '(id, question, answer, category, difficulty) '
+            'SELECT id, question, answer, ('
+            'SELECT categories.id FROM categories '
+            'WHERE categories.id = CAST(questions.category AS INTEGER)'
+            '), difficulty FROM questions')
+        connection.execute('DROP TABLE questions')
+        connection.execute(
+            'ALTER TABLE questions_migrating RENAME TO questions')
+
+    question_counts = _question_counts(MetaData(), Integer)
+    question_counts.drop(connection, checkfirst=True)
+    question_counts.create(connection)
+
+
+def category_indexes(connection):
+    '''index questions by (category, id) for category browsing and by
+    (category, difficulty) for quizzes and counts'''
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_id '
+        'ON questions (category, id)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty '
+        'ON questions (category, difficulty)')
+
+
+def quiz_events(connection):
+    '''create the quiz_events table of answered quiz questions'''
+    Table(
+        'quiz_events', MetaData(),
+        Column('id', Integer, primary_key=True),
+        Column('question_id', Integer, nullable=False, index=True),
+        Column('correct', Boolean, nullable=False),
+        Column('created_at', DateTime, nullable=False),
+    ).create(connection, checkfirst=True)
+
+
+# the key of a question count; NULLs are coalesced, so that a question
+# without a category has a single count, too
+QUESTION_COUNT_KEY = 'coalesce(category, -1), coalesce(difficulty, -1)'
+
+
+def unique_question_counts(connection):
+    '''merge duplicate question counts and index question_counts by
+    (category, difficulty) uniquely, so that counts are upserted'''
+    first_ids = (
+        f'SELECT min(id) FROM question_counts GROUP BY {QUESTION_COUNT_KEY}')
+    connection.execute(
+        'UPDATE question_counts SET count = ('
+        'SELECT sum(duplicate.count) FROM question_counts AS duplicate '
+        'WHERE coalesce(duplicate.category, -1) = '
+        'coalesce(question_counts.category, -1) '
+        'AND coalesce(duplicate.difficulty, -1) = '
+        'coalesce(question_counts.difficulty, -1)) '
+        f'WHERE id IN ({first_ids})')
+    connection.execute(
+        f'DELETE FROM question_counts WHERE id NOT IN ({first_ids})')
+    connection.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_question_counts_key '
+        f'ON question_counts ({QUESTION_COUNT_KEY})')
+
+
+# (version, description, migration) in the order they are applied
+MIGRATIONS = (
+    (1, 'create tables', create_tables),
+    (2, 'integer foreign key questions.category', integer_category),
+    (3, 'indexes on questions (category, id) and (category, difficulty)',
+     category_indexes),
+    (4, 'quiz_events table', quiz_events),
+    (5, 'unique index on question_counts (category, difficulty)',
+     unique_question_counts),
+)
+
+
+def latest_version():
+    '''the version of the latest migration'''
+    return MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    '''the schema version of a database, 0 if it isn't versioned'''
+    if not connection.dialect.has_table(connection, 'schema_version'):
+        return 0
+    version = connection.execute(schema_version.select()).scalar()
+    return version or 0
+
+
+def _set_version(connection, version):
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def upgrade(engine, target=None):
+    '''apply the pending migrations up to target, the latest by default
+
+    Returns the versions which are applied.
+    '''
+    if target is None:
+        target = latest_version()
+    with engine.connect() as connection:
+        if current_version(connection) >= target:
+            return []
+
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version > target:
+            break
+        with engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                connection.execute(
+                    f'SELECT pg_advisory_xact_lock({MIGRATION_LOCK_KEY})')
+            schema_version.create(connection, checkfirst=True)
+            if current_version(connection) >= version:
+                continue
+            migrate(connection)
+            _set_version(connection, version)
+        applied.append(version)
+    return applied
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(f'usage: {sys.argv[0]} DATABASE_PATH')
+    engine = create_engine(sys.argv[1])
+    for version in upgrade(engine):
+        print(f'applied {version}: {MIGRATIONS[version - 1][1]}')
+    with engine.connect() as connection:
+        print(f'schema version {current_version(connection)}')
@@ -1,9 +1,17 @@
 # FLASK_APP=flaskr FLASK_ENV=development flask run
 
-import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
-import json
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, \
+    String, Integer, case, func, inspect, orm
+from sqlalchemy.sql.dml import UpdateBase
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+
+from migrations import QUESTION_COUNT_KEY, upgrade
+
+CATEGORY_CACHE_TTL = 300
 
 database_name = "trivia"
 database_path = "postgres://{}:{}@{}/{}".format(
@@ -13,30 +21,152 @@ database_path = "postgres://{}:{}@{}/{}".format(
     database_name
 )
 
-db = SQLAlchemy()
+REPLICA_BIND_PREFIX = 'replica'
+
+# dialects upserting on a primary key or unique index
+UPSERT_DIALECTS = ('postgresql', 'sqlite')
+
+
+class RoutingSession(SignallingSession):
+    '''RoutingSession
+
+    Session sending reads to a replica and writes to the primary. Once
+    the session writes, or use_primary is set, every following read in
+    the session goes to the primary as well, so a request reads its own
+    writes.
+    '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.use_primary = False
+        SignallingSession.__init__(self, db, **options)
 
+    def get_bind(self, mapper=None, clause=None):
+        replicas = replica_binds(self.app)
+        writing = self._flushing or isinstance(clause, UpdateBase) \
+            or (mapper is None and clause is None)
+        if writing:
+            self.use_primary = True
+        if self.use_primary or not replicas:
+            return SignallingSession.get_bind(self, mapper, clause)
+        return self.db.get_engine(self.app, bind=random.choice(replicas))
 
-def setup_db(app, database_path=database_path):
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''SQLAlchemy with RoutingSession'''
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+def setup_db(app, database_path=database_path, replica_paths=(),
+             pool_size=None, max_overflow=None, pool_pre_ping=True,
+             statement_timeout=None):
     '''setup_db(app)
     binds a flask application and a SQLAlchemy service
+
+    database_path is the primary database taking writes, and reads are
+    spread over replica_paths if there are any. pool_size, max_overflow
+    and pool_pre_ping configure the connection pools, and
+    statement_timeout (milliseconds) limits statements on Postgres.
+
+    Nothing is sent to the database here, and engines are created on
+    their first use. The schema is created by init_db().
     '''
 
+    engine_options = {'pool_pre_ping': pool_pre_ping}
+    if pool_size is not None:
+        engine_options['pool_size'] = pool_size
+    if max_overflow is not None:
+        engine_options['max_overflow'] = max_overflow
+    if statement_timeout is not None and database_path.startswith('postgres'):
+        engine_options['connect_args'] = {
+            'options': f'-c statement_timeout={int(statement_timeout)}'
+        }
+
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = {
+        f'{REPLICA_BIND_PREFIX}{i}': replica_path
+        for i, replica_path in enumerate(replica_paths)
+    }
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
-    db.create_all()
+    category_cache.invalidate()
+
+
+def init_db():
+    '''init_db()
+    creates or upgrades the schema of the primary database, and builds
+    the question counts and table versions if they are missing. It is
+    run once per database by `flask init-db`, not per app instance.
+
+    Returns the versions of the applied migrations.
+    '''
+
+    applied = upgrade(db.engine)
+    use_primary()
+    QuestionCount.ensure()
+    TableVersion.ensure(Question.__tablename__, Category.__tablename__)
+    db.session.remove()
+    category_cache.invalidate()
+    return applied
+
+
+def use_primary():
+    '''route the rest of the current session to the primary'''
+
+    db.session().use_primary = True
+
+
+def replica_binds(app):
+    '''bind keys of the replicas of app'''
+
+    return [
+        bind for bind in app.config.get('SQLALCHEMY_BINDS') or ()
+        if bind.startswith(REPLICA_BIND_PREFIX)
+    ]
+
+
+def on_question_change(app, listener):
+    '''on_question_change(app, listener)
+    registers listener(action, old, new) on app, called after a question
+    change is committed. action is 'insert', 'update' or 'delete', and
+    old and new are formatted questions, or None. action is 'reload'
+    when many questions are changed at once, and listeners should
+    reload what they keep from the database.
+    '''
+
+    app.extensions.setdefault('question_listeners', []).append(listener)
+    return listener
+
+
+def notify_question_change(action, old=None, new=None):
+    '''call the question change listeners of the current app'''
+
+    app = db.get_app()
+    for listener in app.extensions.get('question_listeners', ()):
+        listener(action, old, new)
 
 
 class Question(db.Model):
     '''Question'''
 
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey(
+        'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -46,15 +176,115 @@ class Question(db.Model):
         self.difficulty = difficulty
 
     def insert(self):
+        QuestionCount.adjust(*self.count_key(), 1)
+        self.bump_versions(self.category)
         db.session.add(self)
         db.session.commit()
+        notify_question_change('insert', new=self.format())
 
     def update(self):
+        old = self.committed_format()
+        old_key = QuestionCount.key(old['category'], old['difficulty'])
+        new_key = self.count_key()
+        if old_key != new_key:
+            QuestionCount.adjust(*old_key, -1)
+            QuestionCount.adjust(*new_key, 1)
+        self.bump_versions(old['category'], self.category)
         db.session.commit()
+        notify_question_change('update', old=old, new=self.format())
 
     def delete(self):
+        old = self.committed_format()
+        QuestionCount.adjust(old['category'], old['difficulty'], -1)
+        self.bump_versions(old['category'])
         db.session.delete(self)
         db.session.commit()
+        notify_question_change('delete', old=old)
+
+    @classmethod
+    def delete_many(cls, ids):
+        '''delete the questions of ids with a single statement
+
+        Returns the deleted questions, formatted.
+        '''
+        old = cls._select_for_update(ids)
+        if old:
+            db.session.execute(cls.__table__.delete().where(
+                cls.id.in_([question['id'] for question in old])))
+            QuestionCount.adjust_many(old=old)
+            cls.bump_versions(*[question['category'] for question in old])
+        db.session.commit()
+        for question in old:
+            notify_question_change('delete', old=question)
+        return old
+
+    @classmethod
+    def update_many(cls, ids, values):
+        '''set values, a dictionary of column: value, on the questions of
+        ids with a single statement
+
+        Returns the updated questions, formatted.
+        '''
+        old = cls._select_for_update(ids)
+        new = [dict(question, **values) for question in old]
+        if old:
+            db.session.execute(cls.__table__.update().where(
+                cls.id.in_([question['id'] for question in old])
+            ).values(**values))
+            QuestionCount.adjust_many(old=old, new=new)
+            cls.bump_versions(*[
+                question['category'] for question in old + new])
+        db.session.commit()
+        for old_question, new_question in zip(old, new):
+            notify_question_change(
+                'update', old=old_question, new=new_question)
+        return new
+
+    @classmethod
+    def category_version_name(cls, category_id):
+        '''the TableVersion name of the questions of a category'''
+        return f'{cls.__tablename__}:category:{int(category_id)}'
+
+    @classmethod
+    def bump_versions(cls, *categories):
+        '''bump the version of the questions table and of the questions
+        of each of categories in the current session
+
+        The category rows are bumped in id order, so that concurrent
+        changes lock them in the same order.
+        '''
+        TableVersion.bump(cls.__tablename__, *[
+            cls.category_version_name(category) for category in sorted({
+                int(category) for category in categories
+                if category is not None
+            })
+        ])
+
+    @classmethod
+    def _select_for_update(cls, ids):
+        columns = (cls.id, cls.question, cls.answer, cls.category,
+                   cls.difficulty)
+        rows = db.session.query(*columns).filter(cls.id.in_(ids)) \
+            .order_by(cls.id).with_for_update().all()
+        return [
+            {column.key: value for column, value in zip(columns, row)}
+            for row in rows
+        ]
+
+    def count_key(self):
+        '''(category, difficulty) of the question in QuestionCount'''
+        return QuestionCount.key(self.category, self.difficulty)
+
+    def committed_format(self):
+        '''format() with the values stored in the database instead of
+        pending changes'''
+        question = self.format()
+        state = inspect(self)
+        for attr in question:
+            history = state.attrs[attr].load_history()
+            if history.deleted:
+                question[attr] = history.deleted[0]
+        return question
 
     def format(self):
         return {
@@ -77,8 +307,324 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        TableVersion.bump(self.__tablename__)
+        db.session.add(self)
+        db.session.commit()
+        category_cache.invalidate()
+
+    def update(self):
+        TableVersion.bump(self.__tablename__)
+        db.session.commit()
+        category_cache.invalidate()
+
+    def delete(self):
+        TableVersion.bump(self.__tablename__)
+        db.session.delete(self)
+        db.session.commit()
+        category_cache.invalidate()
+
     def format(self):
         return {
             'id': self.id,
             'type': self.type
         }
+
+
+class QuizEvent(db.Model):
+    '''QuizEvent
+
+    An answer to a quiz question. Events are written in batches by the
+    quiz event writer, instead of a commit per answer.
+    '''
+
+    __tablename__ = 'quiz_events'
+
+    id = Column(Integer, primary_key=True)
+    question_id = Column(Integer, nullable=False, index=True)
+    correct = Column(Boolean, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    @classmethod
+    def insert_many(cls, events):
+        '''insert events, dictionaries of column: value, with a single
+        multi-row statement'''
+        db.session.execute(cls.__table__.insert().values(events))
+        db.session.commit()
+
+    @classmethod
+    def correct_rates(cls, category=None):
+        '''a dictionary of question id: (answers, correct answers) of
+        the existing questions, in category if it is given'''
+        selection = db.session.query(
+            cls.question_id,
+            func.count(cls.id),
+            func.sum(case([(cls.correct, 1)], else_=0)),
+        ).join(Question, Question.id == cls.question_id)
+        if category is not None:
+            selection = selection.filter(Question.category == category)
+        rows = selection.group_by(cls.question_id).order_by(cls.question_id)
+        return {
+            question_id: (answers, correct)
+            for question_id, answers, correct in rows
+        }
+
+
+class TableVersion(db.Model):
+    '''TableVersion
+
+    Change version of a table. Every change of questions or categories
+    bumps the version of its table in the same transaction, so readers
+    can tell whether the table has changed from a single small row.
+    Question changes bump the questions of their categories as well, in
+    rows named by Question.category_version_name().
+    '''
+
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def bump(cls, name, *others):
+        '''increase the versions of name and of the distinct others in the
+        current session, and return the new version of name, which
+        bumped() returns as well
+
+        The rows are upserted in a single statement on Postgres and
+        SQLite, so that concurrent first bumps of a name add up in a
+        single row.
+        '''
+        table = cls.__table__
+        names = (name,) + others
+        if db.session.connection().dialect.name in UPSERT_DIALECTS:
+            db.session.execute(
+                f'INSERT INTO {cls.__tablename__} (name, version) VALUES '
+                + ', '.join(f'(:name{i}, 1)' for i in range(len(names)))
+                + ' ON CONFLICT (name) DO UPDATE SET version = '
+                f'{cls.__tablename__}.version + 1',
+                {f'name{i}': bumped for i, bumped in enumerate(names)})
+        else:
+            for bumped in names:
+                result = db.session.execute(
+                    table.update()
+                    .where(table.c.name == bumped)
+                    .values(version=table.c.version + 1)
+                )
+                if result.rowcount == 0:
+                    db.session.execute(
+                        table.insert().values(name=bumped, version=1))
+        version = db.session.query(cls.version) \
+            .filter(cls.name == name).scalar()
+        db.session.info.setdefault('bumped_versions', {})[name] = version
+        return version
+
+    @classmethod
+    def bumped(cls, name):
+        '''the version the last bump of the current session set, so that
+        question listeners can tell their own change from the others'''
+        return db.session.info.get('bumped_versions', {}).get(name)
+
+    @classmethod
+    def get(cls, *names):
+        '''a dictionary of table name: version'''
+        versions = dict.fromkeys(names, 0)
+        versions.update(
+            db.session.query(cls.name, cls.version)
+            .filter(cls.name.in_(names)).all())
+        return versions
+
+    @classmethod
+    def ensure(cls, *names):
+        '''create the version rows of tables which don't have one'''
+        existing = {name for name, in db.session.query(cls.name)}
+        for name in names:
+            if name not in existing:
+                db.session.add(cls(name=name, version=0))
+        db.session.commit()
+
+
+class CategoryCache:
+    '''CategoryCache
+
+    Read-through cache of all categories keyed by id. The whole table
+    is loaded at once, so a missing category is answered without a
+    query as well. version is the version of the categories table the
+    cache is loaded at. The cache is reloaded when refresh() is given a
+    later version, such as after a change of another worker, after ttl
+    seconds, or right away when Category.insert, update or delete
+    invalidates it.
+    '''
+
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self.version = None
+        self._categories = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self, version=None):
+        with self._lock:
+            expired = time.monotonic() - self._loaded_at > self.ttl
+            behind = version is not None \
+                and (self.version is None or version > self.version)
+            if self._categories is None or expired or behind:
+                if version is None:
+                    # read before the rows, so that the rows are at
+                    # least as recent as their version
+                    version = TableVersion.get(Category.__tablename__)[
+                        Category.__tablename__]
+                rows = db.session.query(Category.id, Category.type) \
+                    .order_by(Category.id).all()
+                self._categories = OrderedDict(rows)
+                self._loaded_at = time.monotonic()
+                self.version = version
+            return self._categories
+
+    def refresh(self, version):
+        '''reload the categories if version, a version of the categories
+        table read before, is past the version of the cache'''
+        self._load(version)
+
+    def get(self, category_id):
+        '''the type of a category, or None if there is no such a category'''
+        try:
+            category_id = int(category_id)
+        except (TypeError, ValueError):
+            return None
+        return self._load().get(category_id)
+
+    def types(self):
+        '''a list of all categories' type ordered by id'''
+        return list(self._load().values())
+
+    def invalidate(self):
+        '''drop the cached categories so that the next read reloads them'''
+        with self._lock:
+            self._categories = None
+
+
+category_cache = CategoryCache()
+
+
+class QuestionCount(db.Model):
+    '''QuestionCount
+
+    Number of questions per (category, difficulty). Question.insert,
+    update and delete adjust it in their own transaction, so totals are
+    read from a handful of rows instead of the questions table.
+    '''
+
+    __tablename__ = 'question_counts'
+
+    id = Column(Integer, primary_key=True)
+    category = Column(Integer)
+    difficulty = Column(Integer)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_question_counts_key', func.coalesce(category, -1),
+              func.coalesce(difficulty, -1), unique=True),
+    )
+
+    @staticmethod
+    def key(category, difficulty):
+        '''normalize (category, difficulty) to the column types'''
+        if category is not None:
+            category = int(category)
+        if difficulty is not None:
+            difficulty = int(difficulty)
+        return category, difficulty
+
+    @classmethod
+    def adjust(cls, category, difficulty, delta):
+        '''add delta to the count of (category, difficulty)
+
+        The change is executed in the current session and committed with
+        the question change itself. The count is upserted on Postgres
+        and SQLite, so that concurrent first changes of a key add up in
+        a single row.
+        '''
+        table = cls.__table__
+        category, difficulty = cls.key(category, difficulty)
+        if db.session.connection().dialect.name in UPSERT_DIALECTS:
+            db.session.execute(
+                f'INSERT INTO {cls.__tablename__} '
+                '(category, difficulty, count) '
+                'VALUES (:category, :difficulty, :delta) '
+                f'ON CONFLICT ({QUESTION_COUNT_KEY}) '
+                f'DO UPDATE SET count = {cls.__tablename__}.count '
+                '+ excluded.count',
+                {'category': category, 'difficulty': difficulty,
+                 'delta': delta})
+            return
+
+        result = db.session.execute(
+            table.update()
+            .where(table.c.category == category)
+            .where(table.c.difficulty == difficulty)
+            .values(count=table.c.count + delta)
+        )
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(
+                category=category, difficulty=difficulty, count=delta))
+
+    @classmethod
+    def adjust_many(cls, old=(), new=()):
+        '''move the counts of formatted questions from their old to
+        their new (category, difficulty), with a statement per changed
+        count'''
+        counts = Counter(
+            cls.key(question['category'], question['difficulty'])
+            for question in new)
+        counts.subtract(
+            cls.key(question['category'], question['difficulty'])
+            for question in old)
+        for (category, difficulty), delta in counts.items():
+            if delta:
+                cls.adjust(category, difficulty, delta)
+
+    @classmethod
+    def total(cls):
+        '''the number of all questions'''
+        return db.session.query(
+            func.coalesce(func.sum(cls.count), 0)).scalar()
+
+    @classmethod
+    def by_category(cls):
+        '''a dictionary of category: number of questions'''
+        return cls._group_by(cls.category)
+
+    @classmethod
+    def by_difficulty(cls):
+        '''a dictionary of difficulty: number of questions'''
+        return cls._group_by(cls.difficulty)
+
+    @classmethod
+    def _group_by(cls, column):
+        rows = db.session.query(column, func.sum(cls.count)) \
+            .group_by(column).order_by(column).all()
+        return {
+            value: count for value, count in rows
+            if value is not None and count
+        }
+
+    @classmethod
+    def rebuild(cls):
+        '''recount all questions from the questions table'''
+        db.session.query(cls).delete()
+        rows = db.session.query(
+            Question.category, Question.difficulty, func.count(Question.id)
+        ).group_by(Question.category, Question.difficulty).all()
+        for category, difficulty, count in rows:
+            category, difficulty = cls.key(category, difficulty)
+            db.session.add(cls(
+                category=category, difficulty=difficulty, count=count))
+        db.session.commit()
+
+    @classmethod
+    def ensure(cls):
+        '''rebuild the counts if they have never been built'''
+        if db.session.query(cls.id).first() is None \
+                and db.session.query(Question.id).first() is not None:
+            cls.rebuild()
@@ -1,10 +1,49 @@
+import asyncio
+import csv
+import gzip
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from flask import Flask, Response, jsonify, request
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
 
+import benchmark
+import migrations
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.admission import GAMEPLAY, READ, WRITE, AdmissionController
+from flaskr.asgi import ASGI_WORKER_THREADS, AsgiApp, worker_threads
+from flaskr.compression import ResponseCompressor
+from flaskr.instrumentation import assert_max_queries, record_queries
+from flaskr.quiz_events import QuizEventWriter
+from flaskr.response_cache import MemoryCacheBackend, ResponseCache, \
+    SqliteCacheBackend
+from flaskr.search import InvertedIndexSearchBackend, \
+    PostgresSearchBackend
+from models import db, init_db, Question, Category, QuizEvent, \
+    TableVersion
+
+database_name = "trivia_test"
+database_path = "postgres://{}:{}@{}/{}".format(
+    'trivia',
+    'development',
+    '172.17.0.2:5432',
+    database_name
+)
+
+
+def setUpModule():
+    """Create or upgrade the schema of the test database once."""
+    app = create_app({'DATABASE_PATH': database_path})
+    with app.app_context():
+        init_db()
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,28 +51,25 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.database_name = database_name
+        self.database_path = database_path
+        self.app = create_app({'DATABASE_PATH': self.database_path})
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}:{}@{}/{}".format(
-            'trivia',
-            'development',
-            '172.17.0.2:5432',
-            self.database_name
-        )
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
 
     def tearDown(self):
         """Executed after reach test"""
         pass
 
+    def add_question(self, category=1, difficulty=1, answer='an answer'):
+        """Add a throwaway question through the API and return its id"""
+        response = self.client().post('/questions', json={
+            'question': 'a throwaway question',
+            'answer': answer,
+            'difficulty': difficulty,
+            'category': category,
+        })
+        return json.loads(response.data)['created']
+
     def test_get_categories(self):
         response = self.client().get('/categories')
         data = json.loads(response.data)
@@ -52,6 +88,107 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['categories'])
 
+    def test_304_sent_requesting_unchanged_questions(self):
+        response = self.client().get('/questions')
+        etag = response.headers['ETag']
+
+        with assert_max_queries(1):
+            response = self.client().get(
+                '/questions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        question_id = self.add_question()
+        self.client().delete(f'/questions/{question_id}')
+        response = self.client().get(
+            '/questions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_304_sent_requesting_unchanged_questions_of_category(self):
+        path = '/categories/1/questions'
+        etag = self.client().get(path).headers['ETag']
+
+        with assert_max_queries(1):
+            response = self.client().get(
+                path, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        question_id = self.add_question(category=1)
+        self.addCleanup(self.client().delete, f'/questions/{question_id}')
+        response = self.client().get(path, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(question_id, [
+            question['id'] for question in json.loads(response.data)[
+                'questions']])
+
+    def change_categories_in_another_worker(self, statement):
+        """Change categories without invalidating the category cache of
+        this process, as another worker does"""
+        with self.app.app_context():
+            result = db.session.execute(statement)
+            TableVersion.bump(Category.__tablename__)
+            db.session.commit()
+            db.session.remove()
+        return result
+
+    def test_categories_follow_changes_of_other_workers(self):
+        etag = self.client().get('/categories').headers['ETag']
+        table = Category.__table__
+        category_id = self.change_categories_in_another_worker(
+            table.insert().values(type='Astronomy')).inserted_primary_key[0]
+        self.addCleanup(self.change_categories_in_another_worker,
+                        table.delete().where(table.c.id == category_id))
+
+        response = self.client().get(
+            '/categories', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Astronomy', json.loads(response.data)['categories'])
+
+        question_id = self.add_question(category=category_id)
+        self.addCleanup(self.client().delete, f'/questions/{question_id}')
+
+    def test_questions_compressed_for_clients_accepting_gzip(self):
+        plain = self.client().get('/questions')
+        response = self.client().get(
+            '/questions', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertEqual(response.headers['ETag'],
+                         plain.headers['ETag'][:-1] + '-gzip"')
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        response = self.client().get('/questions', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': response.headers['ETag'],
+        })
+        self.assertEqual(response.status_code, 304)
+
+    def test_compressed_payloads_cached_by_version(self):
+        app = create_app({'DATABASE_PATH': self.database_path,
+                          'COMPRESSION_MIN_SIZE': 0})
+        client = app.test_client()
+        headers = {'Accept-Encoding': 'gzip'}
+        first = client.get('/questions', headers=headers)
+        second = client.get('/questions', headers=headers)
+
+        self.assertEqual(first.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(second.data, first.data)
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('trivia_compression_cache_hits_total 1', metrics)
+
+    def test_small_responses_not_compressed(self):
+        app = create_app({'DATABASE_PATH': self.database_path,
+                          'COMPRESSION_MIN_SIZE': 10 ** 9})
+        response = app.test_client().get(
+            '/questions', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertTrue(json.loads(response.data)['success'])
+
     def test_404_sent_requesting_beyond_valid_page(self):
         response = self.client().get('/questions?page=1000')
         data = json.loads(response.data)
@@ -61,6 +198,65 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['error'], 404)
         self.assertEqual(data['message'], 'Resource is not found.')
 
+    def test_get_questions_after_cursor(self):
+        first_page = json.loads(self.client().get('/questions').data)
+        cursor = first_page['next_cursor']
+        response = self.client().get(f'/questions?after={cursor}')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(
+            all(question['id'] > cursor for question in data['questions']))
+        self.assertEqual(data['total_questions'],
+                         first_page['total_questions'])
+
+    def test_get_questions_with_fields(self):
+        with record_queries() as stats:
+            response = self.client().get(
+                '/questions?fields=question,difficulty')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(data['questions'][0]),
+                         {'id', 'question', 'difficulty'})
+        self.assertNotIn('categories', data)
+        self.assertEqual(data['next_cursor'], data['questions'][-1]['id'])
+        self.assertFalse(any('questions.answer' in statement
+                             for statement in stats.statements))
+
+    def test_get_questions_with_fields_and_categories(self):
+        response = self.client().get(
+            '/categories/1/questions?fields=id&include=categories')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(data['questions'][0]), {'id'})
+        self.assertTrue(data['categories'])
+
+    def test_search_questions_with_fields(self):
+        response = self.client().post('search_questions?fields=answer',
+                                      json={"searchTerm": "title"})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(data['questions'][0]), {'id', 'answer'})
+
+    def test_400_sent_requesting_unknown_fields(self):
+        response = self.client().get('/questions?fields=id,secret')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_404_sent_requesting_beyond_last_cursor(self):
+        response = self.client().get('/questions?after=100000')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Resource is not found.')
+
     def test_delete_question(self):
         total_num_of_questions_before_delete = len(Question.query.all())
         response = self.client().delete('/questions/5')
@@ -73,6 +269,71 @@ class TriviaTestCase(unittest.TestCase):
             total_num_of_questions_before_delete - data['total_questions']
         self.assertEqual(num_of_deleted_question, 1)
 
+    def check_delete_question(self, question_id):
+        total_num_of_questions_before_delete = len(Question.query.all())
+        response = self.client().delete(f'/questions/{question_id}')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted'], question_id)
+        num_of_deleted_question = \
+            total_num_of_questions_before_delete - data['total_questions']
+        self.assertEqual(num_of_deleted_question, 1)
+
+    def test_delete_questions_in_batch(self):
+        ids = [self.add_question(category=5), self.add_question(category=5)]
+        stats_before = json.loads(self.client().get('/stats').data)
+        with assert_max_queries(8):
+            response = self.client().delete(
+                '/questions', json={"ids": ids + [1000]})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], ids)
+        self.assertEqual(
+            data['total_questions'], stats_before['total_questions'] - 2)
+        self.assertEqual(
+            data['categories']['5'], stats_before['categories']['5'] - 2)
+        self.assertEqual(
+            Question.query.filter(Question.id.in_(ids)).count(), 0)
+
+    def test_update_questions_in_batch(self):
+        ids = [self.add_question(category=5), self.add_question(category=5),
+               self.add_question(category=4)]
+        self.addCleanup(self.client().delete, '/questions', json={"ids": ids})
+        stats_before = json.loads(self.client().get('/stats').data)
+        response = self.client().patch(
+            '/questions', json={"ids": ids, "category": 1})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['updated'], ids)
+        self.assertEqual(
+            data['total_questions'], stats_before['total_questions'])
+        self.assertEqual(
+            data['categories']['1'], stats_before['categories']['1'] + 3)
+        self.assertEqual(
+            data['categories']['4'], stats_before['categories']['4'] - 1)
+        self.assertEqual(
+            data['categories']['5'], stats_before['categories']['5'] - 2)
+        self.assertEqual(Question.query.get(ids[2]).category, 1)
+
+    def test_422_sent_updating_questions_to_non_existing_category(self):
+        response = self.client().patch(
+            '/questions', json={"ids": [2], "category": 1000})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_404_sent_deleting_non_existing_questions_in_batch(self):
+        response = self.client().delete('/questions', json={"ids": [1000]})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_404_sent_deleting_non_existing_question(self):
         response = self.client().delete('/question/1000')
         data = json.loads(response.data)
@@ -100,6 +361,127 @@ class TriviaTestCase(unittest.TestCase):
             data['total_questions'] - total_num_of_questions_before_add
         self.assertEqual(num_of_added_question, 1)
 
+    def test_422_sent_adding_a_question_to_non_existing_category(self):
+        total_num_of_questions_before_add = len(Question.query.all())
+        new_question = {
+            "question": "new question",
+            "answer": "an answer for new question",
+            "difficulty": "2",
+            "category": "1000",
+        }
+        response = self.client().post('questions', json=new_question)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(
+            len(Question.query.all()), total_num_of_questions_before_add)
+
+    def test_import_questions_in_bulk(self):
+        total_num_of_questions_before_import = len(Question.query.all())
+        rows = [
+            {"question": "bulk question 1", "answer": "bulk answer",
+             "category": 1, "difficulty": 1},
+            {"question": "bulk question 2", "answer": "bulk answer",
+             "category": 2, "difficulty": 2},
+            {"question": "", "answer": "no question",
+             "category": 2, "difficulty": 2},
+        ]
+        response = self.client().post(
+            'questions/bulk',
+            data='\n'.join(json.dumps(row) for row in rows),
+            content_type='application/x-ndjson'
+        )
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['errors'][0]['line'], 3)
+        self.assertEqual(
+            data['total_questions'] - total_num_of_questions_before_import, 2)
+
+    def test_import_questions_in_bulk_from_csv(self):
+        response = self.client().post(
+            'questions/bulk',
+            data='question,answer,category,difficulty\n'
+                 'csv question,csv answer,3,3\n',
+            content_type='text/csv'
+        )
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['failed'], 0)
+
+    def test_lines_of_invalid_utf8_reported_importing_in_bulk(self):
+        row = {"question": "bulk question", "answer": "bulk answer",
+               "category": 1, "difficulty": 1}
+        response = self.client().post(
+            'questions/bulk',
+            data=b'{"question": "\xff"}\n' + json.dumps(row).encode(),
+            content_type='application/x-ndjson'
+        )
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['errors'][0]['line'], 1)
+        self.assertIn('Invalid UTF-8', data['errors'][0]['message'])
+
+        response = self.client().post(
+            'questions/bulk',
+            data=b'question,answer,category,difficulty\n'
+                 b'csv \xff question,csv answer,3,3\n',
+            content_type='text/csv'
+        )
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 0)
+        self.assertEqual(data['errors'][0]['line'], 2)
+        self.assertIn('Invalid UTF-8', data['errors'][0]['message'])
+
+    def test_400_sent_importing_questions_in_unknown_format(self):
+        response = self.client().post(
+            'questions/bulk', data='question', content_type='text/plain')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request.')
+
+    def test_export_questions(self):
+        response = self.client().get('questions/export')
+        rows = [
+            json.loads(line)
+            for line in response.get_data(as_text=True).splitlines()
+        ]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), len(Question.query.all()))
+        self.assertEqual(
+            [row['id'] for row in rows], sorted(row['id'] for row in rows))
+
+    def test_export_questions_as_csv_by_category(self):
+        response = self.client().get('questions/export?format=csv&category=5')
+        rows = list(csv.DictReader(
+            response.get_data(as_text=True).splitlines()))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(rows)
+        self.assertTrue(all(row['category'] == '5' for row in rows))
+
+    def test_400_sent_exporting_questions_in_unknown_format(self):
+        response = self.client().get('questions/export?format=xml')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_search_question(self):
         search = {
             "searchTerm": "What is"
@@ -113,6 +495,99 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['current_category'], None)
         self.assertTrue(data['total_questions'])
 
+    def test_search_finds_questions_of_other_workers(self):
+        self.client().post('/search_questions', json={"searchTerm": "a"})
+        other_client = create_app(
+            {'DATABASE_PATH': self.database_path}).test_client()
+        response = other_client.post('/questions', json={
+            'question': 'Which planet has the Great Red Spot?',
+            'answer': 'Jupiter',
+            'category': 1,
+            'difficulty': 2,
+        })
+        question_id = json.loads(response.data)['created']
+        self.addCleanup(other_client.delete, f'/questions/{question_id}')
+
+        response = self.client().post(
+            '/search_questions', json={"searchTerm": "great red spot"})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [question['id'] for question in data['questions']],
+            [question_id])
+
+    def test_search_backends_match_the_same_questions(self):
+        texts = {
+            'planet': ('Which planet has the Great Red Spot?', 'Jupiter'),
+            'pi': ('What is the value of pi to 2 decimals?', '3.14'),
+            'snake': ('Who named snake_case_names?', "Guido's team"),
+        }
+        ids = {}
+        for name, (question, answer) in texts.items():
+            response = self.client().post('/questions', json={
+                'question': question,
+                'answer': answer,
+                'category': 1,
+                'difficulty': 1,
+            })
+            ids[name] = json.loads(response.data)['created']
+            self.addCleanup(self.client().delete, f'/questions/{ids[name]}')
+        queries = {
+            'great red': ['planet'],
+            'Great Red Sp': ['planet'],
+            'reat': [],
+            'jupit': ['planet'],
+            'pi': ['pi'],
+            '3.14': ['pi'],
+            '14': ['pi'],
+            'snake': ['snake'],
+            'case_names': ['snake'],
+            "guido's": ['snake'],
+            '?!': [],
+        }
+
+        backends = [InvertedIndexSearchBackend()]
+        with self.app.app_context():
+            if db.engine.name == 'postgresql':
+                backends.append(PostgresSearchBackend())
+            for term, names in queries.items():
+                matches = []
+                for backend in backends:
+                    questions, total = backend.search(term, 0, 1000, ('id',))
+                    matched = sorted(question[0] for question in questions)
+                    self.assertEqual(total, len(matched))
+                    self.assertEqual(
+                        [name for name in ids if ids[name] in matched],
+                        names, (backend.name, term))
+                    matches.append(matched)
+                for matched in matches[1:]:
+                    self.assertEqual(matched, matches[0], term)
+
+    def test_search_question_by_answer(self):
+        search = {
+            "searchTerm": "Scarab"
+        }
+        response = self.client().post('search_questions', json=search)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['questions'][0]['answer'], 'Scarab')
+        self.assertEqual(data['total_results'], len(data['questions']))
+
+    def test_get_stats(self):
+        response = self.client().get('/stats')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], len(Question.query.all()))
+        self.assertEqual(
+            sum(data['categories'].values()), data['total_questions'])
+        self.assertEqual(
+            sum(data['difficulties'].values()), data['total_questions'])
+
     def test_405_sent_searching_question_with_get_method(self):
         search = {
             "searchTerm": "What is"
@@ -135,6 +610,90 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['current_category'] == "Entertainment")
 
+    def cache_metric(self, name):
+        metrics = self.client().get('/metrics').get_data(as_text=True)
+        for line in metrics.splitlines():
+            if line.startswith(f'trivia_response_cache_{name} '):
+                return int(line.split()[1])
+
+    def test_question_pages_are_cached(self):
+        first = self.client().get('categories/5/questions')
+        second = self.client().get('categories/5/questions')
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(self.cache_metric('misses_total'), 1)
+        self.assertEqual(self.cache_metric('hits_total'), 1)
+
+    def test_new_question_invalidates_only_its_category(self):
+        self.client().get('categories/1/questions')
+        self.client().get('categories/5/questions')
+        question_id = self.add_question(category=1)
+        self.addCleanup(self.client().delete, f'/questions/{question_id}')
+
+        self.client().get('categories/5/questions')
+        self.assertEqual(self.cache_metric('hits_total'), 1)
+        response = self.client().get('categories/1/questions')
+        self.assertEqual(self.cache_metric('hits_total'), 1)
+        self.assertEqual(
+            json.loads(response.data)['total_questions'],
+            json.loads(self.client().get('/questions').data)[
+                'total_questions'])
+
+    def test_moved_questions_invalidate_both_categories(self):
+        question_id = self.add_question(category=5)
+        self.addCleanup(self.client().delete, f'/questions/{question_id}')
+        for category_id in (2, 3, 5):
+            self.client().get(f'categories/{category_id}/questions')
+        other_worker = create_app({'DATABASE_PATH': self.database_path})
+        other_worker.test_client().patch(
+            '/questions', json={"ids": [question_id], "category": 2})
+
+        # the other worker can't drop the pages of this one, the
+        # versions of the old and the new category move on instead
+        self.client().get('categories/3/questions')
+        self.assertEqual(self.cache_metric('hits_total'), 1)
+        moved_to = json.loads(
+            self.client().get('categories/2/questions').data)
+        moved_from = json.loads(
+            self.client().get('categories/5/questions').data)
+        self.assertEqual(self.cache_metric('hits_total'), 1)
+        self.assertIn(question_id, [q['id'] for q in moved_to['questions']])
+        self.assertNotIn(
+            question_id, [q['id'] for q in moved_from['questions']])
+
+    def test_404_sent_requesting_questions_of_non_existing_category(self):
+        response = self.client().get('categories/1000/questions')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Resource is not found.')
+
+    def test_pages_follow_changes_of_other_workers(self):
+        own_id = self.add_question()
+        self.addCleanup(self.client().delete, f'/questions/{own_id}')
+        path = f'/categories/1/questions?after={own_id - 1}'
+        self.client().get(path)
+        other_worker = create_app({'DATABASE_PATH': self.database_path})
+        other_client = other_worker.test_client()
+        response = other_client.post('/questions', json={
+            'question': 'Which planet is the largest?',
+            'answer': 'Jupiter',
+            'category': 1,
+            'difficulty': 2,
+        })
+        other_id = json.loads(response.data)['created']
+        self.addCleanup(other_client.delete, f'/questions/{other_id}')
+
+        response = self.client().get(path)
+        data = json.loads(response.data)
+
+        self.assertEqual(
+            [question['id'] for question in data['questions']],
+            [own_id, other_id])
+        self.assertEqual(response.headers['ETag'],
+                         other_client.get(path).headers['ETag'])
+
     def test_get_random_question_for_quizzes(self):
         response = self.client().post(
             'quizzes',
@@ -151,6 +710,959 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['question'])
         self.assertTrue(data['current_category'])
 
+    def test_get_quiz_deck(self):
+        previous_id = self.add_question(category=5)
+        self.addCleanup(self.client().delete, f'/questions/{previous_id}')
+        total = json.loads(self.client().get('/stats').data)['categories']['5']
+        self.client().get('/categories')
+        with assert_max_queries(3):
+            response = self.client().post('/quizzes/deck', json={
+                "previous_questions": [previous_id],
+                "quiz_category": {"type": "Entertainment", "id": "5"},
+                "count": 5,
+            })
+        data = json.loads(response.data)
+
+        question_ids = [question['id'] for question in data['questions']]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(question_ids), min(5, total - 1))
+        self.assertEqual(len(set(question_ids)), len(question_ids))
+        self.assertNotIn(previous_id, question_ids)
+        self.assertTrue(all(
+            question['category'] == 5 for question in data['questions']))
+        self.assertEqual(data['total_questions'], total)
+        self.assertEqual(data['current_category'], "Entertainment")
+
+    def test_get_stratified_quiz_deck(self):
+        response = self.client().post('/quizzes/deck', json={
+            "quiz_category": {"type": "click", "id": 0},
+            "count": 4,
+            "stratify": True,
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(question['difficulty'] for question in data['questions']),
+            [1, 2, 3, 4])
+
+    def test_422_sent_getting_too_large_quiz_deck(self):
+        response = self.client().post('/quizzes/deck', json={
+            "quiz_category": {"type": "click", "id": 0},
+            "count": 1000,
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_422_sent_getting_quiz_deck_of_non_object_body(self):
+        response = self.client().post('/quizzes/deck', json=[1])
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def question_stats(self, question_id):
+        data = json.loads(self.client().get('/quizzes/stats').data)
+        for question in data['questions']:
+            if question['id'] == question_id:
+                return question
+        return {'answers': 0, 'correct': 0}
+
+    def test_record_quiz_events(self):
+        question_id = self.add_question()
+        self.addCleanup(self.client().delete, f'/questions/{question_id}')
+        before = self.question_stats(question_id)
+        response = self.client().post('/quizzes/events', json={
+            "events": [
+                {"question_id": question_id, "correct": True},
+                {"question_id": question_id, "correct": False},
+                {"question_id": question_id, "correct": True},
+            ],
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['accepted'], 3)
+        self.assertTrue(self.app.extensions['quiz_events'].flush(5))
+        after = self.question_stats(question_id)
+        self.assertEqual(after['answers'], before['answers'] + 3)
+        self.assertEqual(after['correct'], before['correct'] + 2)
+        self.assertEqual(after['correct_rate'],
+                         after['correct'] / after['answers'])
+
+    def test_422_sent_recording_invalid_quiz_events(self):
+        response = self.client().post('/quizzes/events', json={
+            "events": [{"question_id": "2", "correct": True}],
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_503_sent_recording_quiz_events_beyond_the_queue(self):
+        client = create_app({
+            'DATABASE_PATH': self.database_path,
+            'QUIZ_EVENTS_MAX_QUEUE': 1,
+        }).test_client()
+        response = client.post('/quizzes/events', json={
+            "events": [
+                {"question_id": 2, "correct": True},
+                {"question_id": 4, "correct": True},
+            ],
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(data['success'], False)
+
+    def test_play_quiz_session(self):
+        response = self.client().post('quizzes/sessions', json={
+            "quiz_category": {"type": "Geography", "id": "3"},
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['session_id'])
+
+        asked = set()
+        for _ in range(data['total_questions']):
+            response = self.client().post('quizzes', json={
+                "session_id": data['session_id'],
+            })
+            question = json.loads(response.data)['question']
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(question['id'], asked)
+            asked.add(question['id'])
+
+        for _ in range(2):
+            response = self.client().post('quizzes', json={
+                "session_id": data['session_id'],
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['question'], None)
+
+    def test_quiz_session_questions_sampled_up_to_the_limit(self):
+        app = create_app({'DATABASE_PATH': self.database_path,
+                          'QUIZ_SESSION_MAX_QUESTIONS': 2})
+        response = app.test_client().post('quizzes/sessions', json={
+            "quiz_category": {"type": "all", "id": 0},
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_questions'], 2)
+
+    def test_404_sent_playing_non_existing_quiz_session(self):
+        response = self.client().post('quizzes', json={
+            "session_id": "non-existing-session",
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Resource is not found.')
+
+    def test_422_sent_playing_quiz_of_non_object_body(self):
+        response = self.client().post('quizzes', json=[1, 2])
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_422_sent_playing_quiz_session_of_non_string_id(self):
+        for session_id in ([1], {"id": 1}, 1):
+            with self.subTest(session_id=session_id):
+                response = self.client().post('quizzes', json={
+                    "session_id": session_id,
+                })
+                data = json.loads(response.data)
+
+                self.assertEqual(response.status_code, 422)
+                self.assertEqual(data['success'], False)
+
+    def test_query_budget_of_read_endpoints(self):
+        # caches are filled lazily by the first request
+        self.client().get('/categories')
+        budgets = {
+            '/categories': 1,
+            '/questions': 3,
+            '/categories/5/questions': 3,
+            '/stats': 3,
+        }
+        for path, budget in budgets.items():
+            with self.subTest(path=path), assert_max_queries(budget):
+                self.client().get(path)
+
+    def test_query_budget_of_search_and_quiz(self):
+        # including the version of the questions keying cached results
+        with assert_max_queries(4):
+            self.client().post('search_questions', json={
+                "searchTerm": "What is"
+            })
+        with assert_max_queries(2):
+            self.client().post('quizzes', json={
+                "previous_questions": [13],
+                "quiz_category": {"type": "Geography", "id": "3"},
+            })
+
+    def test_server_timing_and_metrics(self):
+        response = self.client().get('/questions')
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+        response = self.client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'trivia_db_queries_total{endpoint="retrieve_questions"}',
+            response.get_data(as_text=True))
+
+    def test_optional_subsystems_imported_when_enabled(self):
+        script = (
+            'import sys\n'
+            'from flaskr import create_app\n'
+            'modules = ("flaskr.admission", "flaskr.profiler", '
+            '"flaskr.read_model", "flaskr.compression")\n'
+            'print([name in sys.modules for name in modules])\n'
+            f'create_app({{"DATABASE_PATH": {self.database_path!r}, '
+            '"COMPRESSION": False})\n'
+            'print([name in sys.modules for name in modules])\n'
+            f'create_app({{"DATABASE_PATH": {self.database_path!r}, '
+            '"READ_MODEL": True})\n'
+            'print([name in sys.modules for name in modules])\n')
+        output = subprocess.run(
+            [sys.executable, '-c', script], check=True,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+        self.assertEqual(output.splitlines(), [
+            '[False, False, False, False]',
+            '[False, False, False, False]',
+            '[False, False, True, True]',
+        ])
+
+    def test_profiler_is_disabled_by_default(self):
+        response = self.client().get('/questions',
+                                     headers={'X-Profile': 'secret'})
+        self.assertNotIn('X-Profile-Id', response.headers)
+
+        response = self.client().get('/admin/profiles')
+        self.assertEqual(response.status_code, 404)
+
+    def test_profile_request_with_token(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        client = create_app({
+            'DATABASE_PATH': self.database_path,
+            'PROFILER_TOKEN': 'secret',
+            'PROFILER_DIR': directory,
+        }).test_client()
+
+        response = client.get('/questions')
+        self.assertNotIn('X-Profile-Id', response.headers)
+        response = client.get('/questions', headers={'X-Profile': 'secret'})
+        profile_id = response.headers['X-Profile-Id']
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+        response = client.get('/admin/profiles')
+        self.assertEqual(response.status_code, 403)
+        response = client.get('/admin/profiles',
+                              headers={'X-Profile': 'secret'})
+        data = json.loads(response.data)
+        self.assertEqual(data['profiles'][0]['route'], '/questions')
+        self.assertEqual(data['profiles'][0]['status'], 200)
+
+        response = client.get(f'/admin/profiles/{profile_id}',
+                              headers={'X-Profile': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('retrieve_questions', response.get_data(as_text=True))
+
+    def test_get_paginated_questions_matches_jsonify(self):
+        response = self.client().get('/questions?page=1')
+
+        with self.app.app_context():
+            questions = Question.query.order_by(Question.id).limit(10).all()
+            expected = jsonify({
+                'questions': [question.format() for question in questions]
+            }).get_data(as_text=True)
+        self.assertIn(expected[1:-2], response.get_data(as_text=True))
+
+
+class AsgiTriviaTestCase(TriviaTestCase):
+    """This class runs the trivia test case against the ASGI app"""
+
+    def setUp(self):
+        """Define test variables and wrap the app in the ASGI app."""
+        super().setUp()
+        self.client = AsgiApp(self.app).test_client
+
+    def test_delete_question(self):
+        # seed question 5 of the base test can only be deleted once
+        self.check_delete_question(self.add_question())
+
+
+class AsgiAppTestCase(unittest.TestCase):
+    """This class represents the ASGI app test case with worker threads"""
+
+    def setUp(self):
+        """Create a small Flask app served by worker threads."""
+        self.app = Flask(__name__)
+        self.uploads = []
+        self.produced = 0
+        self.stream_closed = threading.Event()
+
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            self.uploads.append(request.get_data())
+            return 'uploaded'
+
+        @self.app.route('/stream')
+        def stream():
+            def generate():
+                try:
+                    for _ in range(50):
+                        self.produced += 1
+                        yield b'chunk'
+                finally:
+                    self.stream_closed.set()
+            return Response(generate())
+
+        self.asgi_app = AsgiApp(self.app, max_workers=2,
+                                max_buffered_chunks=4)
+        self.addCleanup(self.asgi_app.executor.shutdown, True)
+
+    def request(self, path, messages, send, method='GET'):
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': b'', 'headers': []}
+
+        async def receive():
+            return messages.pop(0)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+
+    def test_chunked_bulk_import_reads_the_whole_body(self):
+        app = create_app({'DATABASE_PATH': database_path})
+        asgi_app = AsgiApp(app, max_workers=1)
+        self.addCleanup(asgi_app.executor.shutdown, True)
+        rows = [json.dumps({
+            'question': 'a chunked question', 'answer': 'an answer',
+            'category': 1, 'difficulty': 1,
+        }).encode() + b'\n' for _ in range(3)]
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        messages = [{'type': 'http.request', 'body': row, 'more_body': True}
+                    for row in rows]
+        messages.append({'type': 'http.request', 'body': b''})
+
+        async def receive():
+            return messages.pop(0)
+
+        asyncio.run(asgi_app({
+            'type': 'http', 'method': 'POST', 'path': '/questions/bulk',
+            'query_string': b'', 'headers': [
+                (b'content-type', b'application/x-ndjson'),
+                (b'transfer-encoding', b'chunked'),
+            ]}, receive, send))
+
+        def delete_chunked_questions():
+            with app.app_context():
+                ids = [question.id for question in Question.query.filter_by(
+                    question='a chunked question')]
+                db.session.remove()
+            app.test_client().delete('/questions', json={'ids': ids})
+        self.addCleanup(delete_chunked_questions)
+
+        self.assertEqual(sent[0]['status'], 200)
+        data = json.loads(b''.join(
+            message.get('body', b'') for message in sent[1:]))
+        self.assertEqual(data['inserted'], 3)
+        self.assertEqual(data['failed'], 0)
+
+    def test_worker_threads_sized_to_the_database_pool(self):
+        self.assertEqual(worker_threads({}), 15)
+        self.assertEqual(worker_threads(
+            {'DATABASE_POOL_SIZE': 3, 'DATABASE_MAX_OVERFLOW': 2}), 5)
+        self.assertEqual(worker_threads(
+            {'DATABASE_POOL_SIZE': 3, 'ASGI_WORKER_THREADS': 8}), 8)
+        self.assertEqual(worker_threads({'DATABASE_MAX_OVERFLOW': -1}),
+                         ASGI_WORKER_THREADS)
+
+    def test_disconnect_before_the_end_of_the_body_skips_the_app(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        self.request('/upload', [
+            {'type': 'http.request', 'body': b'part', 'more_body': True},
+            {'type': 'http.disconnect'},
+        ], send, method='POST')
+
+        self.assertEqual(self.uploads, [])
+        self.assertEqual(sent, [])
+
+    def test_streamed_response_is_bounded_by_buffered_chunks(self):
+        chunks = []
+        lags = []
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                chunks.append(message['body'])
+                lags.append(self.produced - len(chunks))
+                await asyncio.sleep(0.001)
+
+        self.request('/stream', [{'type': 'http.request'}], send)
+
+        self.assertEqual(b''.join(chunks), b'chunk' * 50)
+        # the worker waits for a credit with at most one chunk ahead
+        self.assertLessEqual(max(lags), 4 + 1)
+
+    def test_disconnect_while_streaming_stops_the_worker(self):
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                raise OSError('client disconnected')
+
+        with self.assertRaises(OSError):
+            self.request('/stream', [{'type': 'http.request'}], send)
+
+        self.assertTrue(self.stream_closed.wait(5))
+        self.assertLess(self.produced, 50)
+
+
+class ResponseCompressorTestCase(unittest.TestCase):
+    """This class represents the response compressor test case"""
+
+    def setUp(self):
+        """Define an app whose body changes under the same ETag."""
+        self.body = {'text': 'a' * 1000}
+        self.app = Flask(__name__)
+        compressor = ResponseCompressor(min_size=0)
+
+        @self.app.route('/text')
+        def text():
+            response = jsonify(self.body)
+            response.set_etag('stale')
+            return response
+
+        @self.app.after_request
+        def compress(response):
+            return compressor.compress(request, response)
+
+    def test_bodies_changed_under_the_same_etag_are_compressed(self):
+        client = self.app.test_client()
+        headers = {'Accept-Encoding': 'gzip'}
+        first = client.get('/text', headers=headers)
+        self.body['text'] = 'b' * 1000
+        second = client.get('/text', headers=headers)
+
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(json.loads(gzip.decompress(second.data)),
+                         {'text': 'b' * 1000})
+
+
+class ReadModelTriviaTestCase(TriviaTestCase):
+    """This class runs the trivia test case with the read model"""
+
+    def setUp(self):
+        """Define test variables and initialize app with the read model."""
+        super().setUp()
+        self.app = create_app({
+            'DATABASE_PATH': self.database_path,
+            'READ_MODEL': True,
+            'READ_MODEL_POLL_SECONDS': 0,
+        })
+        self.client = self.app.test_client
+        # load the read model
+        self.client().post('/quizzes', json={
+            "quiz_category": {"type": "click", "id": 0},
+        })
+
+    def test_delete_question(self):
+        # seed question 5 of the base test can only be deleted once
+        self.check_delete_question(self.add_question())
+
+    def test_reads_are_served_from_memory(self):
+        client = create_app({
+            'DATABASE_PATH': self.database_path,
+            'READ_MODEL': True,
+            'READ_MODEL_POLL_SECONDS': 60,
+        }).test_client()
+        quiz = {
+            "previous_questions": [],
+            "quiz_category": {"type": "Science", "id": "1"},
+        }
+        client.post('quizzes', json=quiz)
+
+        with assert_max_queries(0):
+            response = client.post('quizzes', json=quiz)
+        data = json.loads(response.data)
+        self.assertEqual(data['question']['category'], 1)
+
+    def test_changes_of_other_workers_are_polled(self):
+        self.client().get('/categories/1/questions')
+        other_worker = create_app({'DATABASE_PATH': self.database_path})
+        response = other_worker.test_client().post('/questions', json={
+            'question': 'Which planet is the largest?',
+            'answer': 'Jupiter',
+            'category': 1,
+            'difficulty': 2,
+        })
+        question_id = json.loads(response.data)['created']
+        self.addCleanup(other_worker.test_client().delete,
+                        f'/questions/{question_id}')
+
+        response = self.client().get(
+            f'/categories/1/questions?after={question_id - 1}')
+        data = json.loads(response.data)
+
+        self.assertEqual(data['questions'][0]['id'], question_id)
+        self.assertEqual(data['questions'][0]['answer'], 'Jupiter')
+
+    def test_pages_are_built_at_the_version_of_their_etag(self):
+        client = create_app({
+            'DATABASE_PATH': self.database_path,
+            'READ_MODEL': True,
+            'READ_MODEL_POLL_SECONDS': 60,
+        }).test_client()
+        own_id = self.add_question()
+        self.addCleanup(self.client().delete, f'/questions/{own_id}')
+        path = f'/categories/1/questions?after={own_id - 1}'
+        client.get(path)
+        other_id = self.add_question()
+        self.addCleanup(self.client().delete, f'/questions/{other_id}')
+
+        data = json.loads(client.get(path).data)
+
+        self.assertEqual(
+            [question['id'] for question in data['questions']],
+            [own_id, other_id])
+
+    def read_model_loads(self):
+        metrics = self.client().get('/metrics').get_data(as_text=True)
+        for line in metrics.splitlines():
+            if line.startswith('trivia_read_model_loads_total '):
+                return int(line.split()[1])
+
+    def test_changes_of_this_worker_do_not_reload(self):
+        self.client().get('/questions')
+        loads = self.read_model_loads()
+        ids = [self.add_question(category=2) for _ in range(3)]
+        self.addCleanup(self.client().delete, f'/questions/{ids[2]}')
+        self.client().delete('/questions', json={"ids": ids[:2]})
+
+        response = self.client().get(
+            f'/categories/2/questions?after={ids[0] - 1}')
+        data = json.loads(response.data)
+
+        self.assertEqual(
+            [question['id'] for question in data['questions']], [ids[2]])
+        self.assertEqual(self.read_model_loads(), loads)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case
+
+    Two SQLite files stand in for the primary and its replica.
+    """
+
+    def setUp(self):
+        """Create a primary and a replica which is a copy of it."""
+        self.directory = tempfile.mkdtemp()
+        primary_path = os.path.join(self.directory, 'primary.db')
+        replica_path = os.path.join(self.directory, 'replica.db')
+        self.app = create_app({
+            'DATABASE_PATH': f'sqlite:///{primary_path}',
+            'DATABASE_REPLICA_PATHS': [f'sqlite:///{replica_path}'],
+        })
+        self.client = self.app.test_client
+
+        with self.app.app_context():
+            init_db()
+            Category('Science').insert()
+            Question('replicated', 'answer', '1', 1).insert()
+            db.session.remove()
+        shutil.copy(primary_path, replica_path)
+
+        # a write the replica hasn't caught up with yet
+        with self.app.app_context():
+            Question('primary only', 'answer', '1', 1).insert()
+            db.session.remove()
+
+    def tearDown(self):
+        """Remove the databases"""
+        db.session.remove()
+        shutil.rmtree(self.directory)
+
+    def test_reads_are_routed_to_replica(self):
+        response = self.client().get('/categories/1/questions')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [question['question'] for question in data['questions']],
+            ['replicated'])
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_writes_read_their_own_writes(self):
+        response = self.client().post('questions', json={
+            "question": "new question",
+            "answer": "an answer for new question",
+            "difficulty": "1",
+            "category": "1",
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_questions'], 3)
+
+
+class MigrationTestCase(unittest.TestCase):
+    """This class represents the schema migration test case
+
+    A SQLite file stands in for a database created by db.create_all()
+    before the schema was versioned.
+    """
+
+    def setUp(self):
+        """Create an unversioned database with a string category."""
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(
+            self.directory, 'legacy.db'))
+        self.engine.execute(
+            'CREATE TABLE categories (id INTEGER PRIMARY KEY, type VARCHAR)')
+        self.engine.execute(
+            'CREATE TABLE questions (id INTEGER PRIMARY KEY, '
+            'question VARCHAR, answer VARCHAR, category VARCHAR, '
+            'difficulty INTEGER)')
+        self.engine.execute("INSERT INTO categories VALUES (1, 'Science')")
+        self.engine.execute(
+            "INSERT INTO questions VALUES (1, 'known', 'a', '1', 1), "
+            "(2, 'unknown', 'a', '9', 2)")
+
+    def tearDown(self):
+        """Remove the database"""
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_upgrade_legacy_database(self):
+        applied = migrations.upgrade(self.engine)
+
+        self.assertEqual(applied, [1, 2, 3, 4, 5])
+        with self.engine.connect() as connection:
+            self.assertEqual(migrations.current_version(connection),
+                             migrations.latest_version())
+        self.assertEqual(
+            self.engine.execute(
+                'SELECT id, category FROM questions ORDER BY id').fetchall(),
+            [(1, 1), (2, None)])
+        inspector = inspect(self.engine)
+        self.assertEqual(
+            [index['name'] for index in inspector.get_indexes('questions')],
+            ['ix_questions_category_difficulty', 'ix_questions_category_id'])
+        self.assertEqual(
+            inspector.get_foreign_keys('questions')[0]['referred_table'],
+            'categories')
+
+    def test_duplicate_question_counts_merged(self):
+        migrations.upgrade(self.engine, target=4)
+        self.engine.execute(
+            'INSERT INTO question_counts (category, difficulty, count) '
+            'VALUES (1, 1, 1), (1, 1, 2), (NULL, 2, 1), (NULL, 2, 1)')
+
+        self.assertEqual(migrations.upgrade(self.engine), [5])
+        self.assertEqual(
+            self.engine.execute(
+                'SELECT category, difficulty, count FROM question_counts '
+                'ORDER BY id').fetchall(),
+            [(1, 1, 3), (None, 2, 2)])
+        with self.assertRaises(IntegrityError):
+            self.engine.execute(
+                'INSERT INTO question_counts (category, difficulty, count) '
+                'VALUES (NULL, 2, 1)')
+
+    def test_upgrade_is_idempotent(self):
+        migrations.upgrade(self.engine)
+
+        self.assertEqual(migrations.upgrade(self.engine), [])
+
+
+class ResponseCacheBackendTestCase(unittest.TestCase):
+    """This class represents the response cache backend test case"""
+
+    def setUp(self):
+        """Create a memory backend and a SQLite backend."""
+        self.directory = tempfile.mkdtemp()
+        self.backends = [
+            MemoryCacheBackend(max_bytes=100),
+            SqliteCacheBackend(os.path.join(self.directory, 'cache.db'),
+                               max_bytes=100),
+        ]
+
+    def tearDown(self):
+        """Remove the SQLite file"""
+        shutil.rmtree(self.directory)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for backend in self.backends:
+            value = {'questions': 'x' * 30}
+            backend.set('a', value, ('questions',), backend.generation)
+            backend.set('b', value, ('questions',), backend.generation)
+            backend.get('a')
+            evicted = backend.set('c', value, ('questions',),
+                                  backend.generation)
+
+            self.assertEqual(evicted, 1)
+            self.assertEqual(backend.get('a'), value)
+            self.assertIsNone(backend.get('b'))
+            self.assertLessEqual(backend.size, 100)
+
+    def test_invalidation_by_tag(self):
+        for backend in self.backends:
+            value = {'questions': '[]'}
+            backend.set('a', value, ('category:1',), backend.generation)
+            backend.set('b', value, ('category:2',), backend.generation)
+            backend.invalidate(['category:1'])
+
+            self.assertIsNone(backend.get('a'))
+            self.assertEqual(backend.get('b'), value)
+
+    def test_entries_built_before_invalidation_are_not_stored(self):
+        for backend in self.backends:
+            generation = backend.generation
+            backend.invalidate(['questions'])
+            backend.set('a', {'questions': '[]'}, ('questions',), generation)
+
+            self.assertIsNone(backend.get('a'))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """This class represents the request coalescing test case"""
+
+    def setUp(self):
+        """Create a disabled response cache and a blocking page build."""
+        self.cache = ResponseCache(MemoryCacheBackend(max_bytes=0))
+        self.release = threading.Event()
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        self.release.wait(5)
+        return {'questions': '[]'}
+
+    def get_concurrently(self, count):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                self.cache.cached('questions?page=1', ('questions',),
+                                  self.build, 1)))
+            for _ in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        while self.cache.flights.coalesced < count - 1:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_misses_share_one_build(self):
+        results = self.get_concurrently(10)
+
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(
+            result['questions'].json == '[]' for result in results))
+        self.assertIn('trivia_single_flight_coalesced_total 9',
+                      self.cache.collect())
+        self.assertIn('trivia_single_flight_executed_total 1',
+                      self.cache.collect())
+
+    def test_misses_after_a_build_build_again(self):
+        self.release.set()
+        self.cache.cached('questions?page=1', ('questions',), self.build, 1)
+        self.cache.cached('questions?page=1', ('questions',), self.build, 1)
+
+        self.assertEqual(self.builds, 2)
+        self.assertEqual(self.cache.flights.coalesced, 0)
+
+
+class QuizEventWriterTestCase(unittest.TestCase):
+    """This class represents the quiz event writer test case"""
+
+    def setUp(self):
+        """Create a writer collecting its batches."""
+        self.batches = []
+        self.writer = QuizEventWriter(self.batches.append, batch_size=2,
+                                      flush_seconds=0.01, max_queue=5)
+
+    def tearDown(self):
+        """Stop the writer thread"""
+        self.writer.close()
+
+    def test_events_are_written_in_batches(self):
+        self.writer.enqueue([1, 2, 3])
+        self.writer.enqueue([4, 5])
+
+        self.assertTrue(self.writer.flush(5))
+        self.assertTrue(all(len(batch) <= 2 for batch in self.batches))
+        self.assertEqual(sum(self.batches, []), [1, 2, 3, 4, 5])
+
+    def test_events_beyond_the_queue_are_rejected(self):
+        self.writer.write = lambda batch: time.sleep(0.1)
+
+        self.assertTrue(self.writer.enqueue([1, 2, 3, 4]))
+        self.assertFalse(self.writer.enqueue([5, 6, 7, 8]))
+        self.assertEqual(self.writer.rejected, 4)
+
+    def test_close_writes_the_queued_events(self):
+        self.writer.flush_seconds = 60
+        self.writer.enqueue([1])
+        self.writer.close()
+
+        self.assertEqual(self.batches, [[1]])
+
+
+class AdmissionControllerTestCase(unittest.TestCase):
+    """This class represents the admission control test case"""
+
+    def setUp(self):
+        """Create a controller serving one request at once."""
+        self.controller = AdmissionController(1, max_queue=2,
+                                              queue_timeout=5)
+        self.admitted = []
+
+    def acquire_in_thread(self, route, priority):
+        def acquire():
+            if self.controller.acquire(route, priority):
+                self.admitted.append(route)
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        return thread
+
+    def wait_for_waiters(self, count):
+        while len(self.controller._waiters) < count:
+            time.sleep(0.001)
+
+    def test_waiting_gameplay_is_admitted_before_admin_writes(self):
+        self.assertTrue(self.controller.acquire('retrieve_questions', READ))
+        write = self.acquire_in_thread('add_a_new_question', WRITE)
+        self.wait_for_waiters(1)
+        quiz = self.acquire_in_thread('retrieve_questions_for_quiz',
+                                      GAMEPLAY)
+        self.wait_for_waiters(2)
+
+        self.controller.release('retrieve_questions')
+        quiz.join()
+        self.controller.release('retrieve_questions_for_quiz')
+        write.join()
+
+        self.assertEqual(self.admitted,
+                         ['retrieve_questions_for_quiz', 'add_a_new_question'])
+
+    def test_requests_beyond_the_queue_are_rejected(self):
+        self.controller.queue_timeout = 0.05
+        self.assertTrue(self.controller.acquire('retrieve_questions'))
+        threads = [self.acquire_in_thread('retrieve_questions', READ)
+                   for _ in range(2)]
+        self.wait_for_waiters(2)
+
+        self.assertFalse(self.controller.acquire('retrieve_questions'))
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.admitted, [])
+        lines = self.controller.collect()
+        self.assertIn('trivia_admission_rejected_total{endpoint='
+                      '"retrieve_questions",reason="queue_full"} 1', lines)
+        self.assertIn('trivia_admission_rejected_total{endpoint='
+                      '"retrieve_questions",reason="timeout"} 2', lines)
+        self.assertIn('trivia_admission_waiting 0', lines)
+
+    def test_route_limits_admit_other_routes(self):
+        self.controller = AdmissionController(
+            2, route_limits={'import_questions_in_bulk': 1},
+            queue_timeout=0.01)
+        self.assertTrue(self.controller.acquire('import_questions_in_bulk'))
+
+        self.assertFalse(self.controller.acquire('import_questions_in_bulk'))
+        self.assertTrue(self.controller.acquire('retrieve_questions'))
+
+    def test_app_rejects_with_retry_after(self):
+        app = create_app({
+            'DATABASE_PATH': database_path,
+            'ADMISSION_MAX_CONCURRENCY': 1,
+            'ADMISSION_MAX_QUEUE': 0,
+            'ADMISSION_RETRY_AFTER': 3,
+        })
+        controller = app.extensions['admission']
+        self.assertTrue(controller.acquire('retrieve_questions'))
+
+        response = app.test_client().get('/categories')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '3')
+        self.assertEqual(data['success'], False)
+        self.assertEqual(
+            app.test_client().get('/metrics').status_code, 200)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """This class represents the benchmark test case on a SQLite file"""
+
+    def setUp(self):
+        """Seed a small benchmark database."""
+        self.directory = tempfile.mkdtemp()
+        self.database = 'sqlite:///' + os.path.join(
+            self.directory, 'benchmark.db')
+        benchmark.seed_database(self.database, 200)
+
+    def tearDown(self):
+        """Remove the database"""
+        db.session.remove()
+        shutil.rmtree(self.directory)
+
+    def test_run_benchmark(self):
+        result = benchmark.run_benchmark(self.database, requests=3)
+
+        self.assertEqual(result['meta']['questions'], 200)
+        self.assertEqual(
+            list(result['scenarios']),
+            [scenario.name for scenario in benchmark.SCENARIOS])
+        for name, summary in result['scenarios'].items():
+            self.assertEqual(summary['errors'], 0, name)
+            self.assertIsNotNone(summary['p99_ms'], name)
+
+    def test_seed_database_clears_quiz_events(self):
+        app = create_app({'DATABASE_PATH': self.database})
+        with app.app_context():
+            QuizEvent.insert_many([{'question_id': 1, 'correct': True,
+                                    'created_at': datetime.utcnow()}])
+            db.session.remove()
+
+        benchmark.seed_database(self.database, 10)
+
+        with app.app_context():
+            self.assertEqual(QuizEvent.query.count(), 0)
+
+    def test_compare_results_flags_regressions(self):
+        def result(p95_ms, throughput):
+            return {'scenarios': {'GET /categories': {
+                'p95_ms': p95_ms, 'throughput': throughput, 'errors': 0,
+            }}}
+
+        comparison = benchmark.compare_results(
+            result(10.0, 100.0), result(10.5, 95.0))
+        self.assertEqual(comparison[0]['regressions'], [])
+
+        comparison = benchmark.compare_results(
+            result(10.0, 100.0), result(20.0, 50.0))
+        self.assertEqual(
+            comparison[0]['regressions'], ['p95_ms', 'throughput'])
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -11,6 +11,7 @@ class QuizView extends Component {
     this.state = {
       quizCategory: null,
       previousQuestions: [],
+      deck: [],
       showAnswer: false,
       categories: {},
       numCorrect: 0,
@@ -36,65 +37,91 @@ class QuizView extends Component {
   }
 
   selectCategory = ({ type, id = 0 }) => {
-    this.setState({ quizCategory: { type, id } }, this.getNextQuestion);
+    this.setState({ quizCategory: { type, id } }, this.getDeck);
   };
 
   handleChange = event => {
     this.setState({ [event.target.name]: event.target.value });
   };
 
-  getNextQuestion = () => {
-    const previousQuestions = [...this.state.previousQuestions];
-    if (this.state.currentQuestion.id) {
-      previousQuestions.push(this.state.currentQuestion.id);
-    }
-
+  getDeck = () => {
     $.ajax({
-      url: "/quizzes",
+      url: "/quizzes/deck",
       type: "POST",
       dataType: "json",
       contentType: "application/json",
       data: JSON.stringify({
-        previous_questions: previousQuestions,
-        quiz_category: this.state.quizCategory
+        previous_questions: this.state.previousQuestions,
+        quiz_category: this.state.quizCategory,
+        count: questionsPerPlay
       }),
       xhrFields: {
         withCredentials: true
       },
       crossDomain: true,
       success: result => {
-        this.setState({
-          showAnswer: false,
-          previousQuestions: previousQuestions,
-          currentQuestion: result.question,
-          guess: "",
-          forceEnd: result.question ? false : true
-        });
+        this.setState({ deck: result.questions }, this.getNextQuestion);
         return;
       },
       error: error => {
-        alert("Unable to load question. Please try your request again");
+        alert("Unable to load questions. Please try your request again");
         return;
       }
     });
   };
 
+  getNextQuestion = () => {
+    const previousQuestions = [...this.state.previousQuestions];
+    if (this.state.currentQuestion.id) {
+      previousQuestions.push(this.state.currentQuestion.id);
+    }
+    const [nextQuestion, ...deck] = this.state.deck;
+
+    this.setState({
+      showAnswer: false,
+      previousQuestions: previousQuestions,
+      currentQuestion: nextQuestion || {},
+      deck: deck,
+      guess: "",
+      forceEnd: nextQuestion ? false : true
+    });
+  };
+
   submitGuess = event => {
     event.preventDefault();
     const formatGuess = this.state.guess
       .replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g, "")
       .toLowerCase();
     let evaluate = this.evaluateAnswer();
+    this.recordAnswer(evaluate);
     this.setState({
       numCorrect: !evaluate ? this.state.numCorrect : this.state.numCorrect + 1,
       showAnswer: true
     });
   };
 
+  recordAnswer = correct => {
+    // best effort: a failed recording doesn't interrupt the quiz
+    $.ajax({
+      url: "/quizzes/events",
+      type: "POST",
+      dataType: "json",
+      contentType: "application/json",
+      data: JSON.stringify({
+        events: [{ question_id: this.state.currentQuestion.id, correct }]
+      }),
+      xhrFields: {
+        withCredentials: true
+      },
+      crossDomain: true
+    });
+  };
+
   restartGame = () => {
     this.setState({
       quizCategory: null,
       previousQuestions: [],
+      deck: [],
       showAnswer: false,
       numCorrect: 0,
       currentQuestion: {},